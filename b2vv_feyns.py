@@ -1,7 +1,8 @@
 import os
-os.system('mkdir -p feyns')
-from feyn import tree_internal, loop_internal, loop_external, loop_external_quark
-import sys
+os.makedirs('feyns', exist_ok=True)
+from feyn import tree_internal, loop_internal, loop_external, loop_external_quark, render_all
+
+diagrams = []
 
 # b -> s ll
 dec = loop_external_quark(
@@ -16,6 +17,7 @@ dec = loop_external_quark(
     width = 170,
     height = 100,
     fname = 'feyns/b2sll' )
+diagrams.append(dec)
 
 # b ->s qq
 dec = loop_external_quark(
@@ -30,8 +32,8 @@ dec = loop_external_quark(
     width = 170,
     height = 100,
     fname = 'feyns/b2sqq' )
+diagrams.append(dec)
 
-input()
 # B0 -> Kst Kstb
 dec = loop_external(
     A_label=r'$\Bd$',
@@ -43,19 +45,10 @@ dec = loop_external(
     W_label = r'\small{$\Wp$}',
     loop_label = r'$\uquarkbar, \cquarkbar, \tquarkbar$',
     fname='feyns/Bd2KstKst' )
+diagrams.append(dec)
 
 # B0b -> Kst Kstb
-dec = loop_external(
-    A_label=r'$\Bdb$',
-    A_quarks=(r'$\bquark$',r'$\dquarkbar$'),
-    B_label=r'$\Kstarz$',
-    B_quarks=(r'$\dquark$',r'$\squarkbar$'),
-    C_label=r'$\Kstarzb$',
-    C_quarks=(r'$\squark$',r'$\dquarkbar$'),
-    W_label = r'\small{$\Wm$}',
-    loop_label = r'$\uquark, \cquark, \tquark$',
-    anti_at_top = False,
-    fname='feyns/Bdb2KstKst' )
+diagrams.append( dec.conjugate(fname='feyns/Bdb2KstKst') )
 
 # Bs0 -> Kst Kstb
 dec = loop_external(
@@ -68,19 +61,10 @@ dec = loop_external(
     W_label = r'\small{$\Wp$}',
     loop_label = r'$\uquarkbar, \cquarkbar, \tquarkbar$',
     fname='feyns/Bs2KstKst' )
+diagrams.append(dec)
 
 # Bs0b -> Kst Kstb
-dec = loop_external(
-    A_label=r'$\Bsb$',
-    A_quarks=(r'$\bquark$',r'$\squarkbar$'),
-    B_label=r'$\Kstarzb$',
-    B_quarks=(r'$\squark$',r'$\dquarkbar$'),
-    C_label=r'$\Kstarz$',
-    C_quarks=(r'$\dquark$',r'$\squarkbar$'),
-    W_label = r'\small{$\Wm$}',
-    loop_label = r'$\uquark, \cquark, \tquark$',
-    anti_at_top = False,
-    fname='feyns/Bsb2KstKst' )
+diagrams.append( dec.conjugate(fname='feyns/Bsb2KstKst') )
 
 # Bs0 -> JpsiPhi Tree
 dec = tree_internal(
@@ -92,6 +76,7 @@ dec = tree_internal(
     C_quarks=(r'$\squarkbar$',r'$\squark$'),
     W_label = r'\small{$\Wp$}',
     fname='feyns/Bs2JpsiPhi_tree' )
+diagrams.append(dec)
 
 # Bsb0 -> JpsiPhi Tree
 dec = tree_internal(
@@ -104,6 +89,7 @@ dec = tree_internal(
     W_label = r'\small{$\Wm$}',
     anti_at_top = True,
     fname='feyns/Bsb2JpsiPhi_tree' )
+diagrams.append(dec)
 
 # Bs0 -> JpsiPhi Loop
 dec = loop_internal(
@@ -115,16 +101,9 @@ dec = loop_internal(
     C_quarks=(r'$\squarkbar$',r'$\squark$'),
     W_label = r'\small{$\Wp$}',
     fname='feyns/Bs2JpsiPhi_loop' )
+diagrams.append(dec)
 
 # Bs0b -> JpsiPhi Loop
-dec = loop_internal(
-    A_label=r'$\Bsb$',
-    A_quarks=(r'$\bquark$',r'$\squarkbar$'),
-    B_label=r'$\jpsi$',
-    B_quarks=(r'$\cquark$',r'$\cquarkbar$'),
-    C_label=r'$\phi$',
-    C_quarks=(r'$\squark$',r'$\squarkbar$'),
-    W_label = r'\small{$\Wm$}',
-    anti_at_top = False,
-    fname='feyns/Bsb2JpsiPhi_loop' )
+diagrams.append( dec.conjugate(fname='feyns/Bsb2JpsiPhi_loop') )
 
+render_all(diagrams)
@@ -0,0 +1,249 @@
+"""
+Benchmarks of making, writing and compiling diagrams, e.g.
+  python benchmarks.py                       # every benchmark, compiling with a stub TeX toolchain
+  python benchmarks.py --json results.json   # also write the results as JSON, to track them over time
+  python benchmarks.py --tex                 # compile with the installed pdflatex / axohelp instead
+By default the compile benchmarks use stand-ins for pdflatex, axohelp and pdfseparate which
+write placeholder files (see stub_toolchain), so they run anywhere and measure the time spent
+around TeX: writing files, starting processes, the cache and the worker pool
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import feyn
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# arguments which fill every label of each topology (the labels only change the size of the .tex)
+labels = {
+  'A_label'    : r'$\Bd$',
+  'A_quarks'   : (r'$\bquarkbar$', r'$\dquark$'),
+  'Abar_label' : r'$\Bdb$',
+  'Abar_quarks': (r'$\dquarkbar$', r'$\bquark$'),
+  'B_label'    : r'$\Kstarzb$',
+  'B_quarks'   : (r'$\dquarkbar$', r'$\squark$'),
+  'C_label'    : r'$\Kstarz$',
+  'C_quarks'   : (r'$\squarkbar$', r'$\dquark$'),
+  'W_label'    : r'\small{$\Wp$}',
+}
+
+stubs = {
+  # writes a placeholder pdf with a page per axopicture (and the format when run with -ini),
+  # and like the real thing waits for a line on stdin when driven by a tex_worker
+  'pdflatex': r'''
+import os, sys
+if '--version' in sys.argv:
+  print('pdfTeX (feyn benchmark stub)')
+  sys.exit(0)
+args = [ a for a in sys.argv[1:] if not a.startswith('-') ]
+job = next( (a.split('=',1)[1] for a in sys.argv[1:] if a.startswith('-jobname=')), None )
+src = args[-1] if args[-1].endswith('.tex') else args[-1]+'.tex'
+job = job or os.path.splitext(src)[0]
+with open(src) as f:
+  text = f.read()
+if '-ini' in sys.argv:
+  open(job+'.fmt','w').write('stub format\n')
+  sys.exit(0)
+if r'\read16' in text:
+  sys.stdin.readline()
+  with open('feyn.tex') as f:
+    text = f.read()
+open(job+'.log','w').write('stub log\n')
+open(job+'.pdf','w').write('%PDF-1.4 stub pages={}\n'.format(max(1, text.count(r'\begin{axopicture}'))))
+''',
+  'axohelp': r'''
+import sys
+open(sys.argv[-1]+'.ax2','w').write('')
+''',
+  'pdfseparate': r'''
+import sys
+pdf, pattern = sys.argv[-2:]
+pages = int( open(pdf).read().split('pages=')[1] )
+for page in range(1, pages+1):
+  open(pattern % page,'w').write('%PDF-1.4 stub pages=1\n')
+''',
+}
+
+def topologies():
+  # the topologies drawn with fixed coordinates (graph is timed by bench_graph)
+  return { name: topology for name, topology in feyn.topologies().items() if topology is not feyn.graph }
+
+def stub_toolchain(directory):
+  """
+  Write stand-ins for pdflatex, axohelp and pdfseparate into directory and return it
+  (put it at the front of PATH to use them)
+  """
+  os.makedirs(directory, exist_ok=True)
+  for name, code in stubs.items():
+    path = os.path.join(directory, name)
+    with open(path,'w') as f:
+      f.write( f'#!{sys.executable}' + code )
+    os.chmod(path, 0o755)
+  return directory
+
+def best(fn, repeat):
+  """
+  Return the shortest time in seconds of repeat calls of fn
+  """
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append( time.perf_counter()-start )
+  return min(times)
+
+def result(benchmark, n, seconds, **info):
+  return dict(benchmark=benchmark, n=n, seconds=seconds, per_second=n/seconds if seconds else None, **info)
+
+def bench_construct(sizes, repeat):
+  """
+  Time making each topology n times for each n in sizes, drawing every diagram from
+  scratch ('construct') and filling in the labels of a template with stamp ('stamp')
+  """
+  ret = []
+  for name, topology in topologies().items():
+    args = { k: v for k, v in labels.items() if k in feyn.topology_labels(topology) }
+    topology.stamp(**args)  # draws the template once, outside the timing
+    for n in sizes:
+      seconds = best( lambda: [ topology(fname='bench', **args) for i in range(n) ], repeat )
+      ret.append( result('construct', n, seconds, topology=name) )
+      seconds = best( lambda: [ topology.stamp(fname='bench', **args) for i in range(n) ], repeat )
+      ret.append( result('stamp', n, seconds, topology=name) )
+  return ret
+
+def bench_serialize(n, repeat):
+  """
+  Time writing the .tex (to_tex) and .svg (to_svg) code of n diagrams of each topology
+  """
+  ret = []
+  for name, topology in topologies().items():
+    args = { k: v for k, v in labels.items() if k in feyn.topology_labels(topology) }
+    diagrams = [ topology(fname='bench', **args) for i in range(n) ]
+    for benchmark, method in (('to_tex', topology.to_tex), ('to_svg', topology.to_svg)):
+      size = len( method(diagrams[0]) )
+      seconds = best( lambda: [ method(d) for d in diagrams ], repeat )
+      ret.append( result(benchmark, n, seconds, topology=name, bytes_per_second=n*size/seconds) )
+  return ret
+
+# a penguin b -> s qq for bench_graph, with a loop, a gluon and three outgoing legs
+penguin = dict(
+  edges=[ ('b','v1','fermion',r'$\bquark$'), ('v1','v2','fermion',r'$\tquark$'), ('v1','v2','W',r'$\Wm$'),
+          ('v2','s','fermion',r'$\squark$'), ('v2','v3','gluon'), ('v3','q1','fermion',r'$\quark$'),
+          ('q2','v3','fermion',r'$\quarkbar$') ],
+  incoming=['b'], outgoing=['s','q1','q2'])
+
+def bench_graph(n, repeat):
+  """
+  Time making n graph diagrams, laying each one out ('graph') and when the layout
+  of the shape is already cached, as for diagrams which only differ in their labels ('graph cached')
+  """
+  def layout():
+    ret = []
+    for i in range(n):
+      feyn._graph_layouts.clear()
+      ret.append( feyn.graph(fname='bench', **penguin) )
+    return ret
+  seconds = best(layout, repeat)
+  ret = [ result('graph', n, seconds, topology='graph') ]
+  seconds = best( lambda: [ feyn.graph(fname='bench', **penguin) for i in range(n) ], repeat )
+  ret.append( result('graph cached', n, seconds, topology='graph') )
+  return ret
+
+def bench_compile(n, workers, repeat):
+  """
+  Time compiling n diagrams (taking the topologies in turn) into .pdf files in a temporary directory:
+    pool   : compile_pool with the cache turned off
+    batch  : compile_batch with the cache turned off
+    worker : one at a time through a tex_worker
+    cached : compile_pool when every diagram is already in the cache
+  The time spent in each stage (see feyn.profile) is kept with each result
+  """
+  ret = []
+  names = list(topologies())
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory(prefix='feyn-bench-') as tmp:
+    shutil.copy(os.path.join(here, 'lhcb-symbols-def.tex'), tmp)
+    os.chdir(tmp)
+    # keep the formats and the cache of the benchmark to itself
+    saved, feyn.default_cache = feyn.default_cache, feyn.compile_cache(os.path.join(tmp, 'cache'))
+    feyn._formats.clear()
+    worker = feyn.tex_worker()
+    try:
+      def diagrams():
+        return [ topologies()[names[i % len(names)]](fname=f'd{i}') for i in range(n) ]
+      def compile_worker():
+        for d in diagrams():
+          d.write_tex()
+          worker.compile(d.fname, d.passes())
+      cache = feyn.compile_cache(os.path.join(tmp, 'bench-cache'))
+      feyn.compile_pool(diagrams(), workers, cache=cache)
+      runs = [
+        ('pool',   lambda: feyn.compile_pool(diagrams(), workers, cache=False)),
+        ('batch',  lambda: feyn.compile_batch(diagrams(), cache=False)),
+        ('worker', compile_worker),
+        ('cached', lambda: feyn.compile_pool(diagrams(), workers, cache=cache)),
+      ]
+      for benchmark, fn in runs:
+        fn()  # builds the formats and starts the worker, outside the timing
+        with feyn.profile() as records:
+          seconds = best(fn, repeat)
+        stages = { stage: t['total']/repeat for stage, t in feyn._stage_totals(records).items() }
+        ret.append( result(benchmark, n, seconds, workers=workers or os.cpu_count(), stages=stages) )
+    finally:
+      worker.close()
+      feyn.default_cache = saved
+      feyn._formats.clear()
+      os.chdir(cwd)
+  return ret
+
+def table(results):
+  ret = [ '{:<12} {:<20} {:>6} {:>10} {:>12}'.format('benchmark', 'topology', 'n', 'seconds', 'per second') ]
+  for r in results:
+    ret.append( '{:<12} {:<20} {:>6} {:>10.4f} {:>12.1f}'.format(r['benchmark'], r.get('topology', ''), r['n'], r['seconds'], r['per_second'] or 0) )
+  return '\n'.join(ret)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmarks of making, writing and compiling diagrams')
+  parser.add_argument('--sizes', type=lambda s: [ int(n) for n in s.split(',') ], default=[1, 100, 10000],
+                      help='numbers of diagrams to make of each topology (default: 1,100,10000)')
+  parser.add_argument('--serialize', type=int, default=1000, help='number of diagrams to write of each topology (default: 1000)')
+  parser.add_argument('--graphs', type=int, default=500, help='number of graph diagrams to lay out, 0 to skip (default: 500)')
+  parser.add_argument('--compile', type=int, default=20, help='number of diagrams to compile, 0 to skip (default: 20)')
+  parser.add_argument('-j', '--jobs', type=int, default=None, help='number of processes to compile with (default: every core)')
+  parser.add_argument('-r', '--repeat', type=int, default=3, help='take the best of this many runs (default: 3)')
+  parser.add_argument('--tex', action='store_true', help='compile with the installed TeX toolchain rather than the stub')
+  parser.add_argument('--json', metavar='PATH', help='write the results to PATH as JSON')
+  args = parser.parse_args(argv)
+
+  with tempfile.TemporaryDirectory(prefix='feyn-stub-') as stub:
+    if not args.tex:
+      os.environ['PATH'] = stub_toolchain(stub) + os.pathsep + os.environ['PATH']
+    feyn.toolchain_version.cache_clear()
+
+    results = bench_construct(args.sizes, args.repeat)
+    results += bench_serialize(args.serialize, args.repeat)
+    if args.graphs:
+      results += bench_graph(args.graphs, args.repeat)
+    if args.compile:
+      with contextlib.redirect_stdout(io.StringIO()):
+        results += bench_compile(args.compile, args.jobs, args.repeat)
+
+    info = dict(python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(),
+                toolchain='stub' if not args.tex else feyn.toolchain_version(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+
+  print( table(results) )
+  if args.json:
+    with open(args.json,'w') as f:
+      json.dump( dict(info=info, results=results), f, indent=1 )
+
+if __name__ == '__main__':
+  main()
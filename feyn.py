@@ -1,9 +1,34 @@
+import argparse
+import asyncio
+import atexit
+import collections
+import contextlib
+import contextvars
+import copy
+import functools
+import hashlib
+import html
+import inspect
+import json
+import math
 import os
+import re
+import runpy
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 class feyn:
   def __init__(self, fname='feyn', width=190, height=140, dx=0, dy=0,
-                     grid=False, raw=False, wrap_doc=True, wrap_lhcb=True, make_pdf=True
+                     grid=False, raw=False, wrap_doc=True, wrap_lhcb=True, make_pdf=True, cache=True, fmt=True,
+                     axohelp=True, eager=False, backend='tex', worker=None, prune_lhcb=False,
+                     validate=True
               ):
     """
     fname     : where to write the axodraw .tex code (and put the .pdf if make_pdf=True)
@@ -16,6 +41,20 @@ class feyn:
     wrap_doc  : wrap the .tex file with documentclass etc so it can be compiled
     wrap_lhcb : wrap the .tex file with lhcb-symbols-def (which must be in current working dir)
     make_pdf  : compile a standalone pdf
+    cache     : reuse a previously compiled pdf if the .tex has not changed (can also be a compile_cache)
+    fmt       : load the preamble from a precompiled format (built once and reused)
+    axohelp   : use axohelp for photons, gluons and arcs (if False their paths are computed here
+                and written straight into the .tex so the pdf needs a single pdflatex pass)
+    eager     : render as soon as the diagram is made (otherwise nothing is written
+                until render() is called, or the diagram is passed to render_all)
+    backend   : 'tex' writes fname.tex (and fname.pdf) with axodraw, 'svg' draws fname.svg
+                directly without needing LaTeX (labels are shown as plain text)
+    worker    : compile with a tex_worker, which keeps pdflatex started and waiting so that
+                compiling one diagram at a time is quicker (True uses a shared worker)
+    prune_lhcb: rather than reading all of lhcb-symbols-def, define just the macros the
+                diagram uses in the .tex itself (which then compiles without the file)
+    validate  : check the labels and axodraw code before compiling (see check), so that
+                an undefined macro is found without running TeX
     """
 
     self.fname = fname.replace('.tex','').replace('.pdf','')
@@ -27,13 +66,16 @@ class feyn:
     self.raw = raw
     self.wrap_doc = wrap_doc
     self.wrap_lhcb = wrap_lhcb
-    if self.raw:
-      self.wrap_doc = False
-      self.wrap_lhcb = False
+    self.prune_lhcb = prune_lhcb
+    self.validate = validate
     self.make_pdf = make_pdf
-    if self.wrap_lhcb and self.make_pdf:
-      if not os.path.exists('lhcb-symbols-def.tex'):
-        raise FileNotFoundError('Cannot find lhcb-symbols-def.tex file and option wrap_lhcb is set to True')
+    self.cache = cache
+    self.fmt = fmt
+    self.axohelp = axohelp
+    self.backend = backend
+    self.eager = eager
+    self.worker = worker
+    self.check_options()
 
     # defaults
     self.oval_width  = 5
@@ -42,25 +84,28 @@ class feyn:
     self.vertex_rad  = 2
 
     self.lines = []
-    self.maxw  = 0
     self.buffer = 2
 
+  def check_options(self):
+    """
+    Apply the options which change others (raw) and check the backend, and that lhcb-symbols-def.tex
+    is there if the diagram is rendered straight away
+    """
+    if self.raw:
+      self.wrap_doc = False
+      self.wrap_lhcb = False
+    if self.backend not in ('tex', 'svg'):
+      raise ValueError(f'Unknown backend {self.backend}, should be tex or svg')
+    if self.eager and self.backend=='tex' and self.wrap_lhcb and self.make_pdf:
+      if not os.path.exists('lhcb-symbols-def.tex'):
+        raise FileNotFoundError('Cannot find lhcb-symbols-def.tex file and option wrap_lhcb is set to True')
+
   def text(self,x,y,text=None,align=None):
     if text is None: return ''
-    else:
-      ret = r'\Text' + '({0},{1})'.format(x+self.dx,y+self.dy)
-      if align is not None:
-        if '[' in align and ']' in align:
-          ret += align
-        else:
-          ret += '['+align+']'
-      ret += f'{{{text}}}'
-      return ret
+    return Text((x,y), text, align)
 
   def state(self,x,y):
-    ret = r'\GOval' + '({0},{1})'.format(x+self.dx,y+self.dy)
-    ret += '({0},{1})(90){{{2}}}'.format(self.oval_width,self.oval_height,self.oval_grey)
-    return ret
+    return Oval((x,y), self.oval_width, self.oval_height, 90, self.oval_grey)
 
   def fermion(self,start,end,reverse=False,opts=[]):
     st = start
@@ -69,16 +114,15 @@ class feyn:
       st = end
       ed = start
 
-    optstr = ','.join( ['arrow'] + opts )
-
     assert(len(st)==2)
     assert(len(ed)==2)
 
-    return r'\Line[{}]'.format(optstr) + '({0},{1})'.format(st[0]+self.dx,st[1]+self.dy) + '({0},{1})'.format(ed[0]+self.dx,ed[1]+self.dy)
+    return Line(st, ed, ['arrow'] + opts)
 
   def fermion_arc(self, centre, radius, start, end, reverse=False, opts=[]):
     st = start
     ed = end
+    opts = list(opts)
     if reverse:
       st = end
       ed = start
@@ -94,82 +138,3128 @@ class feyn:
       for rm in rms: opts.remove(rm)
       for add in adds: opts.append(add)
 
-
-    optstr = ','.join( ['arrow'] + opts )
-
-    return r'\Arc[{}]'.format(optstr) + '({0},{1})'.format(centre[0]+self.dx,centre[1]+self.dy) + '({0},{1},{2})'.format(radius,st,ed)
+    return Arc(centre, radius, st, ed, ['arrow'] + opts)
 
   def photon(self,start,end,ampl,N):
-    st = start
-    ed = end
-    return r'\Photon' + '({0},{1})'.format(st[0]+self.dx,st[1]+self.dy) + '({0},{1})'.format(ed[0]+self.dx,ed[1]+self.dy) + '{{{0}}}{{{1}}}'.format(ampl,N)
+    return Photon(start, end, ampl, N)
 
   def gluon(self,start,end,ampl,N):
-    st = start
-    ed = end
-    return r'\Gluon' + '({0},{1})'.format(st[0]+self.dx,st[1]+self.dy) + '({0},{1})'.format(ed[0]+self.dx,ed[1]+self.dy) + '{{{0}}}{{{1}}}'.format(ampl,N)
+    return Gluon(start, end, ampl, N)
 
   def photon_arc(self, centre, radius, start, end, ampl, N):
-    return r'\PhotonArc' + '({0},{1})'.format(centre[0]+self.dx,centre[1]+self.dy) + '({0},{1},{2})'.format(radius,start,end) + '{{{0}}}{{{1}}}'.format(ampl,N)
+    return PhotonArc(centre, radius, start, end, ampl, N)
 
   def vertex(self,x,y):
-    return r'\Vertex' + '({0},{1}){{{2}}}'.format(x+self.dx,y+self.dy,self.vertex_rad)
+    return Vertex((x,y), self.vertex_rad)
 
   def add_element(self, obj, comment=None):
-    comm = comment or ''
-    self.lines.append( [obj, comm] )
-    self.maxw = max(self.maxw, len(obj) )
+    """
+    Add an element (or a line of axodraw code) to the diagram
+    """
+    self.lines.append( [obj, comment or ''] )
+
+  def element_tex(self, obj):
+    """
+    Return the axodraw code for one element of the diagram
+    """
+    if isinstance(obj, str): return obj
+    return obj.tex(self.dx, self.dy, self.axohelp)
 
-  def write(self, header=None):
+  def preamble(self):
+    """
+    Return the lines which open the document (documentclass, packages and lhcb-symbols-def)
+    """
+    return tex_preamble(self.wrap_doc, self.wrap_lhcb, prune=self.prune_lhcb)
+
+  def lhcb_definitions(self, picture):
+    """
+    Return the lines defining the macros of lhcb-symbols-def used in picture (if prune_lhcb=True)
+    """
+    if not (self.wrap_lhcb and self.prune_lhcb): return []
+    return lhcb_macros().definitions( used_macros(picture) )
 
+  def check(self, strict=False):
+    """
+    Return the problems found in the labels and axodraw code of this diagram without compiling it:
+    macros which are not defined (by LaTeX, axodraw2 or lhcb-symbols-def), unbalanced braces or $,
+    and unknown axodraw commands, options or alignments. Macros outside the usual ones are looked up
+    in TeX (see tex_defined), or only warned about if pdflatex cannot be run
+    strict : only accept the usual macros, without asking TeX, and no ^^ character codes
+             (used for labels which are not trusted, e.g. those of render_service)
+    """
+    known = (latex_macros | macro_index()) if self.wrap_lhcb else latex_macros
+    # any other macro is looked up in TeX itself, and left for TeX to report if it cannot be asked
+    names = used_macros( self.element_tex(obj) for where, obj in self.elements() ) - known - axodraw_commands
+    if names and not strict:
+      defined = tex_defined(names, self.wrap_lhcb)
+      if defined is None:
+        warnings.warn( f'{self.fname}: cannot run pdflatex to check ' + ', '.join( '\\'+name for name in sorted(names) ) )
+        known = known | names
+      else:
+        known = known | { name for name in names if defined[name] }
+    ret = []
+    for where, obj in self.elements():
+      ret += [ f'{self.fname}: {where}: {problem}' for problem in check_element(obj, known) ]
+      # ^^5c is another way of writing a backslash
+      if strict and '^^' in self.element_tex(obj):
+        ret.append( f'{self.fname}: {where}: character code ^^' )
+    return ret
+
+  def elements(self):
+    """
+    Return the elements of the diagram with a description of each from the comments
+    (e.g. 'A meson: quark Line'), as a list of (description, element)
+    """
+    ret = []
+    section = ''
+    for obj, comment in self.lines:
+      if isinstance(obj, str) and obj.lstrip().startswith('%'):
+        section = obj.strip(' %')
+        continue
+      ret.append( (': '.join( part for part in (section, comment.strip(' %')) if part ) or str(obj).strip(), obj) )
+    return ret
+
+  def layout(self):
+    """
+    Return where each element is drawn, as a list of (description, element, points on its outline),
+    using approximate font metrics for the labels (see label_extent)
+    """
+    ret = []
+    for where, obj in self.elements():
+      if isinstance(obj, str): obj = from_tex(obj)
+      if obj is None: continue
+      points = obj.outline(self.dx, self.dy)
+      if points: ret.append( (where, obj, points) )
+    return ret
+
+  def check_layout(self, margin=1):
+    """
+    Return the problems with the layout of this diagram without running TeX: elements drawn outside
+    the picture, and labels which overlap each other or other elements
+    margin : overlaps and overhangs smaller than this (in pt) are ignored
+    """
+    ret = []
+    layout = [ (where, obj, points, bounds(points)) for where, obj, points in self.layout() ]
+    for where, obj, points, (x0, y0, x1, y1) in layout:
+      over = { 'left': -x0, 'bottom': -y0, 'right': x1-self.width, 'top': y1-self.height }
+      sides = [ side for side, v in over.items() if v > margin ]
+      if sides:
+        ret.append( f'{self.fname}: {where}: outside the picture by {max(over.values()):.0f}pt on the {" and ".join(sides)}' )
+
+    for i, (where, obj, points, box) in enumerate(layout):
+      if not isinstance(obj, Text): continue
+      x0, y0, x1, y1 = box[0]+margin, box[1]+margin, box[2]-margin, box[3]-margin
+      for j, (other, obj2, points2, box2) in enumerate(layout):
+        if j == i or (isinstance(obj2, Text) and j < i): continue
+        if box2[0] >= x1 or box2[2] <= x0 or box2[1] >= y1 or box2[3] <= y0: continue
+        if isinstance(obj2, Text) or any( x0 < x < x1 and y0 < y < y1 for x, y in points2 ):
+          ret.append( f'{self.fname}: {where} overlaps {other}' )
+    return ret
+
+  def tight_layout(self, pad=5):
+    """
+    Return the width, height, dx and dy which fit the picture to what is drawn (see layout)
+    pad : space to leave around the drawing (in pt)
+    """
+    x0, y0, x1, y1 = bounds([ p for where, obj, points in self.layout() for p in points ])
+    return { 'width' : math.ceil(x1-x0+2*pad), 'height': math.ceil(y1-y0+2*pad),
+             'dx': _number(round(self.dx-x0+pad)), 'dy': _number(round(self.dy-y0+pad)) }
+
+  def needs_lhcb(self):
+    """
+    Whether compiling the .tex needs lhcb-symbols-def.tex in the current working dir
+    """
+    return self.wrap_lhcb and not self.prune_lhcb
+
+  def picture(self):
+    """
+    Return the lines of the axopicture environment which draws the diagram
+    """
+    ret = [ r'\begin{axopicture}'+f'({self.width},{self.height})\n' ]
+
+    if self.grid:
+      nx = int(self.width / 10 )
+      ny = int(self.height / 10 )
+      ret.append( r'\AxoGrid(0,0)(10,10)'+f'({nx},{ny})'+r'{LightGray}{0.5}' )
+
+    objs = [ self.element_tex(line[0]) for line in self.lines ]
+    # don't pad every comment out to the end of a long inline path
+    maxw = max( [ len(obj) for obj in objs if not obj.startswith(r'\put(0,0){\pdfliteral') ], default=0 )
+    for obj, line in zip(objs, self.lines):
+      ret.append( '  {:<{width}} {}'.format(obj,line[1],width=maxw+self.buffer) )
+
+    ret.append( r'\end{axopicture}' )
+    return ret
+
+  def to_tex(self, header=None):
+    """
+    Return the .tex code for this diagram
+    header : text to put at the top of the file
+    """
+    lines = []
+    if header: lines.append( f'{header} \n' )
+
+    lines += self.preamble()
+
+    if self.wrap_doc:
+      lines.append( r'\begin{document}' )
+
+    picture = self.picture()
+    lines += self.lhcb_definitions(picture)
+    lines += picture
+
+    if self.wrap_doc:
+      lines.append( r'\end{document}' )
+
+    return ''.join( line+'\n' for line in lines )
+
+  def write_tex(self, header=None):
+    """
+    Write the .tex code for this diagram to fname.tex
+    """
     print(f'Writing file, {self.fname}.tex')
+    start = time.perf_counter()
     with open(self.fname+'.tex','w') as f:
+      f.write( self.to_tex(header) )
+    _timed(self.fname, 'tex', start)
 
-      if header: print(header, '\n', file=f)
+  def to_svg(self):
+    """
+    Return an svg drawing of this diagram
+    """
+    ret = [ '<svg xmlns="http://www.w3.org/2000/svg" width="{0}pt" height="{1}pt" viewBox="0 0 {0} {1}">'.format(self.width, self.height),
+            '<g stroke="black" stroke-width="0.5" stroke-linecap="round" stroke-linejoin="round" font-family="serif" font-size="10" font-style="italic">' ]
 
-      if self.wrap_doc:
-        print(r'\documentclass{standalone}', file=f)
-        print(r'\usepackage{axodraw2}', file=f)
+    if self.grid:
+      for x in range(0, int(self.width)+1, 10):
+        ret.append( f'<line x1="{x}" y1="0" x2="{x}" y2="{self.height}" stroke="lightgray"/>' )
+      for y in range(0, int(self.height)+1, 10):
+        ret.append( f'<line x1="0" y1="{self.height-y}" x2="{self.width}" y2="{self.height-y}" stroke="lightgray"/>' )
 
-      if self.wrap_lhcb:
-        print(r'\usepackage{ifthen}', file=f)
-        print(r'\newboolean{uprightparticles}', file=f)
-        print(r'\setboolean{uprightparticles}{false}', file=f)
-        print(r'\newboolean{pdflatex}', file=f)
-        print(r'\setboolean{pdflatex}{true}', file=f)
-        print(r'\input{lhcb-symbols-def}', file=f)
+    for line in self.lines:
+      ret += svg_element(line[0], self.height, self.dx, self.dy)
 
-      if self.wrap_doc:
-        print(r'\begin{document}', file=f)
+    ret += [ '</g>', '</svg>' ]
+    return ''.join( line+'\n' for line in ret )
 
-      print(r'\begin{axopicture}'+f'({self.width},{self.height})\n',file=f)
+  def write_svg(self):
+    """
+    Write the svg drawing of this diagram to fname.svg
+    """
+    print(f'Writing file, {self.fname}.svg')
+    start = time.perf_counter()
+    with open(self.fname+'.svg','w') as f:
+      f.write( self.to_svg() )
+    _timed(self.fname, 'svg', start)
 
-      if self.grid:
-        nx = int(self.width / 10 )
-        ny = int(self.height / 10 )
-        print(r'\AxoGrid(0,0)(10,10)'+f'({nx},{ny})'+r'{LightGray}{0.5}',file=f)
+  def render(self, header=None):
+    """
+    Write fname.tex and (if make_pdf=True) compile it into fname.pdf,
+    or write fname.svg for backend='svg'
+    header : text to put at the top of the file
+    """
+    if _collected_instead([self]): return
+    if self.backend == 'svg':
+      self.write_svg()
+      return
 
-      for line in self.lines:
-        print('  {:<{width}}'.format(line[0],width=self.maxw+self.buffer),line[1],file=f)
+    if self.make_pdf and self.needs_lhcb() and not os.path.exists('lhcb-symbols-def.tex'):
+      raise FileNotFoundError('Cannot find lhcb-symbols-def.tex file and option wrap_lhcb is set to True')
+    check_diagrams([self])
+    self.write_tex(header)
 
-      print(r'\end{axopicture}',file=f)
+    if self.make_pdf:
+      print(f'Compiling tex file into {self.fname}.pdf')
+      # the format and the worker are only made if the diagram is not in the cache
+      worker = functools.partial(default_worker, self.wrap_lhcb, self.prune_lhcb) if self.worker is True else self.worker
+      compile_tex(self.fname, self.needs_lhcb(), self.cache, self.format if header is None else None, self.passes(), worker)
 
-      if self.wrap_doc:
-        print(r'\end{document}', file=f)
+  # older name for render
+  write = render
 
-    if self.make_pdf:
+  async def render_async(self, header=None, limit=None):
+    """
+    The same as render, but compiles with asyncio subprocesses so it can be awaited from an event loop
+    header : text to put at the top of the file
+    limit  : an asyncio.Semaphore to limit how many compiles run at once
+    Returns the file written (fname.pdf, or fname.tex / fname.svg if there is no pdf)
+    """
+    if self.backend == 'svg':
+      self.write_svg()
+      return self.fname+'.svg'
+
+    if self.make_pdf and self.needs_lhcb() and not os.path.exists('lhcb-symbols-def.tex'):
+      raise FileNotFoundError('Cannot find lhcb-symbols-def.tex file and option wrap_lhcb is set to True')
+    # checking the labels may run pdflatex (see tex_defined), so do it in a thread
+    await asyncio.to_thread(check_diagrams, [self])
+    self.write_tex(header)
+    if not self.make_pdf:
+      return self.fname+'.tex'
+
+    async with limit or contextlib.nullcontext():
       print(f'Compiling tex file into {self.fname}.pdf')
-      os.system(f'cp {self.fname}.tex /tmp/')
-      if self.wrap_lhcb:
-        os.system(f'cp lhcb-symbols-def.tex /tmp/')
-
-      cwd = os.getcwd()
-      os.chdir('/tmp')
-      dirname = os.path.dirname(self.fname)
-      basename = os.path.basename(self.fname)
-      subprocess.run(f'pdflatex {basename}; axohelp {basename}; pdflatex {basename}', shell=True, check=True, capture_output=True)
-      os.system(f'cp {basename}.pdf {cwd}/{dirname}')
-      os.chdir(cwd)
+      return await compile_tex_async(self.fname, self.needs_lhcb(), self.cache, self.format if header is None else None, self.passes())
+
+  def passes(self):
+    """
+    Return the passes needed to compile this diagram (see plan_passes)
+    """
+    return plan_passes(self.lines, self.axohelp)
+
+  def format(self):
+    """
+    Return the precompiled format for the preamble of this diagram (or None if it is not used)
+    """
+    if not (self.fmt and self.wrap_doc): return None
+    return tex_format(self.wrap_lhcb, prune=self.prune_lhcb)
+
+  def copy(self, lines=None, **kwargs):
+    """
+    Return a copy of this diagram (with new lines if given)
+    kwargs : change options of the copy, e.g. fname='other'
+    """
+    ret = copy.copy(self)
+    ret.lines = [ list(line) for line in self.lines ] if lines is None else lines
+    for k, v in kwargs.items():
+      if not hasattr(self, k):
+        raise TypeError(f'Unknown option {k}')
+      setattr(ret, k, v.replace('.tex','').replace('.pdf','') if k=='fname' else v)
+    return ret
+
+  def transform(self, scale=1, shift=(0,0), flip_x=False, flip_y=False, **kwargs):
+    """
+    Return a copy of this diagram with every element moved at once (using numpy)
+    scale  : scale the diagram (and its width and height) by this factor
+    shift  : then move every element by this amount in x and y
+    flip_x : mirror the diagram left to right
+    flip_y : mirror the diagram top to bottom
+    kwargs : change options of the copy, e.g. fname='other'
+    Labels keep their size and stay readable, but are aligned on the other side when mirrored
+    """
+    # optional dependency, only needed for transforms
+    import numpy as np
+    sx = -scale if flip_x else scale
+    sy = -scale if flip_y else scale
+    width, height = self.width*scale, self.height*scale
+    # scale about the corner of the picture, and mirror about its centre
+    offset = np.array([ (width - self.dx*(scale+1) if flip_x else self.dx*(scale-1)) + shift[0],
+                        (height - self.dy*(scale+1) if flip_y else self.dy*(scale-1)) + shift[1] ])
+
+    elements = [ obj for obj, comment in self.lines if not isinstance(obj, str) ]
+    npoints = [ len(obj.points()) for obj in elements ]
+    points = np.array( [ p for obj in elements for p in obj.points() ], dtype=float ).reshape(-1, 2)
+    points = points * (sx, sy) + offset
+
+    moved = {}
+    i = 0
+    for obj, n in zip(elements, npoints):
+      moved[id(obj)] = obj.transformed( [ tuple( _number(v) for v in p ) for p in points[i:i+n] ], sx, sy )
+      i += n
+    lines = [ [ moved.get(id(obj), obj), comment ] for obj, comment in self.lines ]
+    kwargs.setdefault('width', _number(width))
+    kwargs.setdefault('height', _number(height))
+    return self.copy(lines, **kwargs)
+
+  def shift(self, x, y, **kwargs):
+    """
+    Return a copy of this diagram with every element moved by x and y
+    """
+    return self.transform(shift=(x,y), **kwargs)
+
+  def scale(self, scale, **kwargs):
+    """
+    Return a copy of this diagram scaled by scale (along with its width and height)
+    """
+    return self.transform(scale=scale, **kwargs)
+
+  def mirror(self, flip_x=True, flip_y=False, **kwargs):
+    """
+    Return a mirror image of this diagram (left to right by default)
+    """
+    return self.transform(flip_x=flip_x, flip_y=flip_y, **kwargs)
+
+  def conjugate(self, **kwargs):
+    """
+    Return the CP conjugate of this diagram, with every fermion arrow reversed and the particles
+    in the labels swapped for their antiparticles (e.g. \\bquark and \\bquarkbar, \\Bd and \\Bdb)
+    kwargs : change options of the copy, e.g. fname='other'
+    """
+    lines = []
+    for obj, comment in self.lines:
+      if isinstance(obj, (Line, Arc)) and 'arrow' in obj.opts:
+        obj = obj.reversed()
+      elif isinstance(obj, Text):
+        obj = Text(obj.pos, conjugate_label(obj.text), obj.align)
+      lines.append( [ obj, conjugate_comment(comment) ] )
+    ret = self.copy(lines, **kwargs)
+    if hasattr(self, 'aq'):
+      ret.aq, ret.qq = self.qq, self.aq
+    return ret
+
+  @classmethod
+  def template(cls, **structure):
+    """
+    Return the (cached) template of this topology, drawn once with every label left as a slot
+    structure : the options which change the drawing, e.g. anti_at_top=False
+    """
+    key = (cls, tuple(sorted(structure.items())))
+    if key not in _templates:
+      _templates[key] = topology_template(cls, **structure)
+    return _templates[key]
+
+  @classmethod
+  def stamp(cls, **kwargs):
+    """
+    Make a diagram of this topology by filling the labels of its cached template, which is much
+    quicker than drawing it again when making many diagrams which only differ in their labels.
+    Takes the same arguments as the topology, e.g. tree_external.stamp(A_label=r'$\\Bd$', fname='Bd')
+    """
+    options = topology_options(cls)
+    structure = { k: kwargs.pop(k) for k in list(kwargs) if k in options }
+    return cls.template(**structure)(**kwargs)
+
+class slot:
+  """
+  A label left to fill in when a diagram is stamped out of a template
+  (the index picks one of a pair of labels, e.g. A_quarks[1])
+  """
+  __slots__ = ('name', 'index')
+
+  def __init__(self, name, index=None):
+    self.name = name
+    self.index = index
+
+  def __repr__(self):
+    return f'{{{self.name}}}' if self.index is None else f'{{{self.name}[{self.index}]}}'
+
+  def fill(self, labels):
+    value = labels.get(self.name)
+    if value is not None and self.index is not None: value = value[self.index]
+    return value
+
+def is_label(default):
+  return default is None or ( isinstance(default, tuple) and all( v is None for v in default ) )
+
+@functools.lru_cache(maxsize=None)
+def topology_labels(topology):
+  """
+  Return the label arguments of a topology and their defaults
+  """
+  params = inspect.signature(topology.__init__).parameters.values()
+  return { p.name: p.default for p in params if p.kind == p.POSITIONAL_OR_KEYWORD and p.name != 'self' and is_label(p.default) }
+
+@functools.lru_cache(maxsize=None)
+def topology_options(topology):
+  """
+  Return the arguments of a topology which change its drawing (other than the labels)
+  """
+  params = inspect.signature(topology.__init__).parameters.values()
+  return { p.name for p in params if p.kind == p.POSITIONAL_OR_KEYWORD and p.name != 'self' and not is_label(p.default) }
+
+_templates = {}
+
+class topology_template:
+  """
+  The elements of a topology drawn once with its labels left as slots. Calling the template
+  with the usual arguments of the topology (labels, fname, dx, ...) makes a new diagram
+  which shares its elements and only makes the labels given, without drawing the topology again.
+  Usually made through the topology, e.g. tree_external.template(anti_at_top=False)
+  """
+  def __init__(self, topology, **structure):
+    self.topology = topology
+    self.structure = structure
+    self.labels = topology_labels(topology)
+    slots = { name: slot(name) if default is None else tuple( slot(name, i) for i in range(len(default)) )
+              for name, default in self.labels.items() }
+    skeleton = topology(**slots, **structure)
+    # the lines are shared by every diagram stamped out (as tuples, so they cannot be changed in place),
+    # with the labels left empty; only the ones given are made again when stamping
+    self.lines = [ tuple(line) for line in skeleton.lines ]
+    self.slots = {}
+    for i, (obj, comment) in enumerate(self.lines):
+      if isinstance(obj, Text) and isinstance(obj.text, slot):
+        self.slots.setdefault(obj.text.name, []).append((i, obj, comment))
+        self.lines[i] = ('', comment)
+    # the state of a new diagram: the default options and the attributes set by the topology itself (e.g. aq, qq)
+    self.state = dict(vars(skeleton), lines=None)
+    self.state.update( (k, v) for k, v in vars(feyn()).items() if k != 'lines' )
+
+  def __call__(self, **kwargs):
+    labels = { k: kwargs.pop(k) for k in list(kwargs) if k in self.labels }
+    # a new diagram without running feyn.__init__ or drawing the topology again
+    d = object.__new__(self.topology)
+    d.__dict__.update(self.state)
+    for k, v in kwargs.items():
+      if k not in self.state or k == 'lines':
+        raise TypeError(f'{self.topology.__name__}() got an unexpected keyword argument {k!r}')
+      setattr(d, k, v)
+    if 'fname' in kwargs: d.fname = d.fname.replace('.tex','').replace('.pdf','')
+    d.check_options()
+    d.lines = list(self.lines)
+    for name, value in labels.items():
+      if value is None: continue
+      for i, obj, comment in self.slots.get(name, ()):
+        text = obj.text.fill(labels)
+        if text is not None: d.lines[i] = (Text(obj.pos, text, obj.align), comment)
+    if d.eager: d.render()
+    return d
+
+def tex_preamble(wrap_doc=True, wrap_lhcb=True, multi=False, prune=False):
+  """
+  Return the lines which open a document
+  wrap_doc  : include the documentclass and axodraw2
+  wrap_lhcb : include lhcb-symbols-def
+  multi     : make every axopicture a separate page (used by compile_batch)
+  prune     : only load the packages lhcb-symbols-def needs, its macros are then
+              defined in the document itself (see lhcb_macros)
+  """
+  ret = []
+  if wrap_doc:
+    ret.append(r'\documentclass[multi=axopicture]{standalone}' if multi else r'\documentclass{standalone}')
+    ret.append(r'\usepackage{axodraw2}')
+
+  if wrap_lhcb:
+    ret.append(r'\usepackage{ifthen}')
+    ret.append(r'\newboolean{uprightparticles}')
+    ret.append(r'\setboolean{uprightparticles}{false}')
+    ret.append(r'\newboolean{pdflatex}')
+    ret.append(r'\setboolean{pdflatex}{true}')
+    if prune:
+      ret += lhcb_macros().packages
+    else:
+      ret.append(r'\input{lhcb-symbols-def}')
+  return ret
+
+# commands which start a new statement of lhcb-symbols-def.tex
+macro_statements = ('def', 'newcommand', 'renewcommand', 'providecommand', 'DeclareRobustCommand', 'let', 'mathchardef',
+                    'ifthenelse', 'usepackage', 'makeatletter', 'makeatother')
+
+class macro_table:
+  """
+  The definitions of a file of macros (lhcb-symbols-def.tex), indexed by the macros they define and use,
+  so that a diagram can carry just the definitions it needs rather than the whole file
+  path : the file to read
+  """
+  def __init__(self, path='lhcb-symbols-def.tex'):
+    with open(path) as f:
+      # drop the comments, but keep the % which stops the end of the line making a space
+      text = '\n'.join( re.sub(r'(?<!\\)%.*', '%', line) for line in f.read().split('\n') )
+
+    self.packages = []
+    self.conditions = []
+    # each definition is (text, names defined, names used, needs makeatletter, (condition, branch) or None)
+    self.statements = []
+    at = False
+    for text in self._split(text):
+      command = re.match(r'\\([A-Za-z]+)', text).group(1)
+      if command == 'usepackage': self.packages.append(text)
+      elif command == 'makeatletter': at = True
+      elif command == 'makeatother': at = False
+      elif command == 'ifthenelse':
+        condition, branches = self._branches(text)
+        self.conditions.append(condition)
+        for branch, body in enumerate(branches):
+          for sub in self._split(body):
+            self._add(sub, at, (len(self.conditions)-1, branch))
+      else:
+        self._add(text, at, None)
+
+    self.defined = {}
+    for i, statement in enumerate(self.statements):
+      for name in statement[1]:
+        self.defined.setdefault(name, []).append(i)
+
+  @staticmethod
+  def _split(text):
+    """
+    Split text into statements, each starting with one of macro_statements outside any braces
+    """
+    starts = []
+    depth = 0
+    for m in re.finditer(r'\\([A-Za-z@]+|.)|[{}]', text):
+      if m.group(0) == '{': depth += 1
+      elif m.group(0) == '}': depth -= 1
+      elif depth == 0 and m.group(1) in macro_statements:
+        # the name after \def or \let is not a new statement
+        if not re.search(r'\\(def|let|mathchardef)\s*$', text[:m.start()]):
+          starts.append(m.start())
+    return [ text[a:b].rstrip(' \t\n%') for a, b in zip(starts, starts[1:]+[len(text)]) ]
+
+  @staticmethod
+  def _branches(text):
+    """
+    Return the condition and the two branches of an \\ifthenelse
+    """
+    groups = []
+    depth = 0
+    for m in re.finditer(r'\\[A-Za-z@]+|\\.|[{}]', text):
+      if m.group(0) == '{':
+        if depth == 0: start = m.end()
+        depth += 1
+      elif m.group(0) == '}':
+        depth -= 1
+        if depth == 0: groups.append( text[start:m.start()] )
+    return groups[0], groups[1:3]
+
+  def _add(self, text, at, condition):
+    m = re.match(r'\\(?:def|let|mathchardef|[A-Za-z]*[Cc]ommand)\s*\{?\s*\\([A-Za-z@]+)', text)
+    defines = { m.group(1) } if m else set()
+    uses = set( re.findall(r'\\([A-Za-z@]+)', text) ) - defines
+    self.statements.append( (text, defines, uses, at, condition) )
+
+  def needed(self, names):
+    """
+    Return the macros among names which are defined here, with every macro their definitions use
+    """
+    todo = [ name for name in names if name in self.defined ]
+    ret = set(todo)
+    while todo:
+      for i in self.defined[todo.pop()]:
+        for name in self.statements[i][2]:
+          if name in self.defined and name not in ret:
+            ret.add(name)
+            todo.append(name)
+    return ret
+
+  def body(self, name):
+    """
+    Return the replacement text of a macro without arguments (as it is defined
+    when uprightparticles is false), or None if it has arguments or is not a \\def
+    """
+    for i in reversed( self.defined.get(name, []) ):
+      text, defines, uses, at, condition = self.statements[i]
+      if condition is not None and condition[1] != 1: continue
+      m = re.match(r'\\(?:def\s*\\[A-Za-z@]+|[A-Za-z]*[Cc]ommand\s*\{\s*\\[A-Za-z@]+\s*\})\s*\{', text)
+      if m is None: return None
+      depth = 1
+      for j in range(m.end(), len(text)):
+        if text[j] == '{' and text[j-1] != '\\': depth += 1
+        elif text[j] == '}' and text[j-1] != '\\': depth -= 1
+        if depth == 0: return text[m.end():j]
+      return None
+    return None
+
+  def definitions(self, names):
+    """
+    Return the lines which define the macros among names (and the macros they use), in the order of
+    the file. Every line ends with a %, so they can go in the body of the document without adding space
+    """
+    names = self.needed(names)
+    keep = sorted( { i for name in names for i in self.defined[name] } )
+    ret = []
+    branches = None
+    for i in keep:
+      text, defines, uses, at, condition = self.statements[i]
+      text = text.strip()
+      if at: text = r'\makeatletter' + text + r'\makeatother'
+      # a space ends a number (e.g. \mathchardef\PXi="7104) and is then dropped
+      if text[-1].isdigit(): text += ' '
+      if condition is None:
+        ret.append( text+'%' )
+        continue
+      if branches is None or condition[0] != branches[0]:
+        branches = ( condition[0], ([], []) )
+        ret.append( branches )
+      branches[1][condition[1]].append( text )
+    for i, line in enumerate(ret):
+      if isinstance(line, tuple):
+        k, (yes, no) = line
+        ret[i] = '\n'.join( [ r'\ifthenelse{'+self.conditions[k]+'}%', '{'+'%\n '.join(yes)+'}%', '{'+'%\n '.join(no)+'}%' ] )
+    return ret
+
+_macro_tables = {}
+
+def lhcb_macros(path='lhcb-symbols-def.tex'):
+  """
+  Return the macro_table of lhcb-symbols-def.tex, read once (and again if the file changes)
+  """
+  if not os.path.exists(path):
+    raise FileNotFoundError(f'Cannot find {path} file and option prune_lhcb is set to True')
+  key = ( os.path.abspath(path), os.path.getmtime(path) )
+  if key not in _macro_tables:
+    _macro_tables[key] = macro_table(path)
+  return _macro_tables[key]
+
+def used_macros(lines):
+  """
+  Return the names of the macros used in some lines of TeX
+  """
+  return { name for line in lines for name in re.findall(r'\\([A-Za-z@]+)', line) }
+
+# commands of axodraw2, the options of its lines and arcs, and the usual LaTeX commands found in labels,
+# which check_diagrams accepts along with the macros of lhcb-symbols-def (see macro_index)
+axodraw_commands = {
+  'Line', 'DashLine', 'ArrowLine', 'DashArrowLine', 'DoubleLine', 'Arc', 'DashArc', 'ArrowArc', 'DashArrowArc', 'DoubleArc',
+  'CArc', 'DashCArc', 'ArrowArcn', 'DashArrowArcn', 'Photon', 'PhotonArc', 'PhotonArcn', 'DoublePhoton', 'DoublePhotonArc',
+  'Gluon', 'GluonArc', 'GluonArcn', 'GluonCirc', 'DoubleGluon', 'DoubleGluonArc', 'ZigZag', 'ZigZagArc', 'ZigZagArcn',
+  'Vertex', 'Oval', 'GOval', 'COval', 'Circle', 'ECirc', 'BCirc', 'GCirc', 'CCirc', 'EBox', 'BBox', 'GBox', 'CBox',
+  'Boxc', 'BBoxc', 'GBoxc', 'CBoxc', 'ETri', 'BTri', 'GTri', 'CTri', 'Polygon', 'FilledPolygon', 'Bezier', 'DashBezier',
+  'Curve', 'DashCurve', 'Text', 'rText', 'BText', 'GText', 'CText', 'PText', 'BoxText', 'B2Text', 'G2Text', 'C2Text',
+  'AxoGrid', 'LinAxis', 'LogAxis', 'SetColor', 'SetWidth', 'SetScale', 'SetOffset', 'SetScaledOffset', 'SetPFont',
+  'SetLineSep', 'SetArrowScale', 'SetArrowInset', 'SetArrowAspect', 'SetArrowPosition', 'SetArrowStroke', 'SetDashSize',
+  'put', 'pdfliteral',
+}
+axodraw_options = {
+  'arrow', 'noarrow', 'arrowpos', 'arrowlength', 'arrowwidth', 'arrowinset', 'arrowaspect', 'arrowscale', 'arrowstroke',
+  'flip', 'clockwise', 'dash', 'dashsize', 'dsize', 'double', 'sep', 'color', 'colour', 'linewidth', 'width',
+}
+latex_macros = {
+  'tiny', 'scriptsize', 'footnotesize', 'small', 'normalsize', 'large', 'Large', 'LARGE', 'huge', 'Huge',
+  'rm', 'it', 'bf', 'sf', 'tt', 'sl', 'sc', 'em', 'textrm', 'textit', 'textbf', 'textsf', 'texttt', 'textsl', 'textsc',
+  'textnormal', 'emph', 'textsuperscript', 'mathrm', 'mathit', 'mathbf', 'mathsf', 'mathtt', 'mathcal', 'mathnormal',
+  'displaystyle', 'textstyle', 'scriptstyle', 'scriptscriptstyle', 'mbox', 'hbox', 'makebox', 'raisebox', 'shortstack',
+  'rule', 'kern', 'hspace', 'vspace', 'quad', 'qquad', 'phantom', 'hphantom', 'vphantom', 'smash', 'color', 'textcolor',
+  'ensuremath', 'overline', 'underline', 'bar', 'hat', 'tilde', 'widetilde', 'widehat', 'vec', 'dot', 'ddot', 'prime',
+  'frac', 'sqrt', 'left', 'right', 'big', 'Big', 'bigg', 'Bigg', 'stackrel', 'not', 'to', 'rightarrow', 'leftarrow',
+  'leftrightarrow', 'Rightarrow', 'Leftarrow', 'longrightarrow', 'uparrow', 'downarrow', 'gets', 'mapsto',
+  'pm', 'mp', 'times', 'cdot', 'ast', 'star', 'circ', 'bullet', 'dots', 'ldots', 'cdots', 'sim', 'simeq', 'approx',
+  'neq', 'ne', 'leq', 'le', 'geq', 'ge', 'll', 'gg', 'in', 'ell', 'hbar', 'infty', 'partial', 'nabla',
+  'sin', 'cos', 'tan', 'log', 'ln', 'exp', 'min', 'max', 'det',
+  'alpha', 'beta', 'gamma', 'delta', 'epsilon', 'varepsilon', 'zeta', 'eta', 'theta', 'vartheta', 'iota', 'kappa',
+  'lambda', 'mu', 'nu', 'xi', 'pi', 'varpi', 'rho', 'varrho', 'sigma', 'varsigma', 'tau', 'upsilon', 'phi', 'varphi',
+  'chi', 'psi', 'omega', 'Gamma', 'Delta', 'Theta', 'Lambda', 'Xi', 'Pi', 'Sigma', 'Upsilon', 'Phi', 'Psi', 'Omega',
+}
+# macros of the packages lhcb-symbols-def.tex loads
+package_macros = {
+  'xspace' : { 'xspace' },
+  'upgreek': { 'up'+g for g in ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'varepsilon', 'zeta', 'eta', 'theta', 'vartheta',
+                                'iota', 'kappa', 'lambda', 'mu', 'nu', 'xi', 'pi', 'varpi', 'rho', 'varrho', 'sigma', 'varsigma',
+                                'tau', 'upsilon', 'phi', 'varphi', 'chi', 'psi', 'omega') } |
+             { 'Up'+g for g in ('gamma', 'delta', 'theta', 'lambda', 'xi', 'pi', 'sigma', 'upsilon', 'phi', 'psi', 'omega') },
+}
+
+_macro_indexes = {}
+
+def macro_index(path='lhcb-symbols-def.tex'):
+  """
+  Return the set of macros defined by lhcb-symbols-def.tex (and the packages it loads). The index is
+  kept next to the compile cache, keyed on the contents of the file, so it is only built once
+  """
+  if not os.path.exists(path):
+    raise FileNotFoundError(f'Cannot find {path} file and option wrap_lhcb is set to True')
+  stat = os.stat(path)
+  key = ( os.path.abspath(path), stat.st_mtime, stat.st_size )
+  if key in _macro_indexes: return _macro_indexes[key]
+
+  with open(path,'rb') as f:
+    h = hashlib.sha256( f.read() ).hexdigest()[:16]
+  index = os.path.join(default_cache.path, 'macros', h+'.json')
+  try:
+    with open(index) as f:
+      names = json.load(f)
+  except (OSError, ValueError):
+    table = macro_table(path)
+    names = sorted(table.defined)
+    for line in table.packages:
+      for package in re.findall(r'\{([^}]*)\}', line)[0].split(','):
+        names += sorted( package_macros.get(package.strip(), ()) )
+    os.makedirs(os.path.dirname(index), exist_ok=True)
+    # a temporary file of its own, as other threads and processes may be writing the same index
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(index), suffix='.tmp')
+    with os.fdopen(fd,'w') as f:
+      json.dump(names, f)
+    os.replace(tmp, index)
+
+  _macro_indexes[key] = frozenset(names)
+  return _macro_indexes[key]
+
+_tex_defined = {}
+
+def tex_defined(names, wrap_lhcb=True, timeout=60):
+  """
+  Ask TeX which of some macros are defined after the usual preamble (see tex_preamble), running pdflatex
+  once with \\ifdefined on each name. The answers are kept next to the macro index, keyed on the preamble,
+  lhcb-symbols-def.tex and the pdflatex version, so each name is only asked about once
+  names     : the macro names (without the backslash)
+  wrap_lhcb : load lhcb-symbols-def.tex
+  timeout   : maximum time in seconds for pdflatex
+  Returns a dict of name -> True if defined, or None if pdflatex could not answer (e.g. it is not installed)
+  """
+  preamble = '\n'.join( tex_preamble(True, wrap_lhcb) )
+  h = hashlib.sha256( (preamble + toolchain_version()).encode() )
+  if wrap_lhcb:
+    with open('lhcb-symbols-def.tex','rb') as f:
+      h.update( f.read() )
+  path = os.path.join(default_cache.path, 'macros', 'defined-'+h.hexdigest()[:16]+'.json')
+  if path not in _tex_defined:
+    try:
+      with open(path) as f:
+        _tex_defined[path] = json.load(f)
+    except (OSError, ValueError):
+      _tex_defined[path] = {}
+  answers = _tex_defined[path]
+  ask = sorted( set(names) - set(answers) )
+  if ask:
+    with tempfile.TemporaryDirectory(prefix='feyn-') as tmp:
+      if wrap_lhcb: shutil.copy('lhcb-symbols-def.tex', tmp)
+      with open(os.path.join(tmp, 'feyn.tex'),'w') as f:
+        f.write( preamble + '\n' )
+        # names may hold @ (see used_macros)
+        f.write( r'\makeatletter' + '\n' )
+        for name in ask:
+          f.write( f'\\typeout{{feyn-defined:{name}:\\ifdefined\\{name} 1\\else 0\\fi}}\n' )
+        f.write( r'\makeatother' + '\n' )
+        f.write( r'\begin{document}' + '\n' + r'\end{document}' + '\n' )
+      try:
+        out = subprocess.run(['pdflatex', '-interaction=nonstopmode', 'feyn'], cwd=tmp, stdin=subprocess.DEVNULL,
+                             capture_output=True, text=True, timeout=timeout)
+      except (OSError, subprocess.TimeoutExpired):
+        return None
+    found = dict( re.findall(r'^feyn-defined:([A-Za-z@]+):([01])$', out.stdout, re.M) )
+    if set(found) != set(ask): return None
+    answers.update( (name, found[name] == '1') for name in ask )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd,'w') as f:
+      json.dump(answers, f)
+    os.replace(tmp, path)
+  return { name: answers[name] for name in names }
+
+def check_label(text, known):
+  """
+  Return the problems with the TeX of a label: undefined macros, unbalanced braces or $
+  text  : the label
+  known : the macros which are defined
+  """
+  ret = []
+  # the same names as used_macros, so internal macros holding @ are checked too
+  unknown = sorted( set( re.findall(r'\\([A-Za-z@]+)', text) ) - known )
+  if unknown:
+    ret.append( 'undefined ' + ', '.join( '\\'+name for name in unknown ) )
+  depth = 0
+  for brace in re.findall(r'(?<!\\)[{}]', text):
+    depth += 1 if brace == '{' else -1
+    if depth < 0: break
+  if depth != 0:
+    ret.append( 'unbalanced braces' )
+  if len( re.findall(r'(?<!\\)\$', text) ) % 2:
+    ret.append( 'unbalanced $' )
+  return ret
+
+def check_element(obj, known):
+  """
+  Return the problems with an element of a diagram (see check_label), including
+  unknown axodraw commands and options and bad alignments of labels
+  obj   : the element (or a line of axodraw code)
+  known : the macros which are defined
+  """
+  if isinstance(obj, Text):
+    ret = check_label(obj.text, known)
+    if obj.align is not None and not re.fullmatch(r'\[?[lrtbc]*\]?', obj.align):
+      ret.append( f'bad alignment {obj.align}' )
+    return ret
+  if isinstance(obj, (Line, Arc)):
+    unknown = [ opt for opt in obj.opts if opt.split('=')[0].strip() not in axodraw_options ]
+    return [ f'unknown option {opt}' for opt in unknown ]
+  if not isinstance(obj, str) or obj.lstrip().startswith('%') or not obj.strip():
+    return []
+  ret = []
+  m = re.match(r'\s*\\([A-Za-z]+)', obj)
+  if m is None or m.group(1) not in axodraw_commands:
+    ret.append( f'unknown axodraw command {m.group(0).strip() if m else obj.strip()}' )
+  # the \pdfliteral of an inline path holds drawing operators rather than TeX
+  if not obj.lstrip().startswith(r'\put(0,0){\pdfliteral'):
+    ret += check_label( re.sub(r'^\s*\\[A-Za-z]+', '', obj), known | axodraw_commands )
+  return ret
+
+def check_diagrams(diagrams):
+  """
+  Check the labels and axodraw code of the diagrams which will be compiled (backend='tex',
+  make_pdf=True and validate=True) raising a ValueError listing every problem found (see feyn.check)
+  """
+  checked = [ d for d in diagrams if d.validate and d.backend=='tex' and d.make_pdf ]
+  # the macros of lhcb-symbols-def are needed to check the labels (see macro_index)
+  if any( d.wrap_lhcb for d in checked ) and not os.path.exists('lhcb-symbols-def.tex'):
+    raise FileNotFoundError('Cannot find lhcb-symbols-def.tex file and option wrap_lhcb is set to True')
+  problems = [ problem for d in checked for problem in d.check() ]
+  if problems:
+    shown = problems[:20] + ( [ f'... and {len(problems)-20} more' ] if len(problems) > 20 else [] )
+    raise ValueError( f'{len(problems)} problems in the diagrams:\n  ' + '\n  '.join(shown) )
+
+# timing of each stage of rendering a diagram: every stage (writing the .tex, each TeX pass, copying files,
+# cache lookups, rasterizing, ...) makes a timing_record which is passed to each function in timing_callbacks
+timing_record = collections.namedtuple('timing_record', ['name', 'stage', 'duration', 'cache'])
+timing_callbacks = []
+
+def on_timing(callback):
+  """
+  Call callback with every timing_record (name of the diagram, stage, duration in seconds
+  and cache status: 'hit', 'miss' or None) until remove_timing(callback) is called
+  """
+  timing_callbacks.append(callback)
+  return callback
+
+def remove_timing(callback):
+  timing_callbacks.remove(callback)
+
+def _record(record):
+  for callback in list(timing_callbacks):
+    callback(record)
+
+def _timed(name, stage, start, cache=None):
+  # record a stage which started at time.perf_counter() start
+  if timing_callbacks:
+    _record( timing_record(name, stage, time.perf_counter()-start, cache) )
+
+@contextlib.contextmanager
+def profile():
+  """
+  Collect the timing records of everything run inside the with block, e.g.
+    with profile() as records:
+      render_all(diagrams)
+    print(timing_summary(records))
+  """
+  records = []
+  on_timing(records.append)
+  try:
+    yield records
+  finally:
+    remove_timing(records.append)
+
+@contextlib.contextmanager
+def _collect():
+  # collect the records of a compile in a worker process, which the parent passes on to its own callbacks
+  saved = timing_callbacks[:]
+  records = []
+  timing_callbacks[:] = [ records.append ]
+  try:
+    yield records
+  finally:
+    timing_callbacks[:] = saved
+
+def timing_jsonl(path):
+  """
+  Return a timing callback which appends each record to path as a line of JSON
+  """
+  lock = threading.Lock()
+  def callback(record):
+    with lock, open(path,'a') as f:
+      f.write( json.dumps(record._asdict()) + '\n' )
+  return callback
+
+def _stage_totals(records):
+  totals = {}
+  for r in records:
+    t = totals.setdefault(r.stage, { 'runs': 0, 'total': 0., 'max': 0., 'hit': 0, 'miss': 0 })
+    t['runs'] += 1
+    t['total'] += r.duration
+    t['max'] = max(t['max'], r.duration)
+    if r.cache: t[r.cache] += 1
+  return totals
+
+def timing_prometheus(records):
+  """
+  Return the time spent in and the number of runs of each stage in the Prometheus text format
+  """
+  totals = _stage_totals(records)
+  ret = [ '# HELP feyn_stage_seconds_total Time spent in each stage of rendering diagrams',
+          '# TYPE feyn_stage_seconds_total counter' ]
+  ret += [ f'feyn_stage_seconds_total{{stage="{stage}"}} {t["total"]:.6f}' for stage, t in totals.items() ]
+  ret += [ '# HELP feyn_stage_runs_total Number of runs of each stage of rendering diagrams',
+           '# TYPE feyn_stage_runs_total counter' ]
+  for stage, t in totals.items():
+    for cache in ('hit', 'miss'):
+      if t[cache]: ret.append( f'feyn_stage_runs_total{{stage="{stage}",cache="{cache}"}} {t[cache]}' )
+    if t['runs'] > t['hit'] + t['miss']:
+      ret.append( f'feyn_stage_runs_total{{stage="{stage}"}} {t["runs"]-t["hit"]-t["miss"]}' )
+  return '\n'.join(ret) + '\n'
+
+def timing_summary(records):
+  """
+  Return a table of the number of runs, total, mean and longest time (and cache hits and misses) of each stage
+  """
+  totals = _stage_totals(records)
+  ret = [ '{:<12} {:>6} {:>9} {:>9} {:>9} {:>6} {:>6}'.format('stage', 'runs', 'total/s', 'mean/s', 'max/s', 'hits', 'misses') ]
+  for stage, t in sorted( totals.items(), key=lambda item: -item[1]['total'] ):
+    ret.append( '{:<12} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>6} {:>6}'.format(
+                stage, t['runs'], t['total'], t['total']/t['runs'], t['max'], t['hit'], t['miss']) )
+  return '\n'.join(ret)
+
+@functools.lru_cache()
+def toolchain_version():
+  """
+  Return the version strings of pdflatex and axohelp (used in the compile cache key)
+  """
+  ret = []
+  for cmd in (['pdflatex', '--version'], ['axohelp', '-v']):
+    try:
+      out = subprocess.run(cmd, capture_output=True, text=True)
+      ret.append( (out.stdout or out.stderr).strip().split('\n')[0] )
+    except FileNotFoundError:
+      ret.append( f'{cmd[0]} not found' )
+  return '; '.join(ret)
+
+class compile_cache:
+  def __init__(self, path=None, max_size=256*1024*1024):
+    """
+    On disk cache of compiled .pdf files keyed on the hash of the generated .tex,
+    the lhcb-symbols-def.tex it uses and the version of the TeX toolchain
+    path     : cache directory (default: $FEYN_CACHE or ~/.cache/feyn)
+    max_size : maximum size of the cache in bytes, the least recently used
+               files are removed beyond this
+    """
+    if path is None:
+      path = os.environ.get('FEYN_CACHE', os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'feyn'))
+    self.path = path
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, fname, wrap_lhcb=True):
+    """
+    Return the cache key for fname.tex
+    """
+    h = hashlib.sha256()
+    with open(fname+'.tex','rb') as f:
+      h.update( f.read() )
+    h.update( b'\0' )
+    if wrap_lhcb:
+      with open('lhcb-symbols-def.tex','rb') as f:
+        h.update( f.read() )
+    h.update( b'\0' )
+    h.update( toolchain_version().encode() )
+    return h.hexdigest()
+
+  def entry(self, key):
+    return os.path.join(self.path, key+'.pdf')
+
+  def get(self, key, pdf):
+    """
+    Copy the cached file for key to pdf, returns True if it was found
+    """
+    entry = self.entry(key)
+    try:
+      shutil.copy(entry, pdf)
+      # mark as recently used
+      os.utime(entry)
+    except FileNotFoundError:
+      # not there, or evicted by another process since
+      self.misses += 1
+      return False
+    self.hits += 1
+    return True
+
+  def put(self, key, pdf):
+    """
+    Store pdf in the cache under key
+    """
+    os.makedirs(self.path, exist_ok=True)
+    # a temporary file of its own, as other threads and processes may be storing the same key
+    fd, tmp = tempfile.mkstemp(dir=self.path, prefix=key+'.', suffix='.tmp')
+    os.close(fd)
+    try:
+      shutil.copy(pdf, tmp)
+      os.replace(tmp, self.entry(key))
+    except BaseException:
+      os.remove(tmp)
+      raise
+    self.evict()
+
+  def entries(self):
+    if not os.path.isdir(self.path): return []
+    ret = []
+    for f in os.listdir(self.path):
+      if f.endswith('.pdf'):
+        try:
+          st = os.stat(os.path.join(self.path, f))
+        except FileNotFoundError:
+          # removed by another process since listing the directory
+          continue
+        ret.append( (st.st_mtime, st.st_size, os.path.join(self.path, f)) )
+    return sorted(ret)
+
+  def evict(self):
+    """
+    Remove the least recently used files until the cache is below max_size
+    """
+    entries = self.entries()
+    size = sum( e[1] for e in entries )
+    for mtime, esize, path in entries:
+      if size <= self.max_size: break
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+      size -= esize
+
+  def clear(self):
+    for mtime, size, path in self.entries():
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+  def stats(self):
+    """
+    Return a dict with the number of hits and misses (in this session) and the entries and size on disk
+    """
+    entries = self.entries()
+    return { 'hits': self.hits, 'misses': self.misses, 'entries': len(entries), 'size': sum( e[1] for e in entries ) }
+
+default_cache = compile_cache()
+
+def _cache(cache):
+  if cache is True: return default_cache
+  return cache or None
+
+_formats = {}
+
+def tex_format(wrap_lhcb=True, multi=False, prune=False, timeout=120):
+  """
+  Return the path of a precompiled format (.fmt) holding the document preamble,
+  building it first if needed (using the mylatexformat package). Formats are kept
+  next to the compile cache and are keyed on the preamble, lhcb-symbols-def.tex and
+  the TeX toolchain, so they are rebuilt whenever one of those changes.
+  Returns None if the format can not be built (compiles then read the preamble as normal), which
+  is remembered so this process does not try again, nor do others if pdflatex ran but made no format
+  (a name.failed file next to the formats, remove it to try again)
+  wrap_lhcb : include lhcb-symbols-def
+  multi     : preamble of a multi-page document (used by compile_batch)
+  prune     : preamble of a diagram with prune_lhcb=True (without lhcb-symbols-def itself)
+  timeout   : maximum time in seconds for building the format
+  """
+  preamble = '\n'.join( tex_preamble(wrap_doc=True, wrap_lhcb=wrap_lhcb, multi=multi, prune=prune) ) + '\n'
+  h = hashlib.sha256( preamble.encode() )
+  wrap_lhcb = wrap_lhcb and not prune
+  if wrap_lhcb:
+    with open('lhcb-symbols-def.tex','rb') as f:
+      h.update( f.read() )
+  h.update( toolchain_version().encode() )
+  name = 'feyn-' + h.hexdigest()[:16]
+
+  if name in _formats: return _formats[name]
+
+  path = os.path.join(default_cache.path, 'formats', name+'.fmt')
+  # a preamble which pdflatex could not make a format of (with this toolchain) is not tried again
+  failed = path[:-len('.fmt')]+'.failed'
+  if not os.path.exists(path) and not os.path.exists(failed):
+    print(f'Building preamble format {name}')
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='feyn-') as tmp:
+      with open(os.path.join(tmp, 'preamble.tex'),'w') as f:
+        f.write( preamble + r'\begin{document}' + '\n' + r'\end{document}' + '\n' )
+      if wrap_lhcb:
+        shutil.copy('lhcb-symbols-def.tex', tmp)
+      try:
+        subprocess.run(['pdflatex', '-ini', '-interaction=batchmode', f'-jobname={name}', '&pdflatex', 'mylatexformat.ltx', 'preamble.tex'],
+                       cwd=tmp, stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+        ran = True
+      except (OSError, subprocess.TimeoutExpired):
+        # no pdflatex (or it hangs), which the compiles will report
+        ran = False
+      if os.path.exists(os.path.join(tmp, name+'.fmt')):
+        os.replace(os.path.join(tmp, name+'.fmt'), path)
+      elif ran:
+        open(failed,'w').close()
+    _timed(name, 'format', start)
+
+  _formats[name] = path if os.path.exists(path) else None
+  return _formats[name]
+
+class TexError(RuntimeError):
+  def __init__(self, fname, step, message, line=None, source=None, comment=None, log=''):
+    """
+    A failed compile
+    fname   : the .tex file (without extension)
+    step    : the pass which failed (pdflatex or axohelp)
+    message : the error message
+    line    : line number of the error in fname.tex (if known)
+    source  : the offending line of fname.tex (if known)
+    comment : the comment on that line which says which element it is (if known)
+    log     : the full log of the failed pass
+    """
+    self.fname = fname
+    self.step = step
+    self.message = message
+    self.line = line
+    self.source = source
+    self.comment = comment
+    self.log = log
+    msg = f'{step} failed on {fname}.tex'
+    if line is not None: msg += f':{line}'
+    msg += f': {message}'
+    if source is not None: msg += f'\n  {source.strip()}'
+    super().__init__(msg)
+
+  def __reduce__(self):
+    # rebuild from every field, so the error survives coming back from a compile_pool process
+    return (TexError, (self.fname, self.step, self.message, self.line, self.source, self.comment, self.log))
+
+# axopicture commands which are drawn without axohelp
+simple_commands = { 'Line', 'Vertex', 'GOval', 'Text', 'AxoGrid', 'put' }
+
+def plan_passes(lines, axohelp=True):
+  """
+  Return the passes needed to compile a diagram, which is ['pdflatex'] unless
+  one of its elements needs axohelp and a second pdflatex pass
+  lines   : the elements of the diagram (feyn.lines) or lines of an axopicture
+  axohelp : whether the elements are drawn with axohelp (see feyn)
+  """
+  for line in lines:
+    obj = line[0] if isinstance(line, (list,tuple)) else line
+    if not isinstance(obj, str):
+      if obj.needs_axohelp(axohelp): return ['pdflatex', 'axohelp', 'pdflatex']
+      continue
+    m = re.match(r'\s*\\([A-Za-z]+)', obj)
+    if m and m.group(1) not in simple_commands:
+      return ['pdflatex', 'axohelp', 'pdflatex']
+  return ['pdflatex']
+
+def picture_lines(tex):
+  """
+  Return the lines inside the axopicture environments of a .tex file
+  """
+  ret = []
+  inside = False
+  for line in tex.split('\n'):
+    if line.startswith(r'\begin{axopicture}'): inside = True
+    elif line.startswith(r'\end{axopicture}'): inside = False
+    elif inside: ret.append(line)
+  return ret
+
+def parse_tex_error(fname, step, log):
+  """
+  Make a TexError from the log of a failed pass, finding the offending line of fname.tex
+  """
+  message = 'unknown error'
+  line = None
+  m = re.search(r'^(?:\./)?feyn\.tex:(\d+): (.*)$', log, re.M)
+  if m:
+    line, message = int(m.group(1)), m.group(2)
+  else:
+    m = re.search(r'^! (.*)$', log, re.M)
+    if m:
+      message = m.group(1)
+      l = re.search(r'^l\.(\d+) ', log[m.end():], re.M)
+      if l: line = int(l.group(1))
+    elif log.strip():
+      message = log.strip().split('\n')[-1]
+
+  source = comment = None
+  if line is not None and os.path.exists(fname+'.tex'):
+    with open(fname+'.tex') as f:
+      lines = f.read().split('\n')
+    if line <= len(lines):
+      source = lines[line-1]
+      # the element comment follows the first unescaped %
+      c = re.search(r'(?<!\\)%(.*)$', source)
+      if c: comment = c.group(1).strip()
+      # in a batch find which diagram the line belongs to
+      for prev in reversed(lines[:line]):
+        if prev.startswith('% diagram: '):
+          comment = prev[len('% diagram: '):] + (f': {comment}' if comment else '')
+          break
+
+  return TexError(fname, step, message, line, source, comment, log)
+
+def run_tex(fname, wrap_lhcb=True, fmt=None, passes=None, timeout=120):
+  """
+  Run the passes (by default pdflatex; axohelp; pdflatex) on fname.tex and put fname.pdf next to it.
+  The compile happens in a private temporary directory (and never changes the
+  working directory) so it is safe to call from several threads or processes at once.
+  Every pass runs non-interactively and a TexError is raised if one fails or times out
+  fname     : name of the .tex file (without extension)
+  wrap_lhcb : the file needs lhcb-symbols-def.tex (which must be in current working dir)
+  fmt       : precompiled format of the preamble to use (see tex_format)
+  passes    : the passes to run (default: None works them out from the file with plan_passes)
+  timeout   : maximum time in seconds for each pass
+  """
+  passes, commands, env = _tex_commands(fname, fmt, passes)
+
+  with tempfile.TemporaryDirectory(prefix='feyn-') as tmp:
+    _tex_setup(fname, wrap_lhcb, tmp)
+
+    for step, cmd, stage in zip(passes, commands, _stages(passes)):
+      start = time.perf_counter()
+      try:
+        out = subprocess.run(cmd, cwd=tmp, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=timeout)
+      except subprocess.TimeoutExpired:
+        raise TexError(fname, step, f'timed out after {timeout}s')
+      _timed(fname, stage, start)
+      if out.returncode != 0:
+        raise _pass_error(fname, step, tmp, out.stdout + out.stderr)
+
+    start = time.perf_counter()
+    shutil.copy(os.path.join(tmp, 'feyn.pdf'), fname+'.pdf')
+    _timed(fname, 'copy', start)
+
+  return fname+'.pdf'
+
+def _stages(passes):
+  # names of the passes for the timing records, e.g. pdflatex-1, axohelp, pdflatex-2
+  n = 0
+  for step in passes:
+    if step == 'pdflatex': n += 1
+    yield f'pdflatex-{n}' if step == 'pdflatex' else step
+
+def _tex_commands(fname, fmt=None, passes=None):
+  """
+  Return the passes to compile fname.tex, the command for each and the environment to run them in
+  """
+  if passes is None:
+    with open(fname+'.tex') as f:
+      passes = plan_passes( picture_lines(f.read()) )
+
+  pdflatex = ['pdflatex', '-interaction=nonstopmode', '-halt-on-error', '-file-line-error']
+  env = None
+  if fmt:
+    # the preamble in the file is skipped up to \begin{document} when run with the format
+    pdflatex.append( '-fmt='+os.path.basename(fmt)[:-len('.fmt')] )
+    env = dict(os.environ, TEXFORMATS=os.path.dirname(fmt)+os.pathsep)
+  commands = [ pdflatex+['feyn'] if step=='pdflatex' else [step, 'feyn'] for step in passes ]
+  return passes, commands, env
+
+def _tex_setup(fname, wrap_lhcb, tmp):
+  # each compile has its own directory so diagrams with
+  # the same basename in different directories can't clash
+  start = time.perf_counter()
+  shutil.copy(fname+'.tex', os.path.join(tmp, 'feyn.tex'))
+  if wrap_lhcb:
+    shutil.copy('lhcb-symbols-def.tex', tmp)
+  _timed(fname, 'copy', start)
+
+def _pass_error(fname, step, tmp, log):
+  if step=='pdflatex' and os.path.exists(os.path.join(tmp, 'feyn.log')):
+    with open(os.path.join(tmp, 'feyn.log'), errors='replace') as f:
+      log = f.read()
+  return parse_tex_error(fname, step, log)
+
+async def run_tex_async(fname, wrap_lhcb=True, fmt=None, passes=None, timeout=120):
+  """
+  The same as run_tex, but runs the passes as asyncio subprocesses so the event loop carries on meanwhile.
+  If the task is cancelled the running pass is killed and the temporary directory removed
+  """
+  passes, commands, env = _tex_commands(fname, fmt, passes)
+
+  with tempfile.TemporaryDirectory(prefix='feyn-') as tmp:
+    _tex_setup(fname, wrap_lhcb, tmp)
+
+    for step, cmd, stage in zip(passes, commands, _stages(passes)):
+      start = time.perf_counter()
+      proc = await asyncio.create_subprocess_exec(*cmd, cwd=tmp, env=env, stdin=subprocess.DEVNULL,
+                                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout)
+      except asyncio.TimeoutError:
+        raise TexError(fname, step, f'timed out after {timeout}s')
+      finally:
+        # on a timeout or cancellation
+        if proc.returncode is None:
+          proc.kill()
+          await proc.wait()
+      _timed(fname, stage, start)
+      if proc.returncode != 0:
+        raise _pass_error(fname, step, tmp, out.decode(errors='replace') + err.decode(errors='replace'))
+
+    shutil.copy(os.path.join(tmp, 'feyn.pdf'), fname+'.pdf')
+
+  return fname+'.pdf'
+
+def compile_tex(fname, wrap_lhcb=True, cache=True, fmt=None, passes=None, worker=None):
+  """
+  Compile fname.tex into fname.pdf, unless an identical file has been compiled before
+  fname     : name of the .tex file (without extension)
+  wrap_lhcb : the file needs lhcb-symbols-def.tex (which must be in current working dir)
+  cache     : compile_cache to use (default: True uses default_cache, False does not cache)
+  fmt       : precompiled format of the preamble to use (see tex_format), or a function returning it
+              which is only called if the file is not in the cache
+  passes    : the passes to run (default: None works them out from the file with plan_passes)
+  worker    : tex_worker to compile with (default: None runs the passes with run_tex), or a function
+              returning it, as for fmt
+  """
+  cache = _cache(cache)
+  if cache:
+    key = _cache_get(cache, fname, wrap_lhcb)
+    if key is None: return fname+'.pdf'
+
+  if callable(fmt): fmt = fmt()
+  if callable(worker): worker = worker()
+  if worker is not None and fmt is not None:
+    worker.compile(fname, passes)
+  else:
+    run_tex(fname, wrap_lhcb, fmt, passes)
+
+  if cache:
+    cache.put(key, fname+'.pdf')
+  return fname+'.pdf'
+
+class tex_worker:
+  """
+  Keeps pdflatex processes started in the background with the preamble format loaded, each waiting
+  (before the document begins) for a signal on its stdin to typeset a diagram. Compiling a diagram then
+  only costs typesetting its picture and writing the pdf, rather than starting TeX and loading the
+  preamble, which makes regenerating one diagram at a time (e.g. from a notebook) much quicker.
+  Each waiting process makes one pdf, and a new one is started whenever one is used.
+  wrap_lhcb : the diagrams need lhcb-symbols-def.tex (which must be in current working dir)
+  standby   : number of processes to keep waiting (a diagram which needs axohelp uses two)
+  timeout   : maximum time in seconds for each pass
+  prune     : the diagrams have prune_lhcb=True
+  """
+  # typesets feyn.tex, which holds the body of the document, once a line arrives on stdin
+  driver = '\n'.join([ r'\read16 to \feynrequest', r'\begin{document}', r'\input{feyn}', r'\end{document}', '' ])
+
+  def __init__(self, wrap_lhcb=True, standby=2, timeout=120, prune=False):
+    self.wrap_lhcb = wrap_lhcb
+    self.prune = prune
+    self.standby = standby
+    self.timeout = timeout
+    self.fmt = None
+    self.waiting = []
+    self.lock = threading.Lock()
+
+  def _start(self):
+    tmp = tempfile.mkdtemp(prefix='feyn-')
+    with open(os.path.join(tmp, 'feyn-driver.tex'),'w') as f:
+      f.write( self.driver )
+    # scrollmode, as pdflatex can't read from the terminal in nonstop mode
+    cmd = [ 'pdflatex', '-interaction=scrollmode', '-halt-on-error', '-file-line-error',
+            '-fmt='+os.path.basename(self.fmt)[:-len('.fmt')], '-jobname=feyn', 'feyn-driver' ]
+    env = dict(os.environ, TEXFORMATS=os.path.dirname(self.fmt)+os.pathsep)
+    proc = subprocess.Popen(cmd, cwd=tmp, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+    return proc, tmp
+
+  def _take(self):
+    """
+    Return a waiting process (and its directory), starting another in its place
+    """
+    with self.lock:
+      fmt = tex_format(self.wrap_lhcb, prune=self.prune)
+      if fmt is None:
+        raise RuntimeError('tex_worker needs the precompiled preamble format, which could not be built')
+      if fmt != self.fmt:
+        # the preamble or lhcb-symbols-def.tex has changed
+        self._stop()
+        self.fmt = fmt
+      while len(self.waiting) < self.standby+1:
+        self.waiting.append( self._start() )
+      return self.waiting.pop(0)
+
+  def _run(self, fname, body, files=[], stage='pdflatex-1'):
+    proc, tmp = self._take()
+    start = time.perf_counter()
+    with open(os.path.join(tmp, 'feyn.tex'),'w') as f:
+      f.write( body )
+    for path in files:
+      shutil.copy(path, tmp)
+    _timed(fname, 'copy', start)
+    start = time.perf_counter()
+    try:
+      log, _ = proc.communicate('\n', timeout=self.timeout)
+    except subprocess.TimeoutExpired:
+      proc.kill()
+      proc.communicate()
+      shutil.rmtree(tmp, ignore_errors=True)
+      raise TexError(fname, 'pdflatex', f'timed out after {self.timeout}s')
+    _timed(fname, stage, start)
+    if proc.returncode != 0:
+      if os.path.exists(os.path.join(tmp, 'feyn.log')):
+        with open(os.path.join(tmp, 'feyn.log'), errors='replace') as f:
+          log = f.read()
+      shutil.rmtree(tmp, ignore_errors=True)
+      raise parse_tex_error(fname, 'pdflatex', log)
+    return tmp
+
+  def compile(self, fname, passes=None):
+    """
+    Compile fname.tex (a document with the usual preamble, see feyn.to_tex) into fname.pdf
+    passes : the passes to run (default: None works them out from the file with plan_passes)
+    """
+    with open(fname+'.tex') as f:
+      tex = f.read().split('\n')
+    if passes is None:
+      passes = plan_passes( picture_lines('\n'.join(tex)) )
+    # keep the lines of the body where they are in fname.tex, so errors point at the right line
+    start = next( i for i, line in enumerate(tex) if line.startswith(r'\begin{document}') )
+    end = max( i for i, line in enumerate(tex) if line.startswith(r'\end{document}') )
+    body = '\n'.join( ['%']*(start+1) + tex[start+1:end] ) + '\n'
+
+    tmp = self._run(fname, body)
+    if 'axohelp' in passes:
+      start = time.perf_counter()
+      try:
+        out = subprocess.run(['axohelp', 'feyn'], cwd=tmp, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=self.timeout)
+      except subprocess.TimeoutExpired:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise TexError(fname, 'axohelp', f'timed out after {self.timeout}s')
+      _timed(fname, 'axohelp', start)
+      if out.returncode != 0:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise parse_tex_error(fname, 'axohelp', out.stdout + out.stderr)
+      # the second pass reads the shapes worked out by axohelp when the document begins
+      first, tmp = tmp, self._run(fname, body, [ os.path.join(tmp, 'feyn.ax2') ], 'pdflatex-2')
+      shutil.rmtree(first, ignore_errors=True)
+
+    start = time.perf_counter()
+    shutil.copy(os.path.join(tmp, 'feyn.pdf'), fname+'.pdf')
+    shutil.rmtree(tmp, ignore_errors=True)
+    _timed(fname, 'copy', start)
+    return fname+'.pdf'
+
+  def _stop(self):
+    for proc, tmp in self.waiting:
+      proc.kill()
+      proc.communicate()
+      shutil.rmtree(tmp, ignore_errors=True)
+    self.waiting = []
+
+  def close(self):
+    """
+    Stop the waiting processes
+    """
+    with self.lock:
+      self._stop()
+
+_workers = {}
+
+def default_worker(wrap_lhcb=True, prune=False):
+  """
+  Return the tex_worker shared by diagrams made with worker=True
+  """
+  key = (wrap_lhcb, prune)
+  if key not in _workers:
+    _workers[key] = tex_worker(wrap_lhcb, prune=prune)
+    atexit.register(_workers[key].close)
+  return _workers[key]
+
+async def compile_tex_async(fname, wrap_lhcb=True, cache=True, fmt=None, passes=None):
+  """
+  The same as compile_tex (fmt may also be a function), but compiles with run_tex_async
+  """
+  cache = _cache(cache)
+  if cache:
+    key = _cache_get(cache, fname, wrap_lhcb)
+    if key is None: return fname+'.pdf'
+
+  # building the format (once) blocks, so do it in a thread
+  if callable(fmt): fmt = await asyncio.to_thread(fmt)
+  await run_tex_async(fname, wrap_lhcb, fmt, passes)
+
+  if cache:
+    cache.put(key, fname+'.pdf')
+  return fname+'.pdf'
+
+def _compile_job(job):
+  fname, wrap_lhcb, fmt, passes = job
+  with _collect() as records:
+    run_tex(fname, wrap_lhcb, fmt, passes)
+  return records
+
+def _cache_get(cache, fname, wrap_lhcb):
+  """
+  Restore fname.pdf from the cache and return None, or return its cache key if it is not cached
+  """
+  start = time.perf_counter()
+  key = cache.key(fname, wrap_lhcb)
+  hit = cache.get(key, fname+'.pdf')
+  _timed(fname, 'cache', start, 'hit' if hit else 'miss')
+  return None if hit else key
+
+def _cache_lookup(diagrams, cache):
+  """
+  Restore the cached diagrams and return the others with their cache keys
+  """
+  if not cache: return [ (d, None) for d in diagrams ]
+  todo = []
+  for d in diagrams:
+    key = _cache_get(cache, d.fname, d.needs_lhcb())
+    if key is not None:
+      todo.append( (d, key) )
+  return todo
+
+def compile_pool(diagrams, workers=None, cache=True):
+  """
+  Compile many diagrams in parallel, each in its own temporary directory
+  diagrams : list of feyn objects
+  workers  : number of processes to use (default: None uses every core)
+  cache    : compile_cache to use (default: True uses default_cache, False does not cache)
+  """
+  diagrams = list(diagrams)
+  if _collected_instead(diagrams): return []
+  check_diagrams(diagrams)
+  for d in diagrams:
+    d.write_tex()
+  cache = _cache(cache)
+  todo = _cache_lookup(diagrams, cache)
+  if len(todo)==0: return [ d.fname+'.pdf' for d in diagrams ]
+
+  # build the formats up front rather than once in every worker
+  jobs = [ (os.path.abspath(d.fname), d.needs_lhcb(), d.format(), d.passes()) for d, key in todo ]
+  workers = workers or os.cpu_count()
+  print(f'Compiling {len(jobs)} tex files with {workers} workers')
+  with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+    for records in pool.map(_compile_job, jobs):
+      for record in records: _record(record)
+
+  if cache:
+    for d, key in todo:
+      cache.put(key, d.fname+'.pdf')
+
+  return [ d.fname+'.pdf' for d in diagrams ]
+
+def compile_batch(diagrams, fname=None, keep=False, cache=True):
+  """
+  Compile many diagrams with a single run of pdflatex (and axohelp if needed). The diagrams
+  are written as the pages of one multi-page standalone document which is then
+  split back into one .pdf per diagram (using pdfseparate from poppler-utils, without which
+  each diagram is compiled on its own)
+  diagrams : list of feyn objects
+  fname    : where to write the intermediate multi-page document (default: None uses a private
+             temporary directory, or feyn_batch with keep=True)
+  keep     : keep the multi-page .tex and .pdf (default: False removes them)
+  cache    : compile_cache to use (default: True uses default_cache, False does not cache)
+  """
+  diagrams = list(diagrams)
+  if _collected_instead(diagrams): return []
+  check_diagrams(diagrams)
+  for d in diagrams:
+    d.write_tex()
+  cache = _cache(cache)
+  todo = _cache_lookup(diagrams, cache)
+  if len(todo)==0: return [ d.fname+'.pdf' for d in diagrams ]
+
+  # the whole of lhcb-symbols-def is read if any diagram needs it, otherwise the
+  # macros used by the diagrams with prune_lhcb=True are defined once at the start
+  full = any( d.needs_lhcb() for d, key in todo )
+  prune = not full and any( d.wrap_lhcb for d, key in todo )
+  wrap_lhcb = full or prune
+  if full and not os.path.exists('lhcb-symbols-def.tex'):
+    raise FileNotFoundError('Cannot find lhcb-symbols-def.tex file and option wrap_lhcb is set to True')
+
+  if shutil.which('pdfseparate') is None:
+    print(f'Cannot find pdfseparate, compiling {len(todo)} tex files one by one')
+    for d, key in todo:
+      run_tex(d.fname, d.needs_lhcb(), d.format(), d.passes())
+      if cache:
+        cache.put(key, d.fname+'.pdf')
+    return [ d.fname+'.pdf' for d in diagrams ]
+
+  # a private directory unless the document is kept, so batches running at once do not share it
+  tmp = None
+  if fname is None and not keep:
+    tmp = tempfile.mkdtemp(prefix='feyn-batch-')
+    fname = os.path.join(tmp, 'feyn_batch')
+  fname = (fname or 'feyn_batch').replace('.tex','').replace('.pdf','')
+  try:
+    pictures = [ d.picture() for d, key in todo ]
+    print(f'Writing file, {fname}.tex ({len(todo)} pages)')
+    with open(fname+'.tex','w') as f:
+      for line in tex_preamble(wrap_doc=True, wrap_lhcb=wrap_lhcb, multi=True, prune=prune):
+        print(line, file=f)
+
+      print(r'\begin{document}', file=f)
+      if prune:
+        for line in lhcb_macros().definitions( used_macros(line for picture in pictures for line in picture) ):
+          print(line, file=f)
+      for (d, key), picture in zip(todo, pictures):
+        print(f'% diagram: {d.fname}', file=f)
+        for line in picture:
+          print(line, file=f)
+        print('', file=f)
+      print(r'\end{document}', file=f)
+
+    print(f'Compiling tex file into {len(todo)} pdfs')
+    fmt = tex_format(wrap_lhcb, multi=True, prune=prune) if all( d.fmt for d, key in todo ) else None
+    run_tex(fname, full, fmt, max( (d.passes() for d, key in todo), key=len ))
+
+    start = time.perf_counter()
+    subprocess.run(['pdfseparate', fname+'.pdf', fname+'-page%d.pdf'], check=True, capture_output=True)
+    for i, (d, key) in enumerate(todo):
+      os.replace(f'{fname}-page{i+1}.pdf', d.fname+'.pdf')
+      if cache:
+        cache.put(key, d.fname+'.pdf')
+    _timed(fname, 'split', start)
+  finally:
+    if tmp: shutil.rmtree(tmp, ignore_errors=True)
+
+  if not keep and not tmp:
+    for ext in ('.tex','.pdf'):
+      if os.path.exists(fname+ext): os.remove(fname+ext)
+
+  return [ d.fname+'.pdf' for d in diagrams ]
+
+def render_all(diagrams, workers=None, batch=False):
+  """
+  Write the .tex files of many diagrams and compile the ones with make_pdf=True
+  (diagrams with backend='svg' just write their .svg)
+  diagrams : list of feyn objects
+  workers  : number of processes to compile with (see compile_pool)
+  batch    : compile them all in one TeX run with compile_batch instead
+  """
+  diagrams = list(diagrams)
+  if _collected_instead(diagrams): return []
+  check_diagrams(diagrams)
+  for d in diagrams:
+    if d.backend == 'svg': d.write_svg()
+    elif not d.make_pdf: d.write_tex()
+  diagrams = [ d for d in diagrams if d.backend=='tex' and d.make_pdf ]
+  if batch:
+    return compile_batch(diagrams)
+  return compile_pool(diagrams, workers)
+
+async def render_all_async(diagrams, workers=None):
+  """
+  Render many diagrams concurrently with render_async. If one fails (or this is cancelled)
+  the others are cancelled too
+  diagrams : list of feyn objects
+  workers  : number of compiles to run at once (default: None uses the number of cores)
+  Returns the files written, as render_async
+  """
+  diagrams = list(diagrams)
+  await asyncio.to_thread(check_diagrams, diagrams)
+  limit = asyncio.Semaphore(workers or os.cpu_count())
+  tasks = [ asyncio.ensure_future(d.render_async(limit=limit)) for d in diagrams ]
+  try:
+    return await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks: task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+
+def _rasterize_job(job):
+  pdf, page, out, dpi, fmt, thumbnails = job
+  # optional dependency, only needed for rasterizing
+  from pdf2image import convert_from_path
+  start = time.perf_counter()
+  image = convert_from_path(pdf, dpi=dpi, first_page=page, last_page=page)[0]
+  image.save(f'{out}.{fmt}')
+  ret = [ f'{out}.{fmt}' ] + _thumbnails(image, out, fmt, thumbnails)
+  _timed(out, 'rasterize', start)
+  return ret
+
+def _thumbnails(image, out, fmt, thumbnails):
+  ret = []
+  for width, height in thumbnails:
+    thumb = image.copy()
+    thumb.thumbnail( (width, height) )
+    thumb.save(f'{out}_{width}x{height}.{fmt}')
+    ret.append( f'{out}_{width}x{height}.{fmt}' )
+  return ret
+
+def _thumbnail_job(job):
+  out, fmt, thumbnails = job
+  # optional dependency, only needed for thumbnails
+  from PIL import Image
+  with Image.open(f'{out}.{fmt}') as image:
+    return [ f'{out}.{fmt}' ] + _thumbnails(image, out, fmt, thumbnails)
+
+def _rasterize(jobs, workers):
+  if len(jobs)==0: return []
+  # pdftoppm does the work in a subprocess so threads are enough
+  with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+    return [ out for outs in pool.map(_rasterize_job, jobs) for out in outs ]
+
+def rasterize(pdfs, dpi=200, fmt='png', thumbnails=[], workers=None):
+  """
+  Convert the first page of each pdf into an image next to it (using pdf2image)
+  pdfs       : list of .pdf files
+  dpi        : resolution of the images
+  fmt        : image format (png, jpeg, ...)
+  thumbnails : list of (width, height) sizes, also write a thumbnail no bigger than
+               each size called name_WxH.fmt
+  workers    : number of threads (default: None uses every core)
+  Returns the list of images written
+  """
+  jobs = [ (pdf, 1, os.path.splitext(pdf)[0], dpi, fmt, thumbnails) for pdf in pdfs ]
+  return _rasterize(jobs, workers)
+
+# the image formats pdftoppm writes itself
+pdftoppm_formats = { 'png': '-png', 'jpeg': '-jpeg', 'jpg': '-jpeg', 'tiff': '-tiff' }
+
+def rasterize_batch(pdf, names, dpi=200, fmt='png', thumbnails=[], workers=None):
+  """
+  Convert each page of a multi-page pdf (e.g. from compile_batch with keep=True) into an image,
+  with a single run of pdftoppm (from poppler-utils) for the formats it writes (see pdftoppm_formats)
+  pdf   : the multi-page .pdf file
+  names : where to write the image of each page (without extension)
+  The other options are as for rasterize (the workers make the thumbnails)
+  """
+  outs = [ name.replace('.pdf','').replace('.'+fmt,'') for name in names ]
+  if fmt not in pdftoppm_formats:
+    return _rasterize([ (pdf, i+1, out, dpi, fmt, thumbnails) for i, out in enumerate(outs) ], workers)
+  if len(outs)==0: return []
+
+  start = time.perf_counter()
+  with tempfile.TemporaryDirectory(prefix='feyn-') as tmp:
+    subprocess.run(['pdftoppm', '-r', str(dpi), '-f', '1', '-l', str(len(outs)), pdftoppm_formats[fmt], pdf, os.path.join(tmp, 'page')],
+                   check=True, capture_output=True)
+    # the pages are numbered with the same number of digits, so they sort in order
+    pages = sorted(os.listdir(tmp))
+    if len(pages) != len(outs):
+      raise ValueError(f'{pdf} has {len(pages)} pages, expected {len(outs)}')
+    for page, out in zip(pages, outs):
+      shutil.move(os.path.join(tmp, page), f'{out}.{fmt}')
+  _timed(pdf, 'rasterize', start)
+
+  if not thumbnails: return [ f'{out}.{fmt}' for out in outs ]
+  with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+    return [ image for images in pool.map(_thumbnail_job, [ (out, fmt, thumbnails) for out in outs ]) for image in images ]
+
+def _file_hash(fname):
+  h = hashlib.sha256()
+  with open(fname,'rb') as f:
+    h.update( f.read() )
+  return h.hexdigest()
+
+def gallery(directory='.', readme='README.md', manifest='.gallery.json', dpi=200, workers=None):
+  """
+  Keep a directory of diagrams browsable: make a .png of every .pdf and list them in a README.
+  The hashes of each .tex / .pdf are kept in a small manifest so only new or changed
+  diagrams are rasterized, and the README is only rewritten when the list of diagrams changes
+  directory : the directory of diagrams
+  readme    : name of the index to write
+  manifest  : name of the manifest file
+  dpi       : resolution of the images
+  workers   : number of threads to rasterize with
+  Returns the list of images written
+  """
+  manifest = os.path.join(directory, manifest)
+  old = {}
+  if os.path.exists(manifest):
+    with open(manifest) as f:
+      old = json.load(f)
+
+  new = {}
+  todo = []
+  for pdf in sorted( f for f in os.listdir(directory) if f.endswith('.pdf') ):
+    name = pdf[:-len('.pdf')]
+    path = os.path.join(directory, name)
+    new[name] = { 'pdf': _file_hash(path+'.pdf') }
+    if os.path.exists(path+'.tex'):
+      new[name]['tex'] = _file_hash(path+'.tex')
+    if old.get(name) != new[name] or not os.path.exists(path+'.png'):
+      todo.append( path+'.pdf' )
+
+  print(f'Rasterizing {len(todo)} of {len(new)} diagrams in {directory}')
+  pngs = rasterize(todo, dpi=dpi, workers=workers)
+
+  if sorted(old) != sorted(new) or not os.path.exists(os.path.join(directory, readme)):
+    print(f'Writing file, {os.path.join(directory, readme)}')
+    with open(os.path.join(directory, readme),'w') as f:
+      f.write('# List of diagrams already available\n\n')
+
+      f.write('The following diagrams are available in this directory in .tex, .png and .pdf format.\n\n')
+
+      for name in sorted(new):
+        f.write('- [`{}`]({})\n\n'.format(name, name+'.pdf'))
+        f.write('  ![image]({})\n\n'.format(name+'.png'))
+
+  if old != new:
+    with open(manifest,'w') as f:
+      json.dump(new, f, indent=1, sort_keys=True)
+
+  return pngs
+
+def topologies():
+  """
+  Return the available topologies by name
+  """
+  return { cls.__name__: cls for cls in feyn.__subclasses__() }
+
+def make_diagram(spec, made):
+  """
+  Make one diagram of a manifest
+  spec : its options, either a topology and its arguments, or the fname of another
+         diagram to start from (with conjugate = true and/or a transform) and options to change
+  made : the diagrams already made, by fname
+  """
+  spec = dict(spec)
+  if 'from' in spec:
+    d = made[spec.pop('from')]
+    if spec.pop('conjugate', False): d = d.conjugate()
+    if 'transform' in spec: d = d.transform(**spec.pop('transform'))
+    return d.copy(**spec)
+
+  if 'topology' not in spec:
+    raise ValueError(f'Diagram {spec.get("fname")} needs a topology (or a diagram to start from)')
+  name = spec.pop('topology')
+  if name not in topologies():
+    raise ValueError(f'Unknown topology {name}, should be one of {", ".join(sorted(topologies()))}')
+  # toml has no tuples
+  return topologies()[name].stamp( **{ k: tuple(v) if isinstance(v, list) else v for k, v in spec.items() } )
+
+def load_manifest(path):
+  """
+  Read a catalogue manifest and return its diagrams in order. The manifest is a .toml file
+  with a [[diagram]] table for each diagram, holding the name of its topology and its arguments
+  (labels, fname, dx, ...). Options in a [defaults] table apply to every topology diagram.
+  A diagram can also start from another one, given by its fname, e.g.
+    [[diagram]]
+    from = 'feyns/Bd2KstKst'
+    conjugate = true
+    fname = 'feyns/Bdb2KstKst'
+  """
+  try:
+    import tomllib
+  except ImportError:
+    # python < 3.11
+    import tomli as tomllib
+  with open(path, 'rb') as f:
+    manifest = tomllib.load(f)
+
+  defaults = manifest.get('defaults', {})
+  specs = {}
+  for spec in manifest.get('diagram', []):
+    if 'fname' not in spec:
+      raise ValueError(f'Diagram {spec} in {path} has no fname')
+    if spec['fname'] in specs:
+      raise ValueError(f'Diagram {spec["fname"]} appears twice in {path}')
+    specs[spec['fname']] = spec if 'from' in spec else dict(defaults, **spec)
+
+  made = {}
+  def make(fname, chain=()):
+    if fname in chain:
+      raise ValueError(f'Diagram {fname} in {path} is made from itself')
+    if fname not in made:
+      if fname not in specs:
+        raise ValueError(f'Diagram {chain[-1]} in {path} starts from {fname}, which is not in the manifest')
+      if 'from' in specs[fname]:
+        make(specs[fname]['from'], chain+(fname,))
+      made[fname] = make_diagram(specs[fname], made)
+    return made[fname]
+
+  return [ make(fname) for fname in specs ]
+
+def _read(fname):
+  if not os.path.exists(fname): return None
+  with open(fname) as f:
+    return f.read()
+
+def out_of_date(d):
+  """
+  Return why a diagram needs rebuilding (or None if its files are up to date)
+  """
+  if d.backend == 'svg':
+    svg = _read(d.fname+'.svg')
+    if svg is None: return 'new'
+    return 'changed' if svg != d.to_svg() else None
+
+  tex = _read(d.fname+'.tex')
+  if tex is None: return 'new'
+  if tex != d.to_tex(): return 'changed'
+  if not d.make_pdf: return None
+  if not os.path.exists(d.fname+'.pdf'): return 'no pdf'
+  deps = [ d.fname+'.tex' ] + ( ['lhcb-symbols-def.tex'] if d.needs_lhcb() else [] )
+  if any( os.path.getmtime(dep) > os.path.getmtime(d.fname+'.pdf') for dep in deps ):
+    return 'pdf out of date'
+  return None
+
+def build_plan(diagrams, force=False):
+  """
+  Return the diagrams which need rebuilding and why, as a list of (diagram, reason)
+  force : rebuild every diagram
+  """
+  plan = []
+  for d in diagrams:
+    reason = 'forced' if force else out_of_date(d)
+    if reason: plan.append( (d, reason) )
+  return plan
+
+def build(manifest='manifest.toml', workers=None, batch=False, force=False, dry_run=False):
+  """
+  Build the diagrams of a catalogue manifest (see load_manifest) which are out of date: the
+  .tex of each is written (with any missing directories) and the pdfs are compiled in parallel
+  manifest : the manifest file
+  workers  : number of processes to compile with (see compile_pool)
+  batch    : compile them all in one TeX run with compile_batch instead
+  force    : rebuild every diagram
+  dry_run  : only list the diagrams which would be rebuilt
+  Returns the diagrams which were (or would be) rebuilt
+  """
+  diagrams = load_manifest(manifest)
+  check_diagrams(diagrams)
+  plan = build_plan(diagrams, force)
+  print(f'{len(plan)} of {len(diagrams)} diagrams in {manifest} to build')
+  for d, reason in plan:
+    print(f'  {d.fname} ({reason})')
+  todo = [ d for d, reason in plan ]
+  if dry_run or not todo: return todo
+
+  for d in todo:
+    if os.path.dirname(d.fname):
+      os.makedirs(os.path.dirname(d.fname), exist_ok=True)
+  render_all(todo, workers, batch)
+  return todo
+
+def layout_report(diagrams, pad=5):
+  """
+  Return the lines of a report on the layout of some diagrams (see feyn.check_layout), with the
+  width, height, dx and dy which would fit each diagram if they differ from the current ones
+  pad : space to leave around each drawing (in pt)
+  """
+  ret = []
+  for d in diagrams:
+    if d.backend != 'tex': continue
+    problems = d.check_layout()
+    tight = d.tight_layout(pad)
+    if tight != { k: getattr(d, k) for k in tight }:
+      problems.append( f'{d.fname}: tight layout is ' + ' '.join( f'{k}={v}' for k, v in tight.items() ) )
+    ret += problems
+  return ret
+
+# the list collecting() adds rendered diagrams to, in the context (thread or task) which is collecting
+_collecting = contextvars.ContextVar('feyn_collecting', default=None)
+
+def _collected_instead(diagrams):
+  # add the diagrams to the list of collecting() and return True, if in that context
+  collected = _collecting.get()
+  if collected is None: return False
+  collected.extend(diagrams)
+  return True
+
+@contextlib.contextmanager
+def collecting():
+  """
+  Within this context, rendering diagrams (render, render_all, compile_pool and compile_batch)
+  only collects them instead of writing and compiling them. Yields the list of diagrams collected.
+  Other threads carry on rendering as usual
+  """
+  collected = []
+  token = _collecting.set(collected)
+  try:
+    yield collected
+  finally:
+    _collecting.reset(token)
+
+def script_diagrams(path):
+  """
+  Run a diagram script (e.g. gamma_feyns.py) and return the diagrams it renders, without compiling them
+  (a diagram rendered more than once is only returned once, as it was last rendered)
+  """
+  with collecting() as collected:
+    runpy.run_path(path, run_name='__main__')
+  return list( { d.fname: d for d in collected }.values() )
+
+def load_diagrams(source):
+  """
+  Return the diagrams of a manifest (.toml, see load_manifest) or a diagram script (.py, see script_diagrams)
+  """
+  if source.endswith('.toml'): return load_manifest(source)
+  return script_diagrams(source)
+
+class watcher:
+  """
+  Keeps the diagrams of some manifests and diagram scripts built while they are edited. The files (and
+  lhcb-symbols-def.tex) are checked for changes, and a changed file is loaded again in a background thread
+  which rebuilds just the diagrams whose .tex has changed (see build_plan), so that a previewer showing the
+  .pdf (or .png) files sees an edit about one compile later. A single diagram is compiled through the
+  shared tex_worker, which has pdflatex waiting with the preamble already loaded, and more at once with
+  compile_pool. Usually run from the command line with python feyn.py watch gamma_feyns.py
+  sources : manifests (.toml) and diagram scripts (.py) to watch (modules a script imports are not watched)
+  workers : number of processes to compile with (see compile_pool)
+  png     : also keep a .png of each diagram up to date (using pdf2image)
+  dpi     : resolution of the .png files
+  warm    : compile a single changed diagram through the shared tex_worker
+  """
+  def __init__(self, sources, workers=None, png=False, dpi=200, warm=True):
+    self.sources = list(sources)
+    self.workers = workers
+    self.png = png
+    self.dpi = dpi
+    self.warm = warm
+    self.diagrams = {}
+    self.mtimes = {}
+    self.queued = set()
+    self.pending = None
+    self.lock = threading.Lock()
+    # one thread, so loading the sources and building never overlap
+    self.pool = ThreadPoolExecutor(max_workers=1)
+
+  def changed(self):
+    """
+    Return the watched files which have changed (or appeared or gone) since the last call
+    """
+    ret = []
+    for path in self.sources + ['lhcb-symbols-def.tex']:
+      mtime = os.path.getmtime(path) if os.path.exists(path) else None
+      if path not in self.mtimes or self.mtimes[path] != mtime:
+        ret.append(path)
+      self.mtimes[path] = mtime
+    return ret
+
+  def update(self, changed):
+    """
+    Load the changed sources again and rebuild the diagrams which are out of date.
+    A source which fails to load keeps its last diagrams
+    Returns the diagrams rebuilt
+    """
+    start = time.perf_counter()
+    for source in self.sources:
+      if source not in changed: continue
+      try:
+        self.diagrams[source] = load_diagrams(source)
+      except Exception as e:
+        # anything can go wrong half way through editing a script
+        print(f'feyn watch: cannot load {source}: {type(e).__name__}: {e}')
+    diagrams = [ d for source in self.sources for d in self.diagrams.get(source, []) ]
+    todo = [ d for d, reason in build_plan(diagrams) ]
+    if not todo: return []
+
+    for d in todo:
+      if os.path.dirname(d.fname):
+        os.makedirs(os.path.dirname(d.fname), exist_ok=True)
+    try:
+      if self.warm and len(todo) == 1:
+        todo[0].copy(worker=todo[0].worker or True).render()
+      else:
+        render_all(todo, self.workers)
+      if self.png:
+        rasterize([ d.fname+'.pdf' for d in todo if d.backend == 'tex' and d.make_pdf ], self.dpi)
+    except (TexError, ValueError, FileNotFoundError) as e:
+      print(f'feyn watch: {e}')
+      return []
+    names = ', '.join( d.fname for d in todo[:5] ) + ( f' and {len(todo)-5} more' if len(todo) > 5 else '' )
+    print(f'{time.strftime("%H:%M:%S")} rebuilt {names} in {time.perf_counter()-start:.2f}s')
+    return todo
+
+  def _update(self):
+    with self.lock:
+      changed, self.queued = self.queued, set()
+    try:
+      return self.update(changed)
+    except Exception as e:
+      # nobody waits on the background thread, so say what went wrong and keep watching
+      print(f'feyn watch: {type(e).__name__}: {e}')
+      return []
+
+  def submit(self, changed):
+    """
+    Rebuild after the given files changed, in the background. Changes which arrive while
+    a rebuild is waiting to start join it, and wait for the running one to finish otherwise
+    Returns the future of the rebuild
+    """
+    with self.lock:
+      self.queued.update(changed)
+      if self.pending is None or self.pending.running() or self.pending.done():
+        self.pending = self.pool.submit(self._update)
+      return self.pending
+
+  def poll(self):
+    """
+    Check for changes once, and start a rebuild if there are any (see submit)
+    """
+    changed = self.changed()
+    if changed: return self.submit(changed)
+
+  def run(self, interval=0.25):
+    """
+    Check for changes every interval seconds until interrupted (with Ctrl-C)
+    """
+    print(f'Watching {", ".join(self.sources)} and lhcb-symbols-def.tex (Ctrl-C to stop)')
+    try:
+      while True:
+        self.poll()
+        time.sleep(interval)
+    except KeyboardInterrupt:
+      pass
+    finally:
+      self.close()
+
+  def close(self):
+    self.pool.shutdown(wait=True, cancel_futures=True)
+
+regression_result = collections.namedtuple('regression_result', ['fname', 'status', 'detail'])
+
+def tex_structure(tex):
+  """
+  Return the structure of a .tex file to compare (see tex_equal): each line without its comment and
+  spacing, split into text and numbers, so that the layout of the file and of its numbers does not count
+  (the images are compared when the structure differs, so this errs on the side of a difference)
+  """
+  ret = []
+  for line in tex.split('\n'):
+    line = re.sub(r'\s+', ' ', re.sub(r'(?<!\\)%.*', '', line)).strip()
+    # spaces only matter between letters
+    line = re.sub(r'(?<![A-Za-z]) | (?![A-Za-z])', '', line)
+    if not line: continue
+    parts = re.split(r'(-?\d*\.?\d+)', line)
+    ret.append( tuple( float(p) if i % 2 else p for i, p in enumerate(parts) ) )
+  return ret
+
+def tex_equal(a, b, tol=1e-6):
+  """
+  Return True if two .tex files draw the same thing: the same lines (ignoring comments and spacing)
+  with the same numbers to within tol
+  """
+  a, b = tex_structure(a), tex_structure(b)
+  if len(a) != len(b): return False
+  return all( len(x) == len(y) and all( abs(p-q) <= tol if isinstance(p, float) and isinstance(q, float) else p == q
+                                        for p, q in zip(x, y) ) for x, y in zip(a, b) )
+
+def pixel_diff(reference, image, threshold=32):
+  """
+  Compare two greyscale images (2d uint8 arrays, padded with white to the same size) with numpy
+  threshold : smallest change of a pixel (out of 255) which counts as a difference
+  Returns the fraction of pixels which differ and an RGB image of the differences, with the reference
+  faded and what has gone in red and what has appeared in blue
+  """
+  import numpy as np
+  shape = np.maximum(reference.shape, image.shape)
+  a = np.full(shape, 255, dtype=np.int16)
+  b = np.full(shape, 255, dtype=np.int16)
+  a[:reference.shape[0], :reference.shape[1]] = reference
+  b[:image.shape[0], :image.shape[1]] = image
+  gone = b - a >= threshold
+  new = a - b >= threshold
+  diff = np.repeat( (191 + a[..., None]//4).astype(np.uint8), 3, axis=2 )
+  diff[gone] = (255, 0, 0)
+  diff[new] = (0, 0, 255)
+  return (gone | new).mean(), diff
+
+def _regression_job(job):
+  fname, reference, pdf, dpi, threshold, tolerance, diffs = job
+  # optional dependencies, only needed when the .tex has changed
+  import numpy as np
+  from pdf2image import convert_from_path
+  from PIL import Image
+  start = time.perf_counter()
+  a, b = [ np.asarray(convert_from_path(p, dpi=dpi, first_page=1, last_page=1)[0].convert('L')) for p in (reference, pdf) ]
+  fraction, diff = pixel_diff(a, b, threshold)
+  _timed(fname, 'rasterize', start)
+  if fraction <= tolerance:
+    return regression_result(fname, 'close', f'{fraction:.3%} of pixels differ')
+  out = os.path.join(diffs, fname.replace(os.sep, '_')+'-diff.png')
+  os.makedirs(diffs, exist_ok=True)
+  Image.fromarray(diff).save(out)
+  return regression_result(fname, 'differs', f'{fraction:.3%} of pixels differ, see {out}')
+
+def regression(diagrams, dpi=100, threshold=32, tolerance=1e-3, diffs='regression', workers=None):
+  """
+  Check that diagrams still match their committed fname.tex and fname.pdf, e.g. after changing feyn.py.
+  Each diagram's .tex is compared with the committed one first (see tex_equal), which is cheap. Only
+  the diagrams whose .tex differs are compiled (in a temporary directory, with compile_pool), and their
+  first pages rasterized and compared pixel by pixel with numpy (see pixel_diff), in parallel
+  diagrams  : list of feyn objects (e.g. from load_diagrams)
+  dpi       : resolution to compare the images at
+  threshold : smallest change of a pixel (out of 255) which counts as a difference
+  tolerance : largest fraction of pixels which can differ
+  diffs     : directory to write an image of the differences of each failure into
+  workers   : number of processes and threads to use (default: None uses every core)
+  Returns a regression_result (fname, status, detail) for each diagram where the status is
+    same    : the .tex draws the same thing
+    close   : the .tex differs but the images agree within the tolerance
+    differs : the images differ (or the diagram is now drawn as svg)
+    missing : there is no committed .tex (or .pdf) to compare with
+  """
+  results = {}
+  changed = []
+  for d in diagrams:
+    ext = '.svg' if d.backend == 'svg' else '.tex'
+    committed = _read(d.fname+ext)
+    if committed is None:
+      results[d.fname] = regression_result(d.fname, 'missing', f'no {d.fname}{ext}')
+    elif tex_equal(committed, d.to_svg() if d.backend == 'svg' else d.to_tex()):
+      results[d.fname] = regression_result(d.fname, 'same', '')
+    elif d.backend == 'svg' or not d.make_pdf:
+      results[d.fname] = regression_result(d.fname, 'differs', f'{d.fname}{ext} has changed')
+    elif not os.path.exists(d.fname+'.pdf'):
+      results[d.fname] = regression_result(d.fname, 'missing', f'no {d.fname}.pdf')
+    else:
+      changed.append(d)
+
+  if changed:
+    with tempfile.TemporaryDirectory(prefix='feyn-regression-') as tmp:
+      copies = [ d.copy(fname=os.path.join(tmp, d.fname.replace(os.sep, '_'))) for d in changed ]
+      compile_pool(copies, workers)
+      jobs = [ (d.fname, d.fname+'.pdf', c.fname+'.pdf', dpi, threshold, tolerance, diffs) for d, c in zip(changed, copies) ]
+      # pdftoppm does the rasterizing in a subprocess and numpy releases the GIL, so threads are enough
+      with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for result in pool.map(_regression_job, jobs):
+          results[result.fname] = result
+
+  return [ results[d.fname] for d in diagrams ]
+
+class LabelError(ValueError):
+  """
+  The labels of a render_service request use macros (or TeX) which the service does not compile
+  """
+
+class render_service:
+  """
+  Renders diagrams on demand from a description such as
+    { "topology": "tree_external", "A_label": "$\\Bd$", "format": "png" }
+  holding the name of a topology, its arguments (labels and geometry) and the format wanted
+  (pdf, png or svg, plus dpi for png). Identical requests which arrive while one is being rendered
+  wait for it rather than compiling again, and the results are kept in a bounded in-memory cache.
+  Diagrams are compiled in temporary directories on a pool of threads (lhcb-symbols-def.tex is
+  read from the current working directory)
+  workers    : number of diagrams to render at once (default: None uses the number of cores)
+  cache_size : maximum size in bytes of the in-memory cache
+  warm       : compile through the shared tex_worker (see feyn worker=True)
+  """
+  formats = { 'pdf': 'application/pdf', 'png': 'image/png', 'svg': 'image/svg+xml' }
+  # feyn options a request may set (the rest are chosen by the service)
+  options = { 'width', 'height', 'dx', 'dy', 'grid', 'axohelp' }
+
+  def __init__(self, workers=None, cache_size=64*1024*1024, warm=False):
+    self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+    self.cache_size = cache_size
+    self.warm = warm
+    self.cache = collections.OrderedDict()
+    self.size = 0
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.hits = self.misses = self.shared = 0
+
+  def check(self, request):
+    """
+    Return the topology, its arguments and the format for a request, raising ValueError if it is not valid
+    (LabelError if its labels do not pass feyn.check with strict=True, as they are compiled as TeX)
+    """
+    request = dict(request)
+    name = request.pop('topology', None)
+    if name not in topologies():
+      raise ValueError(f'Unknown topology {name}, should be one of {", ".join(sorted(topologies()))}')
+    fmt = request.pop('format', 'pdf')
+    if fmt not in self.formats:
+      raise ValueError(f'Unknown format {fmt}, should be one of {", ".join(self.formats)}')
+    dpi = request.pop('dpi', 200)
+    if isinstance(dpi, bool) or not isinstance(dpi, (int, float)) or not 0 < dpi <= 2400:
+      raise ValueError(f'Invalid dpi {dpi!r}, should be a number from 1 to 2400')
+    if fmt != 'png': dpi = None
+    allowed = set(topology_labels(topologies()[name])) | topology_options(topologies()[name]) | self.options
+    unknown = set(request) - allowed
+    if unknown:
+      raise ValueError(f'Unknown options {", ".join(sorted(unknown))} for {name}')
+    args = { k: tuple(v) if isinstance(v, list) else v for k, v in request.items() }
+    problems = topologies()[name].stamp(**args, fname=name).check(strict=True)
+    if problems:
+      raise LabelError( f'{len(problems)} problems in the labels:\n  ' + '\n  '.join(problems) )
+    return name, args, fmt, dpi
+
+  def _render(self, name, args, fmt, dpi):
+    topology = topologies()[name]
+    if fmt == 'svg':
+      return topology.stamp(**args, backend='svg').to_svg().encode()
+    with tempfile.TemporaryDirectory(prefix='feyn-') as tmp:
+      d = topology.stamp(**args, fname=os.path.join(tmp, 'feyn'), worker=self.warm or None)
+      d.render()
+      out = d.fname+'.pdf'
+      if fmt == 'png':
+        out = _rasterize_job( (out, 1, d.fname, dpi, 'png', []) )[0]
+      with open(out,'rb') as f:
+        return f.read()
+
+  def render(self, request):
+    """
+    Return the rendered diagram (as bytes) and its content type for a request
+    """
+    name, args, fmt, dpi = self.check(request)
+    key = hashlib.sha256( json.dumps([name, args, fmt, dpi], sort_keys=True).encode() ).hexdigest()
+    new = False
+    with self.lock:
+      if key in self.cache:
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return self.cache[key], self.formats[fmt]
+      if key in self.pending:
+        self.shared += 1
+        future = self.pending[key]
+      else:
+        self.misses += 1
+        future = self.pending[key] = self.pool.submit(self._render, name, args, fmt, dpi)
+        new = True
+    # outside the lock, as the callback runs straight away (and takes the lock) if the render has already finished
+    if new: future.add_done_callback( functools.partial(self._done, key) )
+    return future.result(), self.formats[fmt]
+
+  def _done(self, key, future):
+    with self.lock:
+      del self.pending[key]
+      if future.cancelled() or future.exception() is not None: return
+      data = future.result()
+      if len(data) > self.cache_size: return
+      self.cache[key] = data
+      self.size += len(data)
+      while self.size > self.cache_size:
+        old, data = self.cache.popitem(last=False)
+        self.size -= len(data)
+
+  def stats(self):
+    """
+    Return the numbers of cache hits and misses, requests which shared a render already
+    running, and the number and total size of the cached diagrams
+    """
+    with self.lock:
+      return { 'hits': self.hits, 'misses': self.misses, 'shared': self.shared, 'entries': len(self.cache), 'size': self.size }
+
+  def close(self):
+    self.pool.shutdown()
+
+class _service_handler(BaseHTTPRequestHandler):
+  # the render_service is set on the server
+  max_request = 64*1024
+
+  def _reply(self, code, data, content_type='application/json'):
+    if content_type == 'application/json':
+      data = json.dumps(data, indent=1).encode()
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    if self.path == '/':
+      self._reply(200, { name: sorted(topology_labels(cls)) for name, cls in sorted(topologies().items()) })
+    elif self.path == '/stats':
+      self._reply(200, self.server.service.stats())
+    else:
+      self._reply(404, { 'error': f'Unknown path {self.path}' })
+
+  def do_POST(self):
+    if self.path != '/render':
+      return self._reply(404, { 'error': f'Unknown path {self.path}' })
+    length = int(self.headers.get('Content-Length', 0))
+    if length > self.max_request:
+      return self._reply(413, { 'error': 'Request too large' })
+    try:
+      request = json.loads(self.rfile.read(length))
+      if not isinstance(request, dict): raise ValueError('The request should be a JSON object')
+      data, content_type = self.server.service.render(request)
+    except LabelError as e:
+      return self._reply(422, { 'error': str(e) })
+    except (ValueError, TypeError) as e:
+      return self._reply(400, { 'error': str(e) })
+    except TexError as e:
+      return self._reply(422, { 'error': str(e) })
+    except FileNotFoundError as e:
+      # the TeX toolchain or lhcb-symbols-def.tex is missing where the service runs
+      return self._reply(500, { 'error': str(e) })
+    self._reply(200, data, content_type)
+
+def serve(host='127.0.0.1', port=8000, workers=None, cache_size=64*1024*1024, warm=False):
+  """
+  Run a local HTTP service which renders diagrams (see render_service). POST a JSON request to /render
+  to get the pdf, png or svg back, GET / lists the topologies and their labels and GET /stats the cache use.
+  Run it from the directory holding lhcb-symbols-def.tex
+  """
+  server = ThreadingHTTPServer((host, port), _service_handler)
+  server.service = render_service(workers, cache_size, warm)
+  print(f'Serving diagrams on http://{host}:{server.server_address[1]}')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    server.service.close()
+
+def curve_path(curve, nseg):
+  """
+  Approximate a parametric curve by cubic Bezier segments
+  curve : function of t in [0,1] returning (x, y, dx/dt, dy/dt)
+  nseg  : number of Bezier segments
+  Returns the start point followed by one (x1,y1,x2,y2,x3,y3) tuple per segment
+  """
+  h = 1./nseg
+  x0, y0, dx0, dy0 = curve(0)
+  path = [ (x0,y0) ]
+  for i in range(1,nseg+1):
+    x1, y1, dx1, dy1 = curve(i*h)
+    path.append( (x0+dx0*h/3, y0+dy0*h/3, x1-dx1*h/3, y1-dy1*h/3, x1, y1) )
+    x0, y0, dx0, dy0 = x1, y1, dx1, dy1
+  return path
+
+def arc_path(centre, radius, start, end, clockwise=False):
+  """
+  Path of an arc (as drawn by axodraw \\Arc), angles in degrees
+  """
+  if clockwise:
+    delta = -( (start-end) % 360 or 360 )
+  else:
+    delta = (end-start) % 360 or 360
+  phi0 = math.radians(start)
+  dphi = math.radians(delta)
+  def curve(t):
+    phi = phi0 + t*dphi
+    return ( centre[0] + radius*math.cos(phi), centre[1] + radius*math.sin(phi),
+             -radius*dphi*math.sin(phi), radius*dphi*math.cos(phi) )
+  return curve_path(curve, max(2, math.ceil(abs(delta)/45.)))
+
+def photon_path(start, end, ampl, N):
+  """
+  Path of a photon (as drawn by axodraw \\Photon), a sine wave with N wiggles of amplitude ampl
+  """
+  dx, dy = end[0]-start[0], end[1]-start[1]
+  length = math.hypot(dx, dy)
+  nx, ny = -dy/length, dx/length
+  w = 2*math.pi*N
+  def curve(t):
+    s, c = ampl*math.sin(w*t), ampl*w*math.cos(w*t)
+    return ( start[0] + t*dx + s*nx, start[1] + t*dy + s*ny, dx + c*nx, dy + c*ny )
+  return curve_path(curve, max(2, math.ceil(4*N)))
+
+def photon_arc_path(centre, radius, start, end, ampl, N):
+  """
+  Path of a photon arc (as drawn by axodraw \\PhotonArc), anticlockwise from start to end in degrees
+  """
+  phi0 = math.radians(start)
+  dphi = math.radians( (end-start) % 360 or 360 )
+  w = 2*math.pi*N
+  def curve(t):
+    phi = phi0 + t*dphi
+    r, dr = radius + ampl*math.sin(w*t), ampl*w*math.cos(w*t)
+    return ( centre[0] + r*math.cos(phi), centre[1] + r*math.sin(phi),
+             dr*math.cos(phi) - r*dphi*math.sin(phi), dr*math.sin(phi) + r*dphi*math.cos(phi) )
+  return curve_path(curve, max(2, math.ceil(4*N)))
+
+def gluon_path(start, end, ampl, N):
+  """
+  Path of a gluon (as drawn by axodraw \\Gluon), N curls of size ampl
+  """
+  dx, dy = end[0]-start[0], end[1]-start[1]
+  length = math.hypot(dx, dy)
+  ux, uy = dx/length, dy/length
+  w = 2*math.pi*N
+  def curve(t):
+    # a prolate cycloid along the line which loops back on itself once per curl
+    u = t*length + abs(ampl)*math.sin(w*t)
+    v = ampl*(1-math.cos(w*t))
+    du = length + abs(ampl)*w*math.cos(w*t)
+    dv = ampl*w*math.sin(w*t)
+    return ( start[0] + u*ux - v*uy, start[1] + u*uy + v*ux, du*ux - dv*uy, du*uy + dv*ux )
+  return curve_path(curve, max(2, math.ceil(8*N)))
+
+def arrow_head(path, pos=0.5, length=5, width=2.5, inset=0.2):
+  """
+  Outline of an arrow head (as drawn by axodraw) at fraction pos along a path made by curve_path
+  """
+  nseg = len(path)-1
+  i = min(int(pos*nseg), nseg-1)
+  t = pos*nseg - i
+  p0 = path[i][-2:]
+  x1, y1, x2, y2, x3, y3 = path[i+1]
+  b = [ (1-t)**3, 3*(1-t)**2*t, 3*(1-t)*t**2, t**3 ]
+  db = [ -3*(1-t)**2, 3*(1-t)**2 - 6*(1-t)*t, 6*(1-t)*t - 3*t**2, 3*t**2 ]
+  xs, ys = (p0[0],x1,x2,x3), (p0[1],y1,y2,y3)
+  x, y = sum( bi*xi for bi, xi in zip(b,xs) ), sum( bi*yi for bi, yi in zip(b,ys) )
+  tx, ty = sum( bi*xi for bi, xi in zip(db,xs) ), sum( bi*yi for bi, yi in zip(db,ys) )
+  norm = math.hypot(tx, ty)
+  tx, ty = tx/norm, ty/norm
+  nx, ny = -ty, tx
+  return [ (x + tx*length/2, y + ty*length/2),
+           (x - tx*length/2 + nx*width, y - ty*length/2 + ny*width),
+           (x - tx*length*(0.5-inset), y - ty*length*(0.5-inset)),
+           (x - tx*length/2 - nx*width, y - ty*length/2 - ny*width) ]
+
+def pdf_literal(paths, fills=[], linewidth=0.5):
+  """
+  Return the TeX which draws paths (made by curve_path) and fills polygons as raw pdf code.
+  Coordinates are in the axopicture units (pt) and are converted to the pdf units (bp)
+  """
+  ops = [ 'q 0.99626 0 0 0.99626 0 0 cm', f'{linewidth} w 1 J 1 j' ]
+  for path in paths:
+    ops.append( '{:.2f} {:.2f} m'.format(*path[0]) )
+    for seg in path[1:]:
+      ops.append( '{:.2f} {:.2f} {:.2f} {:.2f} {:.2f} {:.2f} c'.format(*seg) )
+    ops.append( 'S' )
+  for poly in fills:
+    ops.append( '{:.2f} {:.2f} m'.format(*poly[0]) )
+    for pt in poly[1:]:
+      ops.append( '{:.2f} {:.2f} l'.format(*pt) )
+    ops.append( 'h f' )
+  ops.append( 'Q' )
+  return r'\put(0,0){\pdfliteral{' + ' '.join(ops) + '}}'
+
+# plain text versions of common label macros for the svg backend
+label_symbols = {
+  'quark': 'q', 'ell': '\u2113', 'ellp': '\u2113\u207a', 'ellm': '\u2113\u207b',
+  'Wp': 'W\u207a', 'Wm': 'W\u207b', 'Z': 'Z', 'g': 'g', 'gamma': '\u03b3',
+  'Bp': 'B\u207a', 'Bm': 'B\u207b', 'Bd': 'B\u2070', 'Bdb': 'B\u0305\u2070', 'Bs': 'B\u2070\u209b', 'Bsb': 'B\u0305\u2070\u209b',
+  'Kp': 'K\u207a', 'Km': 'K\u207b', 'Kz': 'K\u2070', 'Kzb': 'K\u0305\u2070', 'Kstarz': 'K*\u2070', 'Kstarzb': 'K\u0305*\u2070',
+  'Dz': 'D\u2070', 'Dzb': 'D\u0305\u2070', 'Dp': 'D\u207a', 'Dm': 'D\u207b', 'jpsi': 'J/\u03c8', 'phi': '\u03c6', 'pi': '\u03c0',
+}
+
+# pairs of label macros for particles and their antiparticles
+conjugate_macros = { 'ellp': 'ellm', 'ep': 'en', 'mup': 'mun', 'taup': 'taum', 'Hp': 'Hm', 'Wp': 'Wm',
+                     'ellpm': 'ellmp', 'epm': 'emp', 'mupm': 'mump', 'taupm': 'taump',
+                     'neu': 'neub', 'neue': 'neueb', 'neum': 'neumb', 'neut': 'neutb', 'neul': 'neulb',
+                     'pip': 'pim', 'pipm': 'pimp', 'rhop': 'rhom', 'rhopm': 'rhomp',
+                     'Kz': 'Kzb', 'Kp': 'Km', 'Kpm': 'Kmp', 'Kstar': 'Kstarb', 'Kstarz': 'Kstarzb', 'Kstarp': 'Kstarm', 'Kstarpm': 'Kstarmp',
+                     'D': 'Db', 'Dz': 'Dzb', 'Dp': 'Dm', 'Dpm': 'Dmp', 'Dstar': 'Dstarb', 'Dstarz': 'Dstarzb', 'Dstarp': 'Dstarm',
+                     'Dstarpm': 'Dstarmp', 'Dsp': 'Dsm', 'Dspm': 'Dsmp', 'Dssp': 'Dssm', 'Dsspm': 'Dssmp',
+                     'B': 'Bb', 'Bz': 'Bzb', 'Bd': 'Bdb', 'Bu': 'Bub', 'Bp': 'Bm', 'Bpm': 'Bmp', 'Bs': 'Bsb', 'Bds': 'Bdsb',
+                     'Bcp': 'Bcm', 'proton': 'antiproton', 'neutron': 'antineutron',
+                     'Lz': 'Lbar', 'Lc': 'Lcbar', 'Lb': 'Lbbar', 'Xic': 'Xicbar', 'Omegac': 'Omegacbar', 'Omegab': 'Omegabbar' }
+conjugate_macros.update( { q+'quark': q+'quarkbar' for q in ('', 'u', 'd', 's', 'c', 'b', 't') } )
+conjugate_macros.update( { v: k for k, v in conjugate_macros.items() } )
+
+@functools.lru_cache(maxsize=4096)
+def conjugate_label(label):
+  """
+  Return a label with each particle macro swapped for its antiparticle, e.g. r'$\\bquark$' -> r'$\\bquarkbar$'
+  """
+  return re.sub(r'\\([A-Za-z]+)', lambda m: '\\'+conjugate_macros.get(m.group(1), m.group(1)), label)
+
+@functools.lru_cache(maxsize=4096)
+def conjugate_comment(comment):
+  # the comments of the topologies say which lines are the quarks and anti-quarks
+  return re.sub(r'\b(anti-)?quark\b', lambda m: 'quark' if m.group(1) else 'anti-quark', comment)
+
+def label_text(label):
+  """
+  Return a plain text version of a TeX label, e.g. r'$\\bquarkbar$' -> 'b̄'
+  """
+  def macro(m):
+    name = m.group(1)
+    if name in label_symbols: return label_symbols[name]
+    if name.endswith('quarkbar') and len(name)==9: return name[0]+'\u0305'
+    if name.endswith('quark') and len(name)==6: return name[0]
+    if name in ('small','footnotesize','scriptsize','tiny','large','mathrm','text','mbox'): return ''
+    return name
+  text = re.sub(r'\\([A-Za-z]+)\s*', macro, label)
+  return re.sub(r'[${}]', '', text)
+
+def parse_element(obj):
+  """
+  Split an axodraw command into its name and arguments, e.g. r'\\Text(1,2)[l]{$x$}' ->
+  ('Text', [ ('(', '1,2'), ('[', 'l'), ('{', '$x$') ])
+  """
+  m = re.match(r'\s*\\([A-Za-z]+)', obj)
+  if not m: return None, []
+  args = []
+  i = m.end()
+  close = { '(': ')', '[': ']', '{': '}' }
+  while i < len(obj) and obj[i] in close:
+    depth = 0
+    for j in range(i, len(obj)):
+      if obj[j] == obj[i]: depth += 1
+      elif obj[j] == close[obj[i]]:
+        depth -= 1
+        if depth == 0: break
+    args.append( (obj[i], obj[i+1:j]) )
+    i = j+1
+  return m.group(1), args
+
+def svg_path(path, height):
+  """
+  Return the svg path data of a path made by curve_path, flipping y to run downwards
+  """
+  d = 'M{:.2f},{:.2f}'.format(path[0][0], height-path[0][1])
+  for x1, y1, x2, y2, x3, y3 in path[1:]:
+    d += ' C{:.2f},{:.2f} {:.2f},{:.2f} {:.2f},{:.2f}'.format(x1, height-y1, x2, height-y2, x3, height-y3)
+  return d
+
+def svg_polygon(poly, height):
+  return '<polygon points="{}"/>'.format( ' '.join( '{:.2f},{:.2f}'.format(x, height-y) for x, y in poly ) )
+
+def svg_literal(ops, height):
+  """
+  Convert the pdf drawing code written by pdf_literal back into svg
+  """
+  ret = []
+  d = ''
+  nums = []
+  for tok in ops.split():
+    try:
+      nums.append( float(tok) )
+      continue
+    except ValueError:
+      pass
+    pts = [ '{:.2f},{:.2f}'.format(nums[k], height-nums[k+1]) for k in range(0, len(nums)-1, 2) ]
+    if tok == 'm': d += ' M'+pts[0]
+    elif tok == 'l': d += ' L'+pts[0]
+    elif tok == 'c': d += ' C'+' '.join(pts)
+    elif tok == 'h': d += ' Z'
+    elif tok == 'S':
+      ret.append( f'<path d="{d.strip()}" fill="none"/>' )
+      d = ''
+    elif tok == 'f':
+      ret.append( f'<path d="{d.strip()}" stroke="none"/>' )
+      d = ''
+    nums = []
+  return ret
+
+def svg_element(obj, height, dx=0, dy=0):
+  """
+  Return the svg for one element of a diagram (or an axodraw command string)
+  """
+  if isinstance(obj, str):
+    name, args = parse_element(obj)
+    if name == 'put' and args and args[-1][1].startswith(r'\pdfliteral'):
+      return svg_literal( parse_element(args[-1][1])[1][0][1], height )
+    obj = from_tex(obj)
+    if obj is None: return []
+    dx, dy = 0, 0
+  return obj.svg(height, dx, dy)
+
+# elements of a diagram, which keep their coordinates as numbers
+# and only make their axodraw (or pdf) code when the .tex is written
+
+def _xy(x, y):
+  return '({0},{1})'.format(x, y)
+
+def _svg_xy(x, y, height):
+  return '{:.2f}'.format(x), '{:.2f}'.format(height-y)
+
+def _arrowpos(opts):
+  return float( next( (o.split('=')[-1] for o in opts if o.startswith('arrowpos')), 0.5 ) )
+
+def _number(v):
+  # a transformed coordinate, written as an int when it is whole
+  v = round(float(v), 6)
+  return int(v) if v.is_integer() else v
+
+def _angle(a, sx, sy):
+  # an angle (in degrees) after mirroring by the sign of sx and sy
+  if sx < 0: a = 180-a
+  if sy < 0: a = -a
+  return _number(a % 360)
+
+def _toggle_clockwise(opts):
+  return [ o for o in opts if o != 'clockwise' ] if 'clockwise' in opts else list(opts) + ['clockwise']
+
+def _path_points(path, step=1.):
+  # points along a path (see curve_path) no more than about step apart
+  ret = [ path[0] ]
+  x0, y0 = path[0]
+  for x1, y1, x2, y2, x3, y3 in path[1:]:
+    n = max(1, math.ceil( math.hypot(x3-x0, y3-y0) / step ))
+    for i in range(1, n+1):
+      t = i/n
+      a, b, c, d = (1-t)**3, 3*t*(1-t)**2, 3*t*t*(1-t), t**3
+      ret.append( (a*x0+b*x1+c*x2+d*x3, a*y0+b*y1+c*y2+d*y3) )
+    x0, y0 = x3, y3
+  return ret
+
+def _ellipse_points(cx, cy, a, b, rotation=0, step=1.):
+  # points on and inside a filled ellipse with semi-axes a, b (rotated by rotation degrees)
+  c, s = math.cos(math.radians(rotation)), math.sin(math.radians(rotation))
+  ret = [ (cx, cy) ]
+  for f in (1, 2/3, 1/3):
+    n = max(8, math.ceil( 2*math.pi*max(a, b)*f / step ))
+    for i in range(n):
+      phi = 2*math.pi*i/n
+      x, y = a*f*math.cos(phi), b*f*math.sin(phi)
+      ret.append( (cx + x*c - y*s, cy + x*s + y*c) )
+  return ret
+
+def bounds(points):
+  """
+  Return the bounding box (x0, y0, x1, y1) of some points
+  """
+  xs, ys = [ p[0] for p in points ], [ p[1] for p in points ]
+  return min(xs), min(ys), max(xs), max(ys)
+
+# approximate metrics of the default 10pt Computer Modern fonts, for label_extent
+font_sizes = { 'tiny': 5, 'scriptsize': 7, 'footnotesize': 8, 'small': 9, 'normalsize': 10,
+               'large': 12, 'Large': 14.4, 'LARGE': 17.28, 'huge': 20.74, 'Huge': 24.88 }
+char_widths = [ ('iljt.,;:!|\'`()[]/', 0.3), ('frI', 0.38), ('mw', 0.8), ('MW', 0.95), ('ABCDEFGHJKLNOPQRSTUVXYZ', 0.73),
+                ('+-=<>*', 0.78), ('abcdeghknopqsuvxyz0123456789?', 0.5), (' ~', 0.33) ]
+# macros which draw a single symbol (the rest draw nothing themselves, e.g. \ensuremath or \xspace)
+symbol_macros = { 'to', 'rightarrow', 'leftarrow', 'pm', 'mp', 'times', 'ell', 'infty', 'prime', 'ast', 'star' } | \
+                { g for g in latex_macros if g.lower() in ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'varepsilon', 'zeta', 'eta',
+                  'theta', 'vartheta', 'iota', 'kappa', 'lambda', 'mu', 'nu', 'xi', 'pi', 'varpi', 'rho', 'varrho', 'sigma', 'varsigma',
+                  'tau', 'upsilon', 'phi', 'varphi', 'chi', 'psi', 'omega') }
+
+def _char_width(c):
+  for chars, width in char_widths:
+    if c in chars: return width
+  return 0.6
+
+@functools.lru_cache(maxsize=4096)
+def label_extent(label, lhcb=True):
+  """
+  Return the approximate (width, height, depth) in pt of a label typeset by TeX at 10pt,
+  expanding the macros of lhcb-symbols-def (if lhcb is True and the file is there)
+  """
+  macros = lhcb_macros() if lhcb and os.path.exists('lhcb-symbols-def.tex') else None
+  tokens = re.findall(r'\\[A-Za-z@]+\s*|\\.|.', label, re.S)
+  width, height, depth = 0., 0., 0.
+  # stack of (size, script shift) for each group
+  stack = [ [10., 0.] ]
+  script = None
+  expansions = 0
+  while tokens:
+    tok = tokens.pop(0)
+    size, shift = stack[-1]
+    if tok.startswith('\\') and tok[1:].strip().isalpha():
+      name = tok[1:].strip()
+      body = macros.body(name) if macros and name not in symbol_macros else None
+      if body is not None and expansions < 1000:
+        expansions += 1
+        tokens[:0] = re.findall(r'\\[A-Za-z@]+\s*|\\.|.', body, re.S)
+        continue
+      if name in font_sizes:
+        stack[-1][0] = font_sizes[name]
+        continue
+      if name in ('quad', 'qquad'):
+        width += size*(1 if name == 'quad' else 2)
+        continue
+      if name in ('kern', 'mskip', 'hskip', 'hspace'):
+        # the length can be a macro, e.g. \kern -\thebaroffset
+        for i in (0, 1):
+          body = macros.body(tokens[i][1:].strip()) if macros and i < len(tokens) and tokens[i].startswith('\\') else None
+          if body is not None: tokens[i:i+1] = list(body)
+        m = re.match(r'\{?\s*(-?[\d.]+)\s*(mu|pt|em|ex)\}?', ''.join(tokens[:16]))
+        if m:
+          del tokens[:len(m.group(0))]
+          width += float(m.group(1)) * {'mu': size/18, 'pt': 1, 'em': size, 'ex': 0.43*size}[m.group(2)]
+        continue
+      if name not in symbol_macros and not (macros and name in macros.defined):
+        # \ensuremath, \mathrm, \overline, \xspace, ... draw nothing themselves
+        continue
+      w = 0.6
+    elif tok in ('^', '_'):
+      script = 0.45 if tok == '^' else -0.2
+      continue
+    elif tok == '{':
+      stack.append( list(stack[-1]) )
+      if script is not None:
+        stack[-1] = [ size*0.7, shift + script*size ]
+        script = None
+      continue
+    elif tok == '}':
+      if len(stack) > 1: stack.pop()
+      continue
+    elif tok in ('$', '\n') or tok.startswith('\\'):
+      w = {'\\,': 0.17, '\\ ': 0.33, '\\!': -0.17}.get(tok, 0)
+      width += w*size
+      continue
+    else:
+      w = _char_width(tok)
+    if script is not None:
+      size, shift = size*0.7, shift + script*size
+      script = None
+    width += w*size
+    height = max(height, shift + 0.7*size)
+    depth = max(depth, -shift + (0.2 if tok in 'gjpqy()' else 0)*size)
+  return width, height, depth
+
+class Line:
+  """
+  A straight line (a fermion if opts contains arrow)
+  """
+  __slots__ = ('start', 'end', 'opts')
+
+  def __init__(self, start, end, opts=()):
+    self.start = tuple(start)
+    self.end = tuple(end)
+    self.opts = tuple(opts)
+
+  def needs_axohelp(self, axohelp=True):
+    return False
+
+  def path(self, dx=0, dy=0):
+    (x1, y1), (x2, y2) = (self.start[0]+dx, self.start[1]+dy), (self.end[0]+dx, self.end[1]+dy)
+    return [ (x1,y1), (x1+(x2-x1)/3, y1+(y2-y1)/3, x2-(x2-x1)/3, y2-(y2-y1)/3, x2, y2) ]
+
+  def points(self):
+    return [ self.start, self.end ]
+
+  def transformed(self, points, sx, sy):
+    return Line(points[0], points[1], self.opts)
+
+  def reversed(self):
+    return Line(self.end, self.start, self.opts)
+
+  def outline(self, dx=0, dy=0):
+    return _path_points(self.path(dx, dy))
+
+  def tex(self, dx=0, dy=0, axohelp=True):
+    ret = r'\Line'
+    if self.opts: ret += '[{}]'.format(','.join(self.opts))
+    return ret + _xy(self.start[0]+dx, self.start[1]+dy) + _xy(self.end[0]+dx, self.end[1]+dy)
+
+  def svg(self, height, dx=0, dy=0):
+    path = self.path(dx, dy)
+    ret = [ '<line x1="{}" y1="{}" x2="{}" y2="{}"/>'.format(*_svg_xy(*path[0], height), *_svg_xy(*path[1][-2:], height)) ]
+    if 'arrow' in self.opts:
+      ret.append( svg_polygon(arrow_head(path, _arrowpos(self.opts)), height).replace('/>', ' stroke="none"/>') )
+    return ret
+
+class Arc:
+  """
+  An arc of a circle, anticlockwise from start to end (in degrees) unless opts contains clockwise
+  """
+  __slots__ = ('centre', 'radius', 'start', 'end', 'opts')
+
+  def __init__(self, centre, radius, start, end, opts=()):
+    self.centre = tuple(centre)
+    self.radius = radius
+    self.start = start
+    self.end = end
+    self.opts = tuple(opts)
+
+  def native(self):
+    # options which can be drawn without axohelp
+    return set( o.split('=')[0] for o in self.opts ) <= {'arrow', 'clockwise', 'arrowpos'}
+
+  def needs_axohelp(self, axohelp=True):
+    return axohelp or not self.native()
+
+  def points(self):
+    return [ self.centre ]
+
+  def transformed(self, points, sx, sy):
+    start, end, opts = self.start, self.end, self.opts
+    if sx < 0 or sy < 0:
+      start, end = _angle(start, sx, sy), _angle(end, sx, sy)
+    if sx*sy < 0:
+      opts = _toggle_clockwise(opts)
+    return Arc(points[0], _number(self.radius*abs(sx)), start, end, opts)
+
+  def reversed(self):
+    # the same arc drawn from end to start (as fermion_arc with reverse=True)
+    opts = _toggle_clockwise(self.opts)
+    opts = [ o for o in opts if not o.startswith('arrowpos') ] + \
+           [ 'arrowpos={:.2f}'.format(1-float(o.split('=')[-1])) for o in opts if o.startswith('arrowpos') ]
+    return Arc(self.centre, self.radius, self.end, self.start, opts)
+
+  def outline(self, dx=0, dy=0):
+    return _path_points(self.path(dx, dy))
+
+  def path(self, dx=0, dy=0):
+    return arc_path((self.centre[0]+dx, self.centre[1]+dy), self.radius, self.start, self.end, clockwise='clockwise' in self.opts)
+
+  def tex(self, dx=0, dy=0, axohelp=True):
+    if not axohelp and self.native():
+      path = self.path(dx, dy)
+      return pdf_literal( [path], [arrow_head(path, _arrowpos(self.opts))] if 'arrow' in self.opts else [] )
+    ret = r'\Arc'
+    if self.opts: ret += '[{}]'.format(','.join(self.opts))
+    return ret + _xy(self.centre[0]+dx, self.centre[1]+dy) + '({0},{1},{2})'.format(self.radius, self.start, self.end)
+
+  def svg(self, height, dx=0, dy=0):
+    path = self.path(dx, dy)
+    ret = [ f'<path d="{svg_path(path, height)}" fill="none"/>' ]
+    if 'arrow' in self.opts:
+      ret.append( svg_polygon(arrow_head(path, _arrowpos(self.opts)), height).replace('/>', ' stroke="none"/>') )
+    return ret
+
+class Photon:
+  """
+  A photon (or W, Z) line with N wiggles of amplitude ampl
+  """
+  __slots__ = ('start', 'end', 'ampl', 'N')
+  command = r'\Photon'
+
+  def __init__(self, start, end, ampl, N):
+    self.start = tuple(start)
+    self.end = tuple(end)
+    self.ampl = ampl
+    self.N = N
+
+  def needs_axohelp(self, axohelp=True):
+    return axohelp
+
+  def points(self):
+    return [ self.start, self.end ]
+
+  def transformed(self, points, sx, sy):
+    # a mirror image wiggles on the other side of the line
+    return type(self)(points[0], points[1], _number(self.ampl*sx*sy/abs(sx)), self.N)
+
+  def path(self, dx=0, dy=0):
+    return photon_path((self.start[0]+dx, self.start[1]+dy), (self.end[0]+dx, self.end[1]+dy), self.ampl, self.N)
+
+  def outline(self, dx=0, dy=0):
+    return _path_points(self.path(dx, dy))
+
+  def tex(self, dx=0, dy=0, axohelp=True):
+    if not axohelp:
+      return pdf_literal( [self.path(dx, dy)] )
+    return self.command + _xy(self.start[0]+dx, self.start[1]+dy) + _xy(self.end[0]+dx, self.end[1]+dy) + '{{{0}}}{{{1}}}'.format(self.ampl, self.N)
+
+  def svg(self, height, dx=0, dy=0):
+    return [ f'<path d="{svg_path(self.path(dx, dy), height)}" fill="none"/>' ]
+
+class Gluon(Photon):
+  """
+  A gluon line with N curls of size ampl
+  """
+  __slots__ = ()
+  command = r'\Gluon'
+
+  def path(self, dx=0, dy=0):
+    return gluon_path((self.start[0]+dx, self.start[1]+dy), (self.end[0]+dx, self.end[1]+dy), self.ampl, self.N)
+
+class PhotonArc:
+  """
+  A photon (or W, Z) along an arc, anticlockwise from start to end (in degrees)
+  """
+  __slots__ = ('centre', 'radius', 'start', 'end', 'ampl', 'N')
+
+  def __init__(self, centre, radius, start, end, ampl, N):
+    self.centre = tuple(centre)
+    self.radius = radius
+    self.start = start
+    self.end = end
+    self.ampl = ampl
+    self.N = N
+
+  def needs_axohelp(self, axohelp=True):
+    return axohelp
+
+  def points(self):
+    return [ self.centre ]
+
+  def transformed(self, points, sx, sy):
+    start, end, ampl = self.start, self.end, self.ampl*abs(sx)
+    if sx < 0 or sy < 0:
+      start, end = _angle(start, sx, sy), _angle(end, sx, sy)
+    if sx*sy < 0:
+      # photon arcs always run anticlockwise, so a mirror image runs from the (mirrored) end
+      # to the start, which puts the wiggles on the other side for a whole number of them
+      start, end = end, start
+      if float(self.N).is_integer(): ampl = -ampl
+    return PhotonArc(points[0], _number(self.radius*abs(sx)), start, end, _number(ampl), self.N)
+
+  def path(self, dx=0, dy=0):
+    return photon_arc_path((self.centre[0]+dx, self.centre[1]+dy), self.radius, self.start, self.end, self.ampl, self.N)
+
+  def outline(self, dx=0, dy=0):
+    return _path_points(self.path(dx, dy))
+
+  def tex(self, dx=0, dy=0, axohelp=True):
+    if not axohelp:
+      return pdf_literal( [self.path(dx, dy)] )
+    return r'\PhotonArc' + _xy(self.centre[0]+dx, self.centre[1]+dy) + '({0},{1},{2})'.format(self.radius, self.start, self.end) + '{{{0}}}{{{1}}}'.format(self.ampl, self.N)
+
+  def svg(self, height, dx=0, dy=0):
+    return [ f'<path d="{svg_path(self.path(dx, dy), height)}" fill="none"/>' ]
+
+class Oval:
+  """
+  A grey filled oval (used for bound states), rotated anticlockwise by rotation degrees
+  """
+  __slots__ = ('centre', 'height', 'width', 'rotation', 'grey')
+
+  def __init__(self, centre, height, width, rotation=0, grey=0.7):
+    self.centre = tuple(centre)
+    self.height = height
+    self.width = width
+    self.rotation = rotation
+    self.grey = grey
+
+  def needs_axohelp(self, axohelp=True):
+    return False
+
+  def points(self):
+    return [ self.centre ]
+
+  def transformed(self, points, sx, sy):
+    rotation = _number(-self.rotation % 180) if sx*sy < 0 else self.rotation
+    return Oval(points[0], _number(self.height*abs(sx)), _number(self.width*abs(sx)), rotation, self.grey)
+
+  def outline(self, dx=0, dy=0):
+    # height and width are the semi-axes (before rotating anticlockwise by rotation)
+    return _ellipse_points(self.centre[0]+dx, self.centre[1]+dy, self.width, self.height, self.rotation)
+
+  def tex(self, dx=0, dy=0, axohelp=True):
+    return r'\GOval' + _xy(self.centre[0]+dx, self.centre[1]+dy) + '({0},{1})({2}){{{3}}}'.format(self.height, self.width, self.rotation, self.grey)
+
+  def svg(self, height, dx=0, dy=0):
+    x, y = _svg_xy(self.centre[0]+dx, self.centre[1]+dy, height)
+    grey = int(round(255*float(self.grey)))
+    return [ '<ellipse cx="{0}" cy="{1}" rx="{2}" ry="{3}" transform="rotate({4} {0} {1})" fill="rgb({5},{5},{5})"/>'.format(
+             x, y, self.width, self.height, -self.rotation, grey) ]
+
+class Vertex:
+  """
+  A filled circle marking a vertex
+  """
+  __slots__ = ('centre', 'radius')
+
+  def __init__(self, centre, radius=2):
+    self.centre = tuple(centre)
+    self.radius = radius
+
+  def needs_axohelp(self, axohelp=True):
+    return False
+
+  def points(self):
+    return [ self.centre ]
+
+  def transformed(self, points, sx, sy):
+    return Vertex(points[0], self.radius)
+
+  def outline(self, dx=0, dy=0):
+    return _ellipse_points(self.centre[0]+dx, self.centre[1]+dy, self.radius, self.radius)
+
+  def tex(self, dx=0, dy=0, axohelp=True):
+    return r'\Vertex' + _xy(self.centre[0]+dx, self.centre[1]+dy) + '{{{0}}}'.format(self.radius)
+
+  def svg(self, height, dx=0, dy=0):
+    x, y = _svg_xy(self.centre[0]+dx, self.centre[1]+dy, height)
+    return [ f'<circle cx="{x}" cy="{y}" r="{self.radius}" stroke="none"/>' ]
+
+class Text:
+  """
+  A label, aligned on its position by align (combinations of l, r, t and b, default centred)
+  """
+  __slots__ = ('pos', 'text', 'align')
+
+  def __init__(self, pos, text, align=None):
+    self.pos = tuple(pos)
+    self.text = text
+    self.align = align
+
+  def needs_axohelp(self, axohelp=True):
+    return False
+
+  def points(self):
+    return [ self.pos ]
+
+  def transformed(self, points, sx, sy):
+    align = self.align
+    if align is not None and sx < 0: align = align.translate(str.maketrans('lr', 'rl'))
+    if align is not None and sy < 0: align = align.translate(str.maketrans('tb', 'bt'))
+    return Text(points[0], self.text, align)
+
+  def outline(self, dx=0, dy=0):
+    # the corners of the box of the label (see label_extent)
+    width, height, depth = label_extent(self.text)
+    align = self.align or ''
+    x = self.pos[0]+dx - (0 if 'l' in align else width if 'r' in align else width/2)
+    y = self.pos[1]+dy - (depth if 'b' in align else height if 't' in align else (height-depth)/2)
+    return [ (x, y-depth), (x+width, y-depth), (x+width, y+height), (x, y+height) ]
+
+  def tex(self, dx=0, dy=0, axohelp=True):
+    ret = r'\Text' + _xy(self.pos[0]+dx, self.pos[1]+dy)
+    if self.align is not None:
+      if '[' in self.align and ']' in self.align:
+        ret += self.align
+      else:
+        ret += '['+self.align+']'
+    return ret + f'{{{self.text}}}'
+
+  def svg(self, height, dx=0, dy=0):
+    x, y = _svg_xy(self.pos[0]+dx, self.pos[1]+dy, height)
+    align = self.align or ''
+    anchor = 'start' if 'l' in align else 'end' if 'r' in align else 'middle'
+    baseline = 'hanging' if 't' in align else 'auto' if 'b' in align else 'central'
+    return [ f'<text x="{x}" y="{y}" text-anchor="{anchor}" dominant-baseline="{baseline}" stroke="none">{html.escape(label_text(self.text))}</text>' ]
+
+def from_tex(obj):
+  """
+  Make the element for an axodraw command string, e.g. from_tex(r'\\Vertex(1,2){2}') -> Vertex((1,2),2).
+  Returns None for comments and commands without an element type
+  """
+  name, args = parse_element(obj)
+  # numbers are kept as written (int or float), so the element writes the same TeX back
+  def number(v):
+    return float(v) if '.' in v else int(v)
+  opts = [ a for t, a in args if t=='[' ]
+  nums = [ [ number(v) for v in a.split(',') ] for t, a in args if t=='(' ]
+  braces = [ a for t, a in args if t=='{' ]
+  try:
+    if name == 'Line':
+      return Line(nums[0], nums[1], opts[0].split(',') if opts else ())
+    if name == 'Arc':
+      return Arc(nums[0], *nums[1], opts[0].split(',') if opts else ())
+    if name in ('Photon', 'Gluon'):
+      return (Photon if name=='Photon' else Gluon)(nums[0], nums[1], number(braces[0]), number(braces[1]))
+    if name == 'PhotonArc':
+      return PhotonArc(nums[0], *nums[1], number(braces[0]), number(braces[1]))
+    if name == 'GOval':
+      return Oval(nums[0], *nums[1], nums[2][0], braces[0])
+    if name == 'Vertex':
+      return Vertex(nums[0], braces[0])
+    if name == 'Text':
+      return Text(nums[0], braces[0], opts[0] if opts else None)
+  except (IndexError, ValueError):
+    pass
+  return None
+
 
 class tree_external(feyn):
   def __init__(self,
@@ -241,7 +3331,7 @@ class tree_external(feyn):
     self.add_element( '' )
 
     # Write it
-    self.write()
+    if self.eager: self.render()
 
 class tree_internal(feyn):
   def __init__(self,
@@ -313,7 +3403,7 @@ class tree_internal(feyn):
     self.add_element( '' )
 
     # Write it
-    self.write()
+    if self.eager: self.render()
 
 class loop_external(feyn):
   def __init__(self,
@@ -394,7 +3484,7 @@ class loop_external(feyn):
     self.add_element( '' )
 
     # Write it
-    self.write()
+    if self.eager: self.render()
 
 class loop_internal(feyn):
   def __init__(self,
@@ -475,7 +3565,7 @@ class loop_internal(feyn):
     self.add_element( '' )
 
     # Write it
-    self.write()
+    if self.eager: self.render()
 
 class mixing1(feyn):
   def __init__(self,
@@ -544,7 +3634,7 @@ class mixing1(feyn):
     self.add_element( '' )
 
     # Write it
-    self.write()
+    if self.eager: self.render()
 
 class mixing2(feyn):
   def __init__(self,
@@ -613,7 +3703,7 @@ class mixing2(feyn):
     self.add_element( '' )
 
     # Write it
-    self.write()
+    if self.eager: self.render()
 
 class loop_external_quark(feyn):
   def __init__(self,
@@ -673,5 +3763,322 @@ class loop_external_quark(feyn):
     self.add_element( '' )
 
     # Write it
-    self.write()
+    if self.eager: self.render()
+
+# the propagators a graph can draw between its nodes
+propagators = ('fermion', 'line', 'photon', 'W', 'gluon')
+
+_graph_layouts = {}
+
+def graph_layout(n, edges, pinned, spacing=40, bounds=None, iterations=40):
+  """
+  Place the nodes of a graph with numpy, keeping the pinned nodes where they are. The other nodes
+  start where every one is the average of its neighbours (solving the graph Laplacian once) and are
+  then pushed apart where they come closer than spacing, all nodes at once on each iteration
+  n          : number of nodes
+  edges      : (start, end) node indices of each edge
+  pinned     : node index -> (x, y) of the nodes which do not move
+  spacing    : the distance below which nodes push each other apart
+  bounds     : (xmin, ymin, xmax, ymax) to keep the free nodes within
+  iterations : number of steps pushing the nodes apart
+  Returns an (n, 2) array of the positions
+  """
+  import numpy as np
+  edges = np.array(edges, dtype=int).reshape(-1, 2)
+  fixed = np.array(sorted(pinned), dtype=int)
+  free = np.setdiff1d(np.arange(n), fixed)
+  pos = np.zeros((n, 2))
+  pos[fixed] = np.array([ pinned[i] for i in fixed ]).reshape(-1, 2)
+  if not len(free): return pos
+
+  # graph Laplacian (parallel edges pull twice as hard)
+  L = np.zeros((n, n))
+  np.add.at(L, (edges[:,0], edges[:,1]), -1)
+  np.add.at(L, (edges[:,1], edges[:,0]), -1)
+  L[np.diag_indices(n)] = -L.sum(axis=1)
+  pos[free] = np.linalg.solve(L[np.ix_(free, free)], -L[np.ix_(free, fixed)] @ pos[fixed])
+  # nodes with the same neighbours land on the same place, split them slightly
+  pos[free] += 1e-3 * np.stack([np.cos(free), np.sin(free)], axis=1)
+
+  degree = L.diagonal()[free][:, None]
+  step = spacing / 2
+  for i in range(iterations):
+    delta = pos[free][:, None, :] - pos[None, :, :]
+    d2 = np.maximum((delta**2).sum(axis=2), 1e-6)
+    push = np.maximum(spacing**2 / d2 - 1, 0)
+    push[np.arange(len(free)), free] = 0
+    force = (delta * push[..., None]).sum(axis=1) - (L[free] @ pos)
+    move = force / (degree + push.sum(axis=1, keepdims=True)) / 2
+    length = np.maximum(np.hypot(move[:,0], move[:,1])[:, None], 1e-12)
+    if length.max() < 0.05: break
+    pos[free] += move * np.minimum(1, step / length)
+    if bounds is not None:
+      pos[free] = np.clip(pos[free], bounds[:2], bounds[2:])
+    step *= 0.9
+  return pos
+
+class graph(feyn):
+  def __init__(self,
+               edges = [],
+               incoming = [],
+               outgoing = [],
+               states = [],
+               **kwargs
+               ):
+    super().__init__(**kwargs)
+    """
+    Draw Feynman diagram (by making axodraw .tex file) of any topology, given as a graph which is laid out
+    automatically (see graph_layout). The incoming legs are placed on the left and the outgoing legs on
+    the right, in the order given, and the vertices between them, e.g. for b -> c l nu
+      graph(edges=[('b','v1','fermion','$\\bquark$'), ('v1','c','fermion','$\\cquark$'), ('v1','v2','W','$\\Wm$'),
+                   ('v2','l','fermion','$\\ellm$'), ('nu','v2','fermion','$\\neub$')],
+            incoming=['b'], outgoing=['c','l','nu'])
+    edges    : the propagators, each (start, end, kind) or (start, end, kind, label) where kind is one of
+               fermion (with an arrow from start to end), line, photon, W or gluon. Propagators between
+               the same two vertices are drawn as arcs (a gluon is kept straight)
+    incoming : the incoming legs, from top to bottom (each the name of a node with one propagator)
+    outgoing : the outgoing legs, from top to bottom
+    states   : bound states, each (label, legs) drawing an oval around neighbouring legs
+    The other nodes are vertices. A label of a propagator ending at a leg is drawn next to the leg
+    """
+    edges = [ tuple(e) + (None,)*(4-len(e)) for e in edges ]
+    for start, end, kind, label in edges:
+      if kind not in propagators:
+        raise ValueError(f'Unknown propagator {kind} from {start} to {end}, should be one of {", ".join(propagators)}')
+      if start == end:
+        raise ValueError(f'Propagator {kind} starts and ends at {start}')
+    incoming, outgoing = list(incoming), list(outgoing)
+    legs = incoming + outgoing
+    if len(set(legs)) < len(legs):
+      raise ValueError('Each leg can only be given once in incoming and outgoing')
+    nodes = list(dict.fromkeys(legs + [ n for e in edges for n in e[:2] ]))
+    index = { name: i for i, name in enumerate(nodes) }
+    ends = [ (index[e[0]], index[e[1]]) for e in edges ]
+    degree = collections.Counter( i for e in ends for i in e )
+    for leg in legs:
+      if degree[index[leg]] != 1:
+        raise ValueError(f'Leg {leg} should have one propagator, not {degree[index[leg]]}')
+
+    # where each leg and state goes
+    groups = [ (label, list(members)) for label, members in states ]
+    pinned = {}
+    for side, x in ((incoming, 25), (outgoing, self.width-25)):
+      if not side: continue
+      space = min(40, (self.height-20)/max(1, len(side)-1))
+      for i, leg in enumerate(side):
+        pinned[index[leg]] = (x, self.height/2 + space*((len(side)-1)/2 - i))
+    for label, members in groups:
+      side = incoming if members[0] in incoming else outgoing
+      if any( m not in side for m in members ) or \
+         sorted( side.index(m) for m in members ) != list(range(side.index(members[0]), side.index(members[0])+len(members))):
+        raise ValueError(f'State {label} should be neighbouring legs on one side, not {", ".join(members)}')
+
+    # lay it out once for each shape of graph (the labels do not change it)
+    key = (tuple(nodes), tuple(ends), tuple(sorted(pinned.items())), self.width, self.height)
+    if key not in _graph_layouts:
+      reached = set(pinned)
+      while True:
+        more = { b for a, b in ends if a in reached } | { a for a, b in ends if b in reached }
+        if more <= reached: break
+        reached |= more
+      if len(reached) < len(nodes):
+        lost = [ nodes[i] for i in range(len(nodes)) if i not in reached ]
+        raise ValueError(f'Vertices {", ".join(lost)} are not connected to any leg')
+      pos = graph_layout(len(nodes), ends, pinned, bounds=(35, 10, self.width-35, self.height-10))
+      _graph_layouts[key] = [ (_number(round(x, 1)), _number(round(y, 1))) for x, y in pos ]
+    pos = _graph_layouts[key]
+    centre = [ sum(p[0] for p in pos)/len(pos), sum(p[1] for p in pos)/len(pos) ] if pos else [0, 0]
+
+    # the sagitta of each propagator, as a fraction of the distance between its ends,
+    # spreading the propagators between the same two vertices (straight if there is one)
+    bulge = [0]*len(edges)
+    pairs = collections.defaultdict(list)
+    for i, (a, b) in enumerate(ends):
+      pairs[min(a, b), max(a, b)].append(i)
+    for (a, b), group in pairs.items():
+      if len(group) == 1: continue
+      gluons = [ i for i in group if edges[i][2] == 'gluon' ]
+      if len(gluons) > 1:
+        raise ValueError(f'Only one gluon can join {nodes[a]} and {nodes[b]}')
+      k = len(group) + (len(group) % 2 == 0 and len(gluons))
+      offsets = sorted( ( (j-(k-1)/2)/(k-1) for j in range(k) ), key=abs )
+      for i in gluons + [ i for i in group if i not in gluons ]:
+        # relative to the direction of the propagator
+        bulge[i] = offsets.pop(0) * (1 if ends[i][0] == a else -1)
+
+    def leg_label(leg, other, label, top):
+      # beside the leg, above or below (for a leg of a state, the side away from the other legs)
+      # and raised enough to clear the propagator as it rises or falls
+      if label is None: return ''
+      (x, y), (ox, oy) = pos[index[leg]], pos[index[other]]
+      inward = 1 if leg in incoming else -1
+      width, height, depth = label_extent(label)
+      rise = (oy-y) / max(abs(ox-x), 1) * (5+width)
+      if top is None: top = rise <= 0
+      shift = 2 + max(0, rise if top else -rise) + (depth if top else 0)
+      return self.text(_number(x+5*inward), _number(round(y+(shift if top else -shift), 1)), label, align=('l' if inward > 0 else 'r')+('b' if top else 't'))
+
+    # Propagators
+    self.add_element( '% Propagators' )
+    tops = { m: pos[index[m]][1] >= sum( pos[index[n]][1] for n in members )/len(members) for label, members in groups for m in members }
+    for i, (start, end, kind, label) in enumerate(edges):
+      p, q = pos[index[start]], pos[index[end]]
+      if start in legs or end in legs:
+        leg, other = (start, end) if start in legs else (end, start)
+        text = leg_label(leg, other, label, tops.get(leg))
+      else:
+        text = self.propagator_label(p, q, bulge[i], centre, label)
+      self.add_element( text, f'% {start} -> {end} {kind} Label' )
+      self.add_element( self.propagator(p, q, kind, bulge[i]), f'% {start} -> {end} {kind} Line' )
+    self.add_element( '' )
+
+    # Vertices
+    self.add_element( '% Vertices' )
+    for name in nodes:
+      if name in legs: continue
+      self.add_element( self.vertex(*pos[index[name]]), f'% {name} Vertex' )
+    self.add_element( '' )
+
+    # States
+    if groups:
+      self.add_element( '% States' )
+    for label, members in groups:
+      x = pos[index[members[0]]][0]
+      ys = [ pos[index[m]][1] for m in members ]
+      y = _number(round(sum(ys)/len(ys), 1))
+      inward = 1 if members[0] in incoming else -1
+      self.add_element( self.text(x-7*inward, y, label, align='r' if inward > 0 else 'l'), '% Label' )
+      size = max(self.oval_height/2, (max(ys)-min(ys))/2)
+      self.add_element( Oval((x, y), self.oval_width, _number(size), 90, self.oval_grey), '% Bound State' )
+    if groups:
+      self.add_element( '' )
+
+    # Write it
+    if self.eager: self.render()
+
+  @classmethod
+  def stamp(cls, **kwargs):
+    # the layout of each shape of graph is cached, so there is no template to fill
+    return cls(**kwargs)
 
+  def propagator(self, p, q, kind, bulge=0):
+    """
+    Return the element drawing a propagator from p to q, bulging to its left by bulge
+    times the distance between them (an arc) or straight if bulge is 0
+    """
+    length = math.hypot(q[0]-p[0], q[1]-p[1])
+    if kind == 'gluon':
+      return self.gluon(p, q, 3, max(2, round(length/10)))
+    if bulge == 0:
+      if kind in ('photon', 'W'):
+        return self.photon(p, q, 2, max(2, round(length/9)))
+      return self.fermion(p, q) if kind == 'fermion' else Line(p, q)
+    centre, radius, a, b = _bulge_arc(p, q, bulge)
+    if kind in ('photon', 'W'):
+      start, end = (a, b) if bulge < 0 else (b, a)
+      return self.photon_arc(centre, radius, start, end, 2, max(2, round(radius*abs(math.radians((end-start) % 360))/9)))
+    opts = ['clockwise'] if bulge > 0 else []
+    return self.fermion_arc(centre, radius, a, b, opts=opts) if kind == 'fermion' else Arc(centre, radius, a, b, opts)
+
+  def propagator_label(self, p, q, bulge, centre, label):
+    """
+    Return the label of a propagator from p to q (see propagator), placed beside its middle
+    on the side away from centre (or outside an arc)
+    """
+    if label is None: return ''
+    length = math.hypot(q[0]-p[0], q[1]-p[1]) or 1
+    nx, ny = -(q[1]-p[1])/length, (q[0]-p[0])/length
+    mx, my = (p[0]+q[0])/2 + nx*bulge*length, (p[1]+q[1])/2 + ny*bulge*length
+    if bulge < 0 or ( bulge == 0 and nx*(mx-centre[0]) + ny*(my-centre[1]) < 0 ):
+      nx, ny = -nx, -ny
+    align = ('l' if nx > 0 else 'r') if abs(nx) > abs(ny) else ('b' if ny > 0 else 't')
+    return self.text(_number(round(mx+5*nx, 1)), _number(round(my+5*ny, 1)), label, align=align)
+
+def _bulge_arc(p, q, bulge):
+  # the circle through p and q whose arc between them bulges to the left of p -> q by bulge times
+  # their distance: the centre, radius and the angles (degrees) of p and q
+  c = math.hypot(q[0]-p[0], q[1]-p[1])
+  s = bulge*c
+  nx, ny = -(q[1]-p[1])/c, (q[0]-p[0])/c
+  radius = (c*c/4 + s*s) / (2*abs(s))
+  t = s - math.copysign(radius, s)
+  cx, cy = (p[0]+q[0])/2 + nx*t, (p[1]+q[1])/2 + ny*t
+  angle = lambda x, y: _number(round(math.degrees(math.atan2(y-cy, x-cx)) % 360, 1))
+  return (_number(round(cx, 1)), _number(round(cy, 1))), _number(round(radius, 1)), angle(*p), angle(*q)
+
+def main(argv=None):
+  """
+  Command line interface, e.g. python feyn.py build manifest.toml or python feyn.py serve
+  """
+  # diagram scripts run by watch import feyn, which should be this module when run as python feyn.py
+  sys.modules.setdefault('feyn', sys.modules[__name__])
+  parser = argparse.ArgumentParser(prog='feyn', description='Draw Feynman diagrams with axodraw')
+  commands = parser.add_subparsers(dest='command', required=True)
+  p = commands.add_parser('build', help='build the diagrams of a manifest which are out of date')
+  p.add_argument('manifest', nargs='?', default='manifest.toml', help='the manifest (default: manifest.toml)')
+  p.add_argument('-j', '--jobs', type=int, default=None, help='number of processes to compile with (default: every core)')
+  p.add_argument('--batch', action='store_true', help='compile every diagram in one TeX run')
+  p.add_argument('-B', '--force', action='store_true', help='rebuild every diagram')
+  p.add_argument('-n', '--dry-run', action='store_true', help='only list the diagrams which would be rebuilt')
+  p.add_argument('--timings', action='store_true', help='print the time spent in each stage')
+  p.add_argument('--timings-jsonl', metavar='PATH', help='append the time of each stage of each diagram to PATH as JSON lines')
+  p.add_argument('--metrics', metavar='PATH', help='write the time spent in each stage to PATH in the Prometheus text format')
+  p = commands.add_parser('layout', help='check the layout of the diagrams of a manifest without running TeX')
+  p.add_argument('manifest', nargs='?', default='manifest.toml', help='the manifest (default: manifest.toml)')
+  p.add_argument('--pad', type=float, default=5, help='space to leave around each diagram in pt (default: 5)')
+  p = commands.add_parser('watch', help='rebuild the diagrams of manifests and scripts as they are edited')
+  p.add_argument('sources', nargs='*', default=['manifest.toml'],
+                 help='manifests (.toml) and diagram scripts (.py) to watch (default: manifest.toml)')
+  p.add_argument('-j', '--jobs', type=int, default=None, help='number of processes to compile with (default: every core)')
+  p.add_argument('--png', action='store_true', help='also keep a .png of each diagram up to date (needs pdf2image)')
+  p.add_argument('--dpi', type=int, default=200, help='resolution of the .png files (default: 200)')
+  p.add_argument('--interval', type=float, default=0.25, help='seconds between checks for changes (default: 0.25)')
+  p.add_argument('--cold', action='store_true', help='compile a single change with a new pdflatex rather than a waiting one')
+  p = commands.add_parser('regress', help='check that diagrams still match their committed .tex and .pdf files')
+  p.add_argument('sources', nargs='*', default=['manifest.toml'],
+                 help='manifests (.toml) and diagram scripts (.py) of the diagrams (default: manifest.toml)')
+  p.add_argument('-j', '--jobs', type=int, default=None, help='number of processes to compile and compare with (default: every core)')
+  p.add_argument('--dpi', type=int, default=100, help='resolution to compare the images at (default: 100)')
+  p.add_argument('--threshold', type=int, default=32, help='smallest change of a pixel (out of 255) which counts (default: 32)')
+  p.add_argument('--tolerance', type=float, default=1e-3, help='largest fraction of pixels which can differ (default: 0.001)')
+  p.add_argument('--diffs', default='regression', help='directory for the images of the differences (default: regression)')
+  p = commands.add_parser('serve', help='run a local HTTP service which renders diagrams')
+  p.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+  p.add_argument('-p', '--port', type=int, default=8000, help='port to listen on (default: 8000)')
+  p.add_argument('-j', '--jobs', type=int, default=None, help='number of diagrams to render at once (default: every core)')
+  p.add_argument('--cache-size', type=int, default=64, help='size of the in-memory cache in MB (default: 64)')
+  p.add_argument('--warm', action='store_true', help='compile through a warm tex_worker')
+  args = parser.parse_args(argv)
+
+  try:
+    if args.command == 'build':
+      with contextlib.ExitStack() as stack:
+        records = stack.enter_context( profile() )
+        if args.timings_jsonl:
+          stack.callback( remove_timing, on_timing(timing_jsonl(args.timings_jsonl)) )
+        build(args.manifest, args.jobs, args.batch, args.force, args.dry_run)
+      if args.timings:
+        print( timing_summary(records) )
+      if args.metrics:
+        with open(args.metrics,'w') as f:
+          f.write( timing_prometheus(records) )
+    elif args.command == 'layout':
+      for line in layout_report(load_manifest(args.manifest), args.pad):
+        print(line)
+    elif args.command == 'watch':
+      watcher(args.sources, args.jobs, args.png, args.dpi, not args.cold).run(args.interval)
+    elif args.command == 'regress':
+      diagrams = [ d for source in args.sources for d in load_diagrams(source) ]
+      results = regression(diagrams, args.dpi, args.threshold, args.tolerance, args.diffs, args.jobs)
+      for r in results:
+        if r.status != 'same': print(f'{r.fname}: {r.status}' + (f', {r.detail}' if r.detail else ''))
+      failed = sum( r.status in ('differs', 'missing') for r in results )
+      print(f'{len(results)-failed} of {len(results)} diagrams match')
+      if failed: parser.exit(1)
+    elif args.command == 'serve':
+      serve(args.host, args.port, args.jobs, args.cache_size*1024*1024, args.warm)
+  except (TexError, ValueError, FileNotFoundError) as e:
+    parser.exit(1, f'feyn: {e}\n')
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,8 @@
 import os
-os.system('mkdir -p feyns')
-from feyn import tree_external, tree_internal
+os.makedirs('feyns', exist_ok=True)
+from feyn import tree_external, tree_internal, render_all
+
+diagrams = []
 
 # B+ -> D0b K+
 dec = tree_external(
@@ -12,6 +14,7 @@ dec = tree_external(
     C_quarks=(r'$\cquarkbar$',r'$\uquark$'),
     W_label = r'\small{$\Wp$}',
     fname='feyns/Bp2DzbKp' )
+diagrams.append(dec)
 
 # B- -> D0 K-
 dec = tree_external(
@@ -24,6 +27,7 @@ dec = tree_external(
     W_label = r'\small{$\Wm$}',
     anti_at_top = False,
     fname='feyns/Bm2DzKm' )
+diagrams.append(dec)
 
 # B+ -> D0 K+
 dec = tree_internal(
@@ -35,6 +39,7 @@ dec = tree_internal(
     C_quarks=(r'$\squarkbar$',r'$\uquark$'),
     W_label = r'\small{$\Wp$}',
     fname='feyns/Bp2DzKp' )
+diagrams.append(dec)
 
 # B- -> D0b K-
 dec = tree_internal(
@@ -47,4 +52,6 @@ dec = tree_internal(
     W_label = r'\small{$\Wm$}',
     anti_at_top = False,
     fname='feyns/Bm2DzbKm' )
+diagrams.append(dec)
 
+render_all(diagrams)
@@ -1,6 +1,8 @@
 import os
-os.system('mkdir -p feyns')
-from feyn import mixing1, mixing2
+os.makedirs('feyns', exist_ok=True)
+from feyn import mixing1, mixing2, render_all
+
+diagrams = []
 
 # Bs0 -> Bs0b mixing 1
 dec = mixing1(
@@ -14,20 +16,10 @@ dec = mixing1(
     #Wr_label = r'\small{$W$}',
     fname = 'feyns/BsMixing1'
     )
+diagrams.append(dec)
 
 # Bs0b -> Bs0 mixing 1
-dec = mixing1(
-    A_label=r'$\Bsb$',
-    A_quarks=(r'$\bquark$',r'$\squarkbar$'),
-    Abar_label = r'$\Bs$',
-    Abar_quarks = (r'$\squark$',r'$\bquarkbar$'),
-    #qt_label = r'$\uquark,\cquark,\tquark$',
-    #qb_label = r'$\uquarkbar,\cquarkbar,\tquarkbar$',
-    #Wl_label = r'\small{$W$}',
-    #Wr_label = r'\small{$W$}',
-    anti_at_top = False,
-    fname = 'feyns/BsbMixing1'
-    )
+diagrams.append( dec.conjugate(fname='feyns/BsbMixing1') )
 
 # Bs0 -> Bs0b mixing 2
 dec = mixing2(
@@ -41,22 +33,9 @@ dec = mixing2(
     #Wb_label = r'\small{$\Wm$}',
     fname = 'feyns/BsMixing2'
     )
+diagrams.append(dec)
 
 # Bs0b -> Bs0 mixing 2
-dec = mixing2(
-    A_label=r'$\Bsb$',
-    A_quarks=(r'$\bquark$',r'$\squarkbar$'),
-    Abar_label = r'$\Bs$',
-    Abar_quarks = (r'$\squark$',r'$\bquarkbar$'),
-    #ql_label = r'$\uquark,\cquark,\tquark$',
-    #qr_label = r'$\uquark,\cquark,\tquark$',
-    #Wt_label = r'\small{$\Wm$}',
-    #Wb_label = r'\small{$\Wp$}',
-    anti_at_top = False,
-    fname = 'feyns/BsbMixing2'
-    )
-
-
-
-
+diagrams.append( dec.conjugate(fname='feyns/BsbMixing2') )
 
+render_all(diagrams)
@@ -0,0 +1,419 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import warnings
+
+import pytest
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+import feyn
+
+# a pdflatex which fails on the first line holding \broken, writing a log like the real one
+failing_pdflatex = r'''
+import sys
+src = [ a for a in sys.argv[1:] if not a.startswith('-') ][-1]
+src = src if src.endswith('.tex') else src+'.tex'
+lines = open(src).read().split('\n')
+n = next( i for i, line in enumerate(lines) if r'\broken' in line ) + 1
+open('feyn.log','w').write('! Undefined control sequence.\nl.%d %s\n' % (n, lines[n-1]))
+print('! Undefined control sequence.')
+sys.exit(1)
+'''
+
+def test_compile_pool_raises_tex_error(tmp_path, monkeypatch):
+  bin = tmp_path/'bin'
+  bin.mkdir()
+  (bin/'pdflatex').write_text(f'#!{sys.executable}\n' + failing_pdflatex)
+  (bin/'pdflatex').chmod(0o755)
+  monkeypatch.setenv('PATH', str(bin) + os.pathsep + os.environ['PATH'])
+  monkeypatch.chdir(tmp_path)
+
+  d = feyn.feyn(fname='broken', wrap_lhcb=False, fmt=False, cache=False, validate=False)
+  d.add_element(r'\broken', '% Broken element')
+  with pytest.raises(feyn.TexError) as e:
+    feyn.compile_pool([d], workers=1)
+  assert e.value.step == 'pdflatex'
+  assert e.value.message == 'Undefined control sequence.'
+  assert e.value.source.strip().startswith(r'\broken')
+  assert e.value.comment == 'Broken element'
+  assert open('broken.tex').read().split('\n')[e.value.line-1] == e.value.source
+
+# a pdflatex which answers the questions of tex_defined, knowing the macros of plain LaTeX used in math_label
+answering_pdflatex = r'''
+import re, sys
+known = {'langle', 'rangle', 'equiv', 'propto', 'vert', 'mskip', 'nearrow', 'tfrac', 'z@'}
+for name in re.findall(r'feyn-defined:([A-Za-z@]+):', open('feyn.tex').read()):
+  print('feyn-defined:%s:%d' % (name, name in known))
+'''
+
+math_label = r'$\langle \Bd \vert \tfrac{1}{2} \rangle \equiv x \propto y \mskip3mu \nearrow$'
+
+def fake_tex(tmp_path, monkeypatch, code):
+  bin = tmp_path/'bin'
+  bin.mkdir()
+  (bin/'pdflatex').write_text(f'#!{sys.executable}\n' + code)
+  (bin/'pdflatex').chmod(0o755)
+  monkeypatch.setenv('PATH', str(bin) + os.pathsep + os.environ['PATH'])
+  monkeypatch.setattr(feyn, 'default_cache', feyn.compile_cache(str(tmp_path/'cache')))
+  monkeypatch.chdir(here)
+  feyn.toolchain_version.cache_clear()
+
+def test_check_accepts_latex_macros(tmp_path, monkeypatch):
+  fake_tex(tmp_path, monkeypatch, answering_pdflatex)
+  d = feyn.tree_external(A_label=math_label)
+  assert d.check() == []
+  d = feyn.tree_external(A_label=r'$\Kstarzbb \langle$')
+  assert d.check() == [ r'feyn: A meson: Label: undefined \Kstarzbb' ]
+
+def test_check_macros_with_at(tmp_path, monkeypatch):
+  fake_tex(tmp_path, monkeypatch, answering_pdflatex)
+  assert feyn.tree_external(A_label=r'$\Bd\kern\z@$').check() == []
+  d = feyn.tree_external(A_label=r'$\Bd\input@path$')
+  with warnings.catch_warnings():
+    warnings.simplefilter('error')
+    assert d.check() == [ r'feyn: A meson: Label: undefined \input@path' ]
+
+def test_async_check_leaves_the_loop_running(tmp_path, monkeypatch):
+  # a slow pdflatex, which answers tex_defined but cannot compile
+  fake_tex(tmp_path, monkeypatch, 'import sys, time\ntime.sleep(0.5)\n' + answering_pdflatex + 'sys.exit(1)\n')
+  ticks = []
+  async def tick():
+    while True:
+      ticks.append(time.perf_counter())
+      await asyncio.sleep(0.02)
+  async def main():
+    ticker = asyncio.ensure_future(tick())
+    await asyncio.sleep(0)
+    with pytest.raises(feyn.TexError):
+      await feyn.render_all_async([ feyn.tree_external(fname=str(tmp_path/'a'), A_label=math_label, fmt=False, cache=False) ])
+    ticker.cancel()
+  asyncio.run(main())
+  assert max( b - a for a, b in zip(ticks, ticks[1:]) ) < 0.3
+
+def test_check_without_tex_only_warns(tmp_path, monkeypatch):
+  fake_tex(tmp_path, monkeypatch, 'import sys\nsys.exit(1)\n')
+  d = feyn.tree_external(A_label=math_label)
+  with pytest.warns(UserWarning, match=r'cannot run pdflatex to check \\equiv'):
+    assert d.check() == []
+
+def test_service_renders_svg(monkeypatch):
+  monkeypatch.chdir(here)
+  service = feyn.render_service(workers=2)
+  request = {'topology': 'tree_external', 'A_label': r'$\Bd$', 'format': 'svg'}
+  replies = []
+  # an svg is rendered so quickly that the render is often finished before render() adds its callback
+  thread = threading.Thread(target=lambda: replies.extend( service.render(request) for i in range(20) ), daemon=True)
+  thread.start()
+  thread.join(30)
+  service.close()
+  assert not thread.is_alive()
+  assert replies[0][1] == 'image/svg+xml' and replies[0][0].startswith(b'<svg')
+  assert service.stats()['misses'] == 1
+
+def test_service_errors(tmp_path, monkeypatch):
+  # run from a directory without lhcb-symbols-def.tex
+  monkeypatch.chdir(tmp_path)
+  server = feyn.ThreadingHTTPServer(('127.0.0.1', 0), feyn._service_handler)
+  server.service = feyn.render_service(workers=1)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  def post(request):
+    url = f'http://127.0.0.1:{server.server_address[1]}/render'
+    try:
+      urllib.request.urlopen(urllib.request.Request(url, json.dumps(request).encode()), timeout=30)
+    except urllib.error.HTTPError as e:
+      return e.code, json.loads(e.read())['error']
+  try:
+    assert post({'topology': 'tree_external', 'format': 'png', 'dpi': 'high'}) == (400, "Invalid dpi 'high', should be a number from 1 to 2400")
+    code, error = post({'topology': 'tree_external', 'A_label': r'$\Bd$'})
+    assert code == 500 and 'Cannot find lhcb-symbols-def.tex' in error
+    monkeypatch.chdir(here)
+    # labels are compiled as TeX, so only the known macros are let through
+    code, error = post({'topology': 'tree_external', 'A_label': r'\input{/etc/passwd}'})
+    assert code == 422 and r'undefined \input' in error
+    code, error = post({'topology': 'tree_external', 'B_label': r'^^5cinput{/etc/passwd}'})
+    assert code == 422 and 'character code ^^' in error
+  finally:
+    server.shutdown()
+    server.server_close()
+    server.service.close()
+
+def test_stamp_matches_topology():
+  labels = dict(A_label=r'$\Bd$', A_quarks=(r'$\bquarkbar$', r'$\dquark$'), B_label=r'$\Dm$', W_label='$W^+$')
+  built = feyn.loop_external(fname='a', **labels)
+  stamped = feyn.loop_external.stamp(fname='a.tex', **labels)
+  assert type(stamped) is feyn.loop_external and stamped.fname == 'a'
+  assert stamped.to_tex() == built.to_tex() and stamped.to_svg() == built.to_svg()
+  # the labels of one stamp are not left in the template for the next
+  assert feyn.loop_external.stamp().to_tex() == feyn.loop_external().to_tex()
+  with pytest.raises(TypeError):
+    feyn.loop_external.stamp(colour='red')
+
+def test_conjugate_macros_are_defined():
+  defined = feyn.macro_table(os.path.join(here, 'lhcb-symbols-def.tex')).defined
+  assert sorted( name for name in feyn.conjugate_macros if name not in defined ) == []
+
+def test_render_without_symbols_file(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  with pytest.raises(FileNotFoundError, match='Cannot find lhcb-symbols-def.tex'):
+    feyn.tree_external(fname='a', A_label=r'$\Bd$').render()
+  with pytest.raises(FileNotFoundError, match='Cannot find lhcb-symbols-def.tex'):
+    feyn.render_all([ feyn.tree_external(fname='a', A_label=r'$\Bd$') ])
+
+# a pdflatex which writes the pictures it was given as the pages of its pdf, listing its runs in FEYN_TEST_RUNS
+paging_pdflatex = r'''
+import os, re, sys
+if '--version' in sys.argv: sys.exit()
+open(os.environ['FEYN_TEST_RUNS'], 'a').write('pdflatex\n')
+src = [ a for a in sys.argv[1:] if not a.startswith('-') ][-1]
+src = src if src.endswith('.tex') else src+'.tex'
+pictures = re.findall(r'\\begin\{axopicture\}.*?\n(.*?)\\end\{axopicture\}', open(src).read(), re.S)
+open(os.path.basename(src)[:-4]+'.pdf', 'w').write('%PDF-1.4\n' + '%page\n'.join(pictures))
+'''
+
+fake_tools = {
+  'axohelp': "import os, sys\nif '-v' in sys.argv: sys.exit()\nopen(os.environ['FEYN_TEST_RUNS'], 'a').write('axohelp\\n')\n",
+  'pdfseparate': "import sys\npages = open(sys.argv[-2]).read()[len('%PDF-1.4\\n'):].split('%page\\n')\n"
+                 "for i, page in enumerate(pages): open(sys.argv[-1] % (i+1), 'w').write('%PDF-1.4\\n' + page)\n",
+}
+
+def batch_diagrams(tmp_path, monkeypatch, tools):
+  fake_tex(tmp_path, monkeypatch, paging_pdflatex)
+  for name in tools:
+    (tmp_path/'bin'/name).write_text(f'#!{sys.executable}\n' + fake_tools[name])
+    (tmp_path/'bin'/name).chmod(0o755)
+  # only the fake tools are found
+  monkeypatch.setenv('PATH', str(tmp_path/'bin'))
+  monkeypatch.setenv('FEYN_TEST_RUNS', str(tmp_path/'runs'))
+  monkeypatch.chdir(tmp_path)
+  photon = feyn.feyn(fname='photon', wrap_lhcb=False, fmt=False, cache=False)
+  photon.add_element(photon.photon((10,10), (90,40), 2, 5))
+  line = feyn.feyn(fname='line', wrap_lhcb=False, fmt=False, cache=False, axohelp=False)
+  line.add_element(line.fermion((10,10), (90,10)))
+  return [ photon, line ]
+
+def test_compile_batch_without_pdfseparate(tmp_path, monkeypatch):
+  diagrams = batch_diagrams(tmp_path, monkeypatch, ['axohelp'])
+  assert feyn.compile_batch(diagrams) == [ 'photon.pdf', 'line.pdf' ]
+  # each diagram is compiled on its own, with just the passes it needs
+  assert open('runs').read().split() == [ 'pdflatex', 'axohelp', 'pdflatex', 'pdflatex' ]
+  assert r'\Photon(10,10)(90,40){2}{5}' in open('photon.pdf').read()
+  assert r'\Line[arrow](10,10)(90,10)' in open('line.pdf').read() and r'\Photon' not in open('line.pdf').read()
+
+def test_compile_batch_at_once(tmp_path, monkeypatch):
+  diagrams = batch_diagrams(tmp_path, monkeypatch, ['axohelp', 'pdfseparate'])
+  # two batches running together each write their document in a directory of their own
+  threads = [ threading.Thread(target=feyn.compile_batch, args=([d],)) for d in diagrams ]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join(30)
+  assert sorted(open('runs').read().split()) == [ 'axohelp', 'pdflatex', 'pdflatex', 'pdflatex' ]
+  assert r'\Photon(10,10)(90,40){2}{5}' in open('photon.pdf').read()
+  assert r'\Line[arrow](10,10)(90,10)' in open('line.pdf').read() and r'\Photon' not in open('line.pdf').read()
+  assert sorted(os.listdir(tmp_path)) == [ 'bin', 'cache', 'line.pdf', 'line.tex', 'photon.pdf', 'photon.tex', 'runs' ]
+
+def test_cache_put_from_threads(tmp_path):
+  cache = feyn.compile_cache(str(tmp_path/'cache'))
+  pdfs = []
+  for i in range(8):
+    pdfs.append(tmp_path/f'{i}.pdf')
+    pdfs[-1].write_text(f'%PDF-1.4 {i}\n')
+  errors = []
+  def put(pdf):
+    try:
+      for j in range(20): cache.put('same', str(pdf))
+    except Exception as e:
+      errors.append(e)
+  threads = [ threading.Thread(target=put, args=(pdf,)) for pdf in pdfs ]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join(30)
+  assert errors == []
+  assert os.listdir(tmp_path/'cache') == [ 'same.pdf' ]
+  assert cache.get('same', str(tmp_path/'out.pdf')) and open(tmp_path/'out.pdf').read().startswith('%PDF-1.4 ')
+
+def test_cache_hit_runs_no_tex(tmp_path, monkeypatch):
+  fake_tex(tmp_path, monkeypatch, paging_pdflatex)
+  monkeypatch.setenv('FEYN_TEST_RUNS', str(tmp_path/'runs'))
+  monkeypatch.setattr(feyn, '_formats', {})
+  d = feyn.feyn(fname=str(tmp_path/'a'), wrap_lhcb=False, axohelp=False)
+  d.add_element(d.fermion((10,10), (90,10)))
+  d.render()
+  # trying to build the format (which this pdflatex cannot) and compiling
+  assert open(tmp_path/'runs').read().split() == [ 'pdflatex', 'pdflatex' ]
+  # as in a new process: a cache hit runs no TeX, and the format which failed is not tried again
+  os.remove(tmp_path/'runs')
+  feyn._formats.clear()
+  d.render()
+  assert not os.path.exists(tmp_path/'runs')
+  d.copy(fname=str(tmp_path/'b'), width=100).render()
+  assert open(tmp_path/'runs').read().split() == [ 'pdflatex' ]
+
+def test_format_without_pdflatex(tmp_path, monkeypatch):
+  fake_tex(tmp_path, monkeypatch, '')
+  monkeypatch.setenv('PATH', str(tmp_path/'cache'))
+  monkeypatch.setattr(feyn, '_formats', {})
+  assert feyn.tex_format(wrap_lhcb=False) is None
+
+def test_from_tex_round_trip():
+  d = feyn.feyn()
+  for tex in [ r'\Line[arrow](10,10)(90,10)', r'\Arc[arrow,clockwise](50,50)(20,0,180)', r'\Photon(10,10)(90,40){2}{5}',
+               r'\Gluon(10,10)(90,40){2.5}{5}', r'\PhotonArc(50,50)(20,0,180){-3}{8}', r'\Vertex(1,2){2}',
+               r'\GOval(60,50)(20,5)(90){0.7}', r'\Text(30,92)[lb]{$\Bd$}' ]:
+    assert d.element_tex(feyn.from_tex(tex)).strip() == tex
+
+def test_collecting_is_local(tmp_path):
+  script = tmp_path/'script.py'
+  script.write_text('import feyn\n'
+                    f'feyn.tree_external(fname={str(tmp_path/"a")!r}, backend="svg").render()\n'
+                    f'feyn.render_all([ feyn.tree_internal(fname={str(tmp_path/"b")!r}, backend="svg") ])\n')
+  assert [ d.fname for d in feyn.script_diagrams(str(script)) ] == [ str(tmp_path/'a'), str(tmp_path/'b') ]
+  assert not os.path.exists(tmp_path/'a.svg')
+  # another thread renders as usual while this one collects
+  with feyn.collecting() as collected:
+    thread = threading.Thread(target=feyn.tree_external(fname=str(tmp_path/'c'), backend='svg').render)
+    thread.start()
+    thread.join(30)
+  assert collected == [] and os.path.exists(tmp_path/'c.svg')
+  with pytest.raises(RuntimeError):
+    with feyn.collecting():
+      raise RuntimeError
+  feyn.tree_external(fname=str(tmp_path/'d'), backend='svg').render()
+  assert os.path.exists(tmp_path/'d.svg')
+
+# a pdftoppm which writes the number of each page as its image, listing its runs in FEYN_TEST_RUNS
+fake_pdftoppm = r'''
+import os, sys
+open(os.environ['FEYN_TEST_RUNS'], 'a').write('pdftoppm\n')
+args = sys.argv[1:]
+first, last = int(args[args.index('-f')+1]), int(args[args.index('-l')+1])
+for page in range(first, last+1):
+  open('%s-%0*d.png' % (args[-1], len(str(last)), page), 'w').write('page %d' % page)
+'''
+
+def test_rasterize_batch_runs_pdftoppm_once(tmp_path, monkeypatch):
+  (tmp_path/'pdftoppm').write_text(f'#!{sys.executable}\n' + fake_pdftoppm)
+  (tmp_path/'pdftoppm').chmod(0o755)
+  monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+  monkeypatch.setenv('FEYN_TEST_RUNS', str(tmp_path/'runs'))
+  names = [ str(tmp_path/f'd{i}') for i in range(12) ]
+  assert feyn.rasterize_batch(str(tmp_path/'batch.pdf'), names) == [ name+'.png' for name in names ]
+  assert open(tmp_path/'runs').read().split() == [ 'pdftoppm' ]
+  assert [ open(name+'.png').read() for name in names ] == [ f'page {i+1}' for i in range(12) ]
+
+def test_cache_evicts_least_recently_used(tmp_path):
+  cache = feyn.compile_cache(str(tmp_path/'cache'), max_size=30)
+  pdf = tmp_path/'a.pdf'
+  pdf.write_text('%PDF-1.4 \n')
+  for i, key in enumerate('abc'):
+    cache.put(key, str(pdf))
+    os.utime(cache.entry(key), (1000+i, 1000+i))
+  # using a marks it as recently used, so b is the one to go
+  assert cache.get('a', str(tmp_path/'out.pdf'))
+  cache.put('d', str(pdf))
+  assert not cache.get('b', str(tmp_path/'out.pdf'))
+  assert sorted( os.path.basename(path) for mtime, size, path in cache.entries() ) == [ 'a.pdf', 'c.pdf', 'd.pdf' ]
+  assert cache.stats() == { 'hits': 1, 'misses': 1, 'entries': 3, 'size': 30 }
+  cache.clear()
+  assert cache.stats()['entries'] == 0
+
+@pytest.mark.parametrize('name', [ 'tree_external', 'tree_internal', 'loop_external', 'loop_internal', 'mixing1', 'mixing2' ])
+def test_stamp_with_structure(name):
+  topology = getattr(feyn, name)
+  labels = { k: r'$\Bd$' if default is None else tuple( f'$q_{i}$' for i in range(len(default)) )
+             for k, default in feyn.topology_labels(topology).items() }
+  for structure in ( {}, {'anti_at_top': False}, {'draw_states': False} ):
+    if not set(structure) <= feyn.topology_options(topology): continue
+    built = topology(**labels, **structure)
+    stamped = topology.stamp(**labels, **structure)
+    assert stamped.to_tex() == built.to_tex()
+    assert (stamped.aq, stamped.qq) == (built.aq, built.qq)
+
+def test_transforms_round_trip():
+  d = feyn.tree_external(A_label=r'$\Bd$', A_quarks=(r'$\bquarkbar$', r'$\dquark$'), B_label=r'$\Dm$', W_label='$W^+$')
+  assert d.mirror().mirror().to_tex() == d.to_tex()
+  assert d.shift(5, -3).shift(-5, 3).to_tex() == d.to_tex()
+  assert d.scale(2).scale(0.5).to_tex() == d.to_tex()
+  assert d.transform(flip_y=True, shift=(0, 140)).transform(flip_y=True, shift=(0, 140)).to_tex() == d.to_tex()
+  assert d.conjugate().conjugate().to_tex() == d.to_tex()
+
+def test_conjugate_swaps_particles():
+  d = feyn.tree_external(A_label=r'$\Bd$', A_quarks=(r'$\bquarkbar$', r'$\dquark$'), B_label=r'$\Dm$')
+  c = d.conjugate(fname='conjugate')
+  assert [ obj.text for obj, comment in c.lines if isinstance(obj, feyn.Text) ] == [ r'$\bquark$', r'$\dquarkbar$', r'$\Bdb$', r'$\Dp$' ]
+  assert (c.aq, c.qq) == (d.qq, d.aq)
+  assert c.fname == 'conjugate' and d.fname == 'feyn'
+
+def test_prune_lhcb_keeps_used_macros(monkeypatch):
+  monkeypatch.chdir(here)
+  table = feyn.macro_table('lhcb-symbols-def.tex')
+  # \BdToKstmm is \decay{\Bd}{\Kstarz\mup\mun}, and those are made of \PB, \PK, ...
+  assert table.needed({'BdToKstmm', 'langle'}) == { 'BdToKstmm', 'decay', 'to', 'Bd', 'B', 'PB', 'Kstarz', 'kaon', 'PK', 'mup', 'mun', 'Pmu' }
+  d = feyn.tree_external(A_label=r'$\BdToKstmm$', prune_lhcb=True)
+  definitions = d.lhcb_definitions(d.picture())
+  assert all( line.endswith('%') for line in definitions )
+  assert any( line.startswith(r'\def\BdToKstmm') for line in definitions )
+  assert any( line.startswith(r'\def\Kstarz') for line in definitions )
+  assert not any( line.startswith(r'\def\Bs ') for line in definitions )
+  assert not any( 'lhcb-symbols-def' in line for line in d.preamble() )
+  assert not d.needs_lhcb()
+
+def test_plan_passes():
+  three = [ 'pdflatex', 'axohelp', 'pdflatex' ]
+  photon = feyn.Photon((0,0), (90,40), 2, 5)
+  arc = feyn.Arc((50,50), 20, 0, 180, ['arrow'])
+  assert feyn.plan_passes([ feyn.Line((0,0), (90,0), ['arrow']), feyn.Vertex((0,0), 2), feyn.Text((0,0), '$a$') ]) == [ 'pdflatex' ]
+  assert feyn.plan_passes([ [photon, '% W'] ]) == three
+  assert feyn.plan_passes([ arc ]) == three
+  # drawn as paths in python instead
+  assert feyn.plan_passes([ photon, arc ], axohelp=False) == [ 'pdflatex' ]
+  # lines of axodraw code, e.g. from a .tex file
+  assert feyn.plan_passes([ r'\Line(0,0)(1,1)', '% a comment', r'\GOval(60,50)(20,5)(90){0.7}' ]) == [ 'pdflatex' ]
+  assert feyn.plan_passes([ r'\ArrowArc(0,0)(5,0,90)' ]) == three
+  assert feyn.plan_passes(feyn.picture_lines('\\begin{axopicture}(1,1)\n\\Gluon(0,0)(1,1){2}{3}\n\\end{axopicture}')) == three
+
+@pytest.mark.parametrize('kwargs, error', [
+  (dict(edges=[('b','v','higgs'), ('v','c','fermion')], incoming=['b'], outgoing=['c']), 'Unknown propagator higgs from b to v'),
+  (dict(edges=[('b','b','fermion')], incoming=['b']), 'Propagator fermion starts and ends at b'),
+  (dict(edges=[('b','c','fermion')], incoming=['b'], outgoing=['b']), 'Each leg can only be given once'),
+  (dict(edges=[('b','v','fermion'), ('b','c','fermion')], incoming=['b'], outgoing=['c']), 'Leg b should have one propagator, not 2'),
+  (dict(edges=[('b','v','fermion'), ('v','c','fermion'), ('v','d','fermion')], incoming=['b'], outgoing=['c','d'],
+        states=[('$B$', ['b','d'])]), r'State \$B\$ should be neighbouring legs on one side, not b, d'),
+  (dict(edges=[('b','c','fermion'), ('v1','v2','gluon')], incoming=['b'], outgoing=['c']), 'Vertices v1, v2 are not connected to any leg'),
+])
+def test_graph_errors(kwargs, error):
+  with pytest.raises(ValueError, match=error):
+    feyn.graph(**kwargs)
+
+def test_gallery_rebuilds_changed_diagrams(tmp_path, monkeypatch):
+  done = []
+  def rasterize(pdfs, dpi=200, workers=None):
+    done.append( sorted( os.path.basename(pdf) for pdf in pdfs ) )
+    for pdf in pdfs:
+      open(pdf[:-len('.pdf')]+'.png','w').write('png')
+    return [ pdf[:-len('.pdf')]+'.png' for pdf in pdfs ]
+  monkeypatch.setattr(feyn, 'rasterize', rasterize)
+  for name in 'ab':
+    (tmp_path/f'{name}.tex').write_text(name)
+    (tmp_path/f'{name}.pdf').write_text(name)
+
+  feyn.gallery(str(tmp_path))
+  feyn.gallery(str(tmp_path))
+  (tmp_path/'a.tex').write_text('a changed')
+  feyn.gallery(str(tmp_path))
+  os.remove(tmp_path/'b.png')
+  feyn.gallery(str(tmp_path))
+  assert done == [ ['a.pdf', 'b.pdf'], [], ['a.pdf'], ['b.pdf'] ]
+
+  # the README only changes with the list of diagrams
+  readme = (tmp_path/'README.md').read_text()
+  assert '[`a`](a.pdf)' in readme and '[`b`](b.pdf)' in readme
+  os.utime(tmp_path/'README.md', (1000, 1000))
+  feyn.gallery(str(tmp_path))
+  assert os.path.getmtime(tmp_path/'README.md') == 1000
+  (tmp_path/'c.pdf').write_text('c')
+  feyn.gallery(str(tmp_path))
+  assert done[-1] == ['c.pdf'] and '[`c`](c.pdf)' in (tmp_path/'README.md').read_text()